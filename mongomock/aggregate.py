@@ -5,6 +5,7 @@ import collections
 import copy
 import datetime
 import decimal
+import functools
 import itertools
 import math
 import numbers
@@ -150,92 +151,252 @@ type_convertion_operators = [
 ]
 
 
-def _avg_operation(values):
-    values_list = list(v for v in values if isinstance(v, numbers.Number))
-    if not values_list:
-        return None
-    return sum(values_list) / float(len(list(values_list)))
+class _Accumulator(object):
+    """Accumulator of a group, consuming its values one at a time.
 
+    A new accumulator is created for each group, then accumulate is called with the value of
+    the expression for each document of the group, except the ones where it is missing.
+    finalize gives the value of the output field.
+    """
 
-def _group_operation(values, operator):
-    values_list = list(v for v in values if v is not None)
-    if not values_list:
-        return None
-    return operator(values_list)
+    def accumulate(self, value):
+        raise NotImplementedError  # pragma: no cover
 
+    def finalize(self):
+        raise NotImplementedError  # pragma: no cover
 
-def _sum_operation(values):
-    values_list = list()
-    if decimal_support:
-        for v in values:
-            if isinstance(v, numbers.Number):
-                values_list.append(v)
-            elif isinstance(v, decimal128.Decimal128):
-                values_list.append(v.to_decimal())
-    else:
-        values_list = list(v for v in values if isinstance(v, numbers.Number))
-    sum_value = sum(values_list)
-    return decimal128.Decimal128(sum_value) if isinstance(sum_value, decimal.Decimal) else sum_value
+
+class _SumAccumulator(_Accumulator):
+
+    def __init__(self):
+        self._sum = 0
+
+    def accumulate(self, value):
+        if isinstance(value, numbers.Number):
+            self._sum += value
+        elif decimal_support and isinstance(value, decimal128.Decimal128):
+            self._sum += value.to_decimal()
+
+    def finalize(self):
+        if isinstance(self._sum, decimal.Decimal):
+            return decimal128.Decimal128(self._sum)
+        return self._sum
+
+
+class _AvgAccumulator(_Accumulator):
+
+    def __init__(self):
+        self._sum = 0
+        self._count = 0
+
+    def accumulate(self, value):
+        if isinstance(value, numbers.Number):
+            self._sum += value
+            self._count += 1
+
+    def finalize(self):
+        if not self._count:
+            return None
+        return self._sum / float(self._count)
+
+
+class _MinAccumulator(_Accumulator):
+
+    def __init__(self):
+        self._value = None
+
+    def accumulate(self, value):
+        if value is not None and (self._value is None or value < self._value):
+            self._value = value
+
+    def finalize(self):
+        return self._value
+
+
+class _MaxAccumulator(_Accumulator):
+
+    def __init__(self):
+        self._value = None
+
+    def accumulate(self, value):
+        if value is not None and (self._value is None or value > self._value):
+            self._value = value
+
+    def finalize(self):
+        return self._value
+
+
+class _FirstAccumulator(_Accumulator):
+
+    def __init__(self):
+        self._value = NOTHING
+
+    def accumulate(self, value):
+        if self._value is NOTHING:
+            self._value = value
+
+    def finalize(self):
+        return None if self._value is NOTHING else self._value
+
+
+class _LastAccumulator(_Accumulator):
+
+    def __init__(self):
+        self._value = None
+
+    def accumulate(self, value):
+        self._value = value
+
+    def finalize(self):
+        return self._value
+
+
+class _PushAccumulator(_Accumulator):
+
+    def __init__(self):
+        self._values = []
+
+    def accumulate(self, value):
+        self._values.append(value)
+
+    def finalize(self):
+        return self._values
+
+
+class _AddToSetAccumulator(_Accumulator):
+    """Accumulator of the distinct values, hashed with their BSON sort keys.
+
+    Values without a sort key, e.g. Decimal128, are compared with the other such values.
+    """
+
+    def __init__(self):
+        self._keys = set()
+        self._unkeyed_values = []
+        self._values = []
+
+    def accumulate(self, value):
+        value = value or None
+        try:
+            key = filtering.bson_sort_key(value)
+        except NotImplementedError:
+            if value not in self._unkeyed_values:
+                self._unkeyed_values.append(value)
+                self._values.append(value)
+            return
+        if key not in self._keys:
+            self._keys.add(key)
+            self._values.append(value)
+
+    def finalize(self):
+        return self._values
+
+
+class _StdDevPopAccumulator(_Accumulator):
+    """Accumulator of the standard deviation of numbers, using Welford's algorithm."""
+
+    def __init__(self):
+        self._count = 0
+        self._mean = 0.
+        self._sum_of_squares = 0.
+
+    def accumulate(self, value):
+        if not isinstance(value, numbers.Number) or isinstance(value, bool):
+            return
+        self._count += 1
+        delta = value - self._mean
+        self._mean += delta / self._count
+        self._sum_of_squares += delta * (value - self._mean)
+
+    def finalize(self):
+        if not self._count:
+            return None
+        return math.sqrt(self._sum_of_squares / self._count)
+
+
+class _StdDevSampAccumulator(_StdDevPopAccumulator):
+
+    def finalize(self):
+        if self._count < 2:
+            return None
+        return math.sqrt(self._sum_of_squares / (self._count - 1))
+
+
+class _MergeObjectsAccumulator(_Accumulator):
+
+    def __init__(self):
+        self._value = {}
+
+    def accumulate(self, value):
+        if value is None:
+            return
+        if not isinstance(value, dict):
+            raise OperationFailure(
+                '$mergeObjects requires object inputs, but input %r is of type %s'
+                % (value, type(value).__name__))
+        self._value.update(value)
+
+    def finalize(self):
+        return self._value
+
+
+_ACCUMULATORS = {
+    '$addToSet': _AddToSetAccumulator,
+    '$avg': _AvgAccumulator,
+    '$first': _FirstAccumulator,
+    '$last': _LastAccumulator,
+    '$max': _MaxAccumulator,
+    '$mergeObjects': _MergeObjectsAccumulator,
+    '$min': _MinAccumulator,
+    '$push': _PushAccumulator,
+    '$stdDevPop': _StdDevPopAccumulator,
+    '$stdDevSamp': _StdDevSampAccumulator,
+    '$sum': _SumAccumulator,
+}
+
+
+def _accumulate_values(accumulator_class, values):
+    accumulator = accumulator_class()
+    for value in values:
+        accumulator.accumulate(value)
+    return accumulator.finalize()
 
 
 _GROUPING_OPERATOR_MAP = {
-    '$sum': _sum_operation,
-    '$avg': _avg_operation,
-    '$min': lambda values: _group_operation(values, min),
-    '$max': lambda values: _group_operation(values, max),
+    operator: functools.partial(_accumulate_values, _ACCUMULATORS[operator])
+    for operator in ('$sum', '$avg', '$min', '$max')
 }
 
 
 class _Parser(object):
-    """Helper to parse expressions within the aggregate pipeline."""
+    """Helper to parse expressions within the aggregate pipeline.
+
+    The first time an expression is parsed, its field path or the handler of its operator is
+    looked up once and kept in compiled_expressions, see _compile_parser_expression. Sharing it
+    between parsers, e.g. for all the documents of a stage, avoids these lookups for each
+    document. The handlers still interpret the arguments of their operator on each call.
+    """
 
-    def __init__(self, doc_dict, user_vars=None, ignore_missing_keys=False):
+    def __init__(self, doc_dict, user_vars=None, ignore_missing_keys=False,
+                 compiled_expressions=None):
         self._doc_dict = doc_dict
         self._ignore_missing_keys = ignore_missing_keys
         self._user_vars = user_vars or {}
+        self._compiled_expressions = {} if compiled_expressions is None else \
+            compiled_expressions
 
     def parse(self, expression):
         """Parse a MongoDB expression."""
-        if not isinstance(expression, dict):
-            return self._parse_basic_expression(expression)
-
-        if len(expression) > 1 and any(key.startswith('$') for key in expression):
-            raise OperationFailure(
-                'an expression specification must contain exactly one field, '
-                'the name of the expression. Found %d fields in %s'
-                % (len(expression), expression))
-
+        # Compiled expressions are keyed by identity, and keep a reference to the expression
+        # so that its id cannot be reused by another object.
+        compiled = self._compiled_expressions.get(id(expression))
+        if compiled is None or compiled[0] is not expression:
+            compiled = (expression, _compile_parser_expression(expression))
+            self._compiled_expressions[id(expression)] = compiled
+        return compiled[1](self)
+
+    def _parse_object(self, expression):
         value_dict = {}
         for k, v in six.iteritems(expression):
-            if k in arithmetic_operators:
-                return self._handle_arithmetic_operator(k, v)
-            if k in project_operators:
-                return self._handle_project_operator(k, v)
-            if k in projection_operators:
-                return self._handle_projection_operator(k, v)
-            if k in comparison_operators:
-                return self._handle_comparison_operator(k, v)
-            if k in date_operators:
-                return self._handle_date_operator(k, v)
-            if k in array_operators:
-                return self._handle_array_operator(k, v)
-            if k in conditional_operators:
-                return self._handle_conditional_operator(k, v)
-            if k in control_flow_operators:
-                return self._handle_control_flow_operator(k, v)
-            if k in set_operators:
-                return self._handle_set_operator(k, v)
-            if k in string_operators:
-                return self._handle_string_operator(k, v)
-            if k in type_convertion_operators:
-                return self._handle_type_convertion_operator(k, v)
-            if k in boolean_operators:
-                return self._handle_boolean_operator(k, v)
-            if k in text_search_operators + projection_operators + object_operators:
-                raise NotImplementedError(
-                    "'%s' is a valid operation but it is not supported by Mongomock yet." % k)
-            if k.startswith('$'):
-                raise OperationFailure("Unrecognized expression '%s'" % k)
             try:
                 value = self.parse(v)
             except KeyError:
@@ -243,7 +404,6 @@ class _Parser(object):
                     continue
                 raise
             value_dict[k] = value
-
         return value_dict
 
     def parse_many(self, values):
@@ -265,13 +425,16 @@ class _Parser(object):
     def _parse_basic_expression(self, expression):
         if isinstance(expression, six.string_types) and expression.startswith('$'):
             if expression.startswith('$$'):
-                return helpers.get_value_by_dot(dict({
-                    'ROOT': self._doc_dict,
-                    'CURRENT': self._doc_dict,
-                }, **self._user_vars), expression[2:])
+                return self._get_variable(expression[2:])
             return helpers.get_value_by_dot(self._doc_dict, expression[1:], can_generate_array=True)
         return expression
 
+    def _get_variable(self, path):
+        return helpers.get_value_by_dot(dict({
+            'ROOT': self._doc_dict,
+            'CURRENT': self._doc_dict,
+        }, **self._user_vars), path)
+
     def _handle_boolean_operator(self, operator, values):
         if operator == '$and':
             return all([self._parse_to_bool(value) for value in values])
@@ -586,6 +749,7 @@ class _Parser(object):
                     self._doc_dict,
                     dict(self._user_vars, **{fieldname: item}),
                     ignore_missing_keys=self._ignore_missing_keys,
+                    compiled_expressions=self._compiled_expressions,
                 ).parse(cond)
             ]
         if operator == '$slice':
@@ -812,62 +976,112 @@ class _Parser(object):
             'pipeline, it is currently not implemented in Mongomock.' % operator)
 
 
-def _parse_expression(expression, doc_dict, ignore_missing_keys=False):
-    """Parse an expression.
+# The handlers of the expression operators, in the order they are looked for.
+_EXPRESSION_OPERATOR_HANDLERS = {}
+for _operators, _handler in (
+        (arithmetic_operators, _Parser._handle_arithmetic_operator),
+        (project_operators, _Parser._handle_project_operator),
+        (projection_operators, _Parser._handle_projection_operator),
+        (comparison_operators, _Parser._handle_comparison_operator),
+        (date_operators, _Parser._handle_date_operator),
+        (array_operators, _Parser._handle_array_operator),
+        (conditional_operators, _Parser._handle_conditional_operator),
+        (control_flow_operators, _Parser._handle_control_flow_operator),
+        (set_operators, _Parser._handle_set_operator),
+        (string_operators, _Parser._handle_string_operator),
+        (type_convertion_operators, _Parser._handle_type_convertion_operator),
+        (boolean_operators, _Parser._handle_boolean_operator)):
+    for _operator in _operators:
+        _EXPRESSION_OPERATOR_HANDLERS.setdefault(_operator, _handler)
+del _operators, _handler, _operator
+
+
+def _compile_parser_expression(expression):
+    """Compile an expression into a function evaluating it with a _Parser.
+
+    Only the top level of the expression is analysed: the function directly gets the value of
+    its field path, or calls the handler of its operator with the raw arguments.
+    """
+    if isinstance(expression, six.string_types) and expression.startswith('$'):
+        if expression.startswith('$$'):
+            variable_path = expression[2:]
+            return lambda parser: parser._get_variable(variable_path)
+        path = expression[1:]
+        if '.' in path:
+            return lambda parser: helpers.get_value_by_dot(
+                parser._doc_dict, path, can_generate_array=True)
+
+        def _get_field(parser):
+            doc_dict = parser._doc_dict
+            if isinstance(doc_dict, dict):
+                return doc_dict[path]
+            return helpers.get_value_by_dot(doc_dict, path, can_generate_array=True)
+        return _get_field
+
+    if not isinstance(expression, dict):
+        return lambda unused_parser: expression
+
+    if len(expression) > 1 and any(key.startswith('$') for key in expression):
+        raise OperationFailure(
+            'an expression specification must contain exactly one field, '
+            'the name of the expression. Found %d fields in %s'
+            % (len(expression), expression))
+
+    for k, v in six.iteritems(expression):
+        handler = _EXPRESSION_OPERATOR_HANDLERS.get(k)
+        if handler:
+            return lambda parser: handler(parser, k, v)
+        if k in text_search_operators + projection_operators + object_operators:
+            raise NotImplementedError(
+                "'%s' is a valid operation but it is not supported by Mongomock yet." % k)
+        if k.startswith('$'):
+            raise OperationFailure("Unrecognized expression '%s'" % k)
+
+    return lambda parser: parser._parse_object(expression)
+
+
+def _compile_expression(expression, ignore_missing_keys=False):
+    """Compile an expression into a function evaluating it on a document.
+
+    A single parser is used for all the documents, so that the lookups of field paths and
+    operator handlers of the expression and its sub-expressions are only done the first time
+    they are evaluated: compile the expressions of a stage once for all its documents.
 
     Args:
         expression: an Aggregate Expression, see
             https://docs.mongodb.com/manual/meta/aggregation-quick-reference/#aggregation-expressions.
-        doc_dict: the document on which to evaluate the expression.
         ignore_missing_keys: if True, missing keys evaluated by the expression are ignored silently
             if it is possible.
     """
-    return _Parser(doc_dict, ignore_missing_keys=ignore_missing_keys).parse(expression)
+    parser = _Parser(None, ignore_missing_keys=ignore_missing_keys)
+
+    def _evaluate(doc_dict):
+        parser._doc_dict = doc_dict
+        return parser.parse(expression)
+    return _evaluate
 
 
-def _accumulate_group(output_fields, group_list):
-    doc_dict = {}
+def _compile_accumulators(output_fields):
+    """List the (field, compiled expression, accumulator class) of the output fields of a group."""
+    accumulators = []
     for field, value in six.iteritems(output_fields):
         if field == '_id':
             continue
         for operator, key in six.iteritems(value):
-            values = []
-            for doc in group_list:
-                try:
-                    values.append(_parse_expression(key, doc))
-                except KeyError:
-                    continue
-            if operator in _GROUPING_OPERATOR_MAP:
-                doc_dict[field] = _GROUPING_OPERATOR_MAP[operator](values)
-            elif operator == '$first':
-                doc_dict[field] = values[0] if values else None
-            elif operator == '$last':
-                doc_dict[field] = values[-1] if values else None
-            elif operator == '$addToSet':
-                value = []
-                val_it = (val or None for val in values)
-                # Don't use set in case elt in not hashable (like dicts).
-                for elt in val_it:
-                    if elt not in value:
-                        value.append(elt)
-                doc_dict[field] = value
-            elif operator == '$push':
-                if field not in doc_dict:
-                    doc_dict[field] = values
-                else:
-                    doc_dict[field].extend(values)
-            elif operator in group_operators:
-                raise NotImplementedError(
-                    'Although %s is a valid group operator for the '
-                    'aggregation pipeline, it is currently not implemented '
-                    'in Mongomock.' % operator)
-            else:
-                raise NotImplementedError(
+            try:
+                accumulators.append((field, _compile_expression(key), _ACCUMULATORS[operator]))
+            except KeyError as err:
+                if operator in group_operators:
+                    raise_from(NotImplementedError(
+                        'Although %s is a valid group operator for the '
+                        'aggregation pipeline, it is currently not implemented '
+                        'in Mongomock.' % operator), err)
+                raise_from(NotImplementedError(
                     '%s is not a valid group operator for the aggregation '
                     'pipeline. See http://docs.mongodb.org/manual/meta/'
                     'aggregation-quick-reference/ for a complete list of '
-                    'valid operators.' % operator)
-    return doc_dict
+                    'valid operators.' % operator), err)
+    return accumulators
 
 
 def _fix_sort_key(key_getter):
@@ -910,17 +1124,140 @@ def _handle_lookup_stage(in_collection, database, options):
     foreign_field = options['foreignField']
     local_name = options['as']
     foreign_collection = database.get_collection(foreign_name)
-    for doc in in_collection:
-        try:
-            query = helpers.get_value_by_dot(doc, local_field)
-        except KeyError:
-            query = None
-        if isinstance(query, list):
-            query = {'$in': query}
-        matches = foreign_collection.find({foreign_field: query})
-        doc[local_name] = [foreign_doc for foreign_doc in matches]
+    # Without an index, join with a hash table of the foreign collection built once, instead
+    # of scanning the whole foreign collection for each document.
+    lookup_table = None
+    if not foreign_collection._has_index_on(foreign_field):
+        lookup_table = _LookupTable(foreign_collection._iter_stored_copies(), foreign_field)
+
+    def _lookup(in_collection):
+        for doc in in_collection:
+            try:
+                query = helpers.get_value_by_dot(doc, local_field)
+            except KeyError:
+                query = None
+            if lookup_table is not None:
+                doc[local_name] = lookup_table.find(query)
+            else:
+                if isinstance(query, list):
+                    query = {'$in': query}
+                matches = foreign_collection._iter_stored_copies({foreign_field: query})
+                doc[local_name] = [foreign_doc for foreign_doc in matches]
+            yield doc
 
-    return in_collection
+    return _lookup(in_collection)
+
+
+def _get_equality_key(value):
+    """Get a hashable key of a value, equal for the values a query considers equal.
+
+    Queries compare values with ==, so that e.g. True matches 1 and dicts match regardless of
+    the order of their keys. Raises TypeError if the value, or one of its items, cannot be
+    hashed or is NaN, which is not equal to itself.
+    """
+    if isinstance(value, dict):
+        return _DICT_KEY, frozenset((k, _get_equality_key(v)) for k, v in six.iteritems(value))
+    if isinstance(value, (list, tuple)):
+        return _LIST_KEY, tuple(_get_equality_key(item) for item in value)
+    hash(value)
+    if value != value:
+        raise TypeError('NaN cannot be used as a key')
+    return value
+
+
+def _is_operator_query(value):
+    if isinstance(value, _RE_TYPES):
+        return True
+    return isinstance(value, dict) and any(key.startswith('$') for key in value)
+
+
+_DICT_KEY = object()
+_LIST_KEY = object()
+_STRING_ITEM_KEY = object()
+
+
+class _LookupTable(object):
+    """Hash table of documents keyed by the values of one of their fields.
+
+    Finding a value gives the same documents as an equality filter on the field: a document is
+    listed under the key of each value it holds at the field, of each item of its arrays, and
+    of None if it misses the field. Documents holding values that cannot be hashed, e.g.
+    Decimal128, are matched with the filter instead.
+    """
+
+    def __init__(self, documents, field):
+        self.documents = []
+        self._field = field
+        # Positions by the keys of the values, and of the items of arrays.
+        self._positions_by_key = collections.defaultdict(list)
+        # Positions by the keys of whole arrays, only matched by a value, not by $in.
+        self._positions_by_array_key = collections.defaultdict(list)
+        self._unhashed_positions = []
+        for position, doc in enumerate(documents):
+            self.documents.append(doc)
+            try:
+                keys, array_keys = self._get_document_keys(doc)
+            except TypeError:
+                self._unhashed_positions.append(position)
+                continue
+            for key in keys:
+                self._positions_by_key[key].append(position)
+            for key in array_keys:
+                self._positions_by_array_key[key].append(position)
+
+    def _get_document_keys(self, doc):
+        keys = set()
+        array_keys = set()
+        for value in filtering.iter_key_candidates(self._field, doc):
+            if value is NOTHING:
+                value = None
+            if not isinstance(value, (list, tuple)):
+                keys.add(_get_equality_key(value))
+                continue
+            array_keys.add(_get_equality_key(value))
+            for item in value:
+                keys.add(_get_equality_key(item))
+                if isinstance(item, six.string_types):
+                    # An ObjectId matches its string form in arrays.
+                    array_keys.add((_STRING_ITEM_KEY, item))
+        return keys, array_keys
+
+    def find_positions(self, query):
+        """Find the positions of the documents matching a value, or any value of a list.
+
+        The positions are in the natural order of the documents.
+        """
+        is_in_query = isinstance(query, list)
+        values = query if is_in_query else [query]
+        if any(_is_operator_query(value) for value in values) or \
+                isinstance(query, dict) and not query:
+            # Regexes and operators need to be matched as a query. An empty document also
+            # matches the documents missing the field.
+            return self._filter_positions(query, moves.range(len(self.documents)))
+        try:
+            lookups = [(self._positions_by_key, _get_equality_key(value)) for value in values]
+        except TypeError:
+            return self._filter_positions(query, moves.range(len(self.documents)))
+
+        if not is_in_query:
+            lookups.append((self._positions_by_array_key, lookups[0][1]))
+            if isinstance(query, helpers.ObjectId):
+                lookups.append((self._positions_by_array_key, (_STRING_ITEM_KEY, str(query))))
+        positions = set(itertools.chain.from_iterable(
+            positions_by_key.get(key, ()) for positions_by_key, key in lookups))
+        if self._unhashed_positions:
+            positions.update(self._filter_positions(query, self._unhashed_positions))
+        return sorted(positions)
+
+    def _filter_positions(self, query, positions):
+        """Filter the positions of the documents matching a value, or any value of a list."""
+        matches_filter = filtering.compile_filter(
+            {self._field: {'$in': query} if isinstance(query, list) else query})
+        return [position for position in positions if matches_filter(self.documents[position])]
+
+    def find(self, query):
+        """Get copies of the documents matching a value, or any value of a list."""
+        return [copy.deepcopy(self.documents[position]) for position in self.find_positions(query)]
 
 
 def _handle_graph_lookup_stage(in_collection, database, options):
@@ -959,64 +1296,113 @@ def _handle_graph_lookup_stage(in_collection, database, options):
     local_name = options['as']
     max_depth = options.get('maxDepth', None)
     depth_field = options.get('depthField', None)
-    restrict_search_with_match = options.get('restrictSearchWithMatch', {})
     foreign_collection = database.get_collection(foreign_name)
-    out_doc = copy.deepcopy(in_collection)  # TODO(pascal): speed the deep copy
-
-    def _find_matches_for_depth(query):
-        if isinstance(query, list):
-            query = {'$in': query}
-        matches = foreign_collection.find({connect_to_field: query})
-        new_matches = []
-        for new_match in matches:
-            if filtering.filter_applies(restrict_search_with_match, new_match) \
-                    and new_match['_id'] not in found_items:
-                if depth_field is not None:
-                    new_match = collections.OrderedDict(new_match, **{depth_field: depth})
-                new_matches.append(new_match)
-                found_items.add(new_match['_id'])
-        return new_matches
-
-    for doc in out_doc:
-        found_items = set()
+    # Adjacency map from the connectToField values to the documents, built once for all the
+    # traversals. Documents excluded by restrictSearchWithMatch are never reached.
+    lookup_table = _LookupTable(
+        foreign_collection._iter_stored_copies(options.get('restrictSearchWithMatch', {})),
+        connect_to_field)
+    foreign_documents = lookup_table.documents
+    get_start_with = _compile_expression(start_with)
+
+    def _graph_lookup(doc):
+        visited = set()
+
+        def _visit(positions):
+            new_positions = [position for position in positions if position not in visited]
+            visited.update(new_positions)
+            return new_positions
+
         depth = 0
-        result = _parse_expression(start_with, doc)
-        origin_matches = doc[local_name] = _find_matches_for_depth(result)
-        while origin_matches and (max_depth is None or depth < max_depth):
+        origin_positions = _visit(lookup_table.find_positions(get_start_with(doc)))
+        found_positions = [(position, depth) for position in origin_positions]
+        while origin_positions and (max_depth is None or depth < max_depth):
             depth += 1
-            newly_discovered_matches = []
-            for match in origin_matches:
-                match_target = match.get(connect_from_field)
-                newly_discovered_matches += _find_matches_for_depth(match_target)
-            doc[local_name] += newly_discovered_matches
-            origin_matches = newly_discovered_matches
-    return out_doc
+            newly_discovered_positions = []
+            for position in origin_positions:
+                match_target = foreign_documents[position].get(connect_from_field)
+                newly_discovered_positions += _visit(lookup_table.find_positions(match_target))
+            found_positions.extend((position, depth) for position in newly_discovered_positions)
+            origin_positions = newly_discovered_positions
+
+        matches = []
+        for position, match_depth in found_positions:
+            match = copy.deepcopy(foreign_documents[position])
+            if depth_field is not None:
+                match = collections.OrderedDict(match, **{depth_field: match_depth})
+            matches.append(match)
+        # Only the output document is copied, to write the "as" field.
+        out_doc = copy.copy(doc)
+        out_doc[local_name] = matches
+        return out_doc
+
+    return (_graph_lookup(doc) for doc in in_collection)
+
+
+def _accumulate_groups(in_collection, key_getter, output_fields, group_ids=()):
+    """Group documents and accumulate their output fields, in a single pass over them.
+
+    Groups are keyed by a canonical hashable encoding of their ID, so that IDs that are equal
+    in BSON (e.g. 1 and 1.0, or equal documents) end up in the same group. Each group only
+    holds the state of its accumulators, not its documents. The groups listed in group_ids
+    are output even if no document falls in them.
+
+    Returns:
+        the (group ID, output fields) pairs sorted by group ID: only the groups are sorted,
+        not the documents.
+    """
+    accumulators = _compile_accumulators(output_fields)
+    groups = {}
+
+    def _get_group_states(group_id):
+        group_key = filtering.bson_sort_key(group_id)
+        try:
+            return groups[group_key][1]
+        except KeyError:
+            states = [accumulator_class() for unused_field, unused_expression, accumulator_class
+                      in accumulators]
+            groups[group_key] = (group_id, states)
+            return states
+
+    for group_id in group_ids:
+        _get_group_states(group_id)
+
+    for doc in in_collection:
+        states = _get_group_states(key_getter(doc))
+        for (unused_field, expression, unused_class), state in zip(accumulators, states):
+            try:
+                value = expression(doc)
+            except KeyError:
+                continue
+            state.accumulate(value)
+
+    return [
+        (group_id, {
+            field: state.finalize()
+            for (field, unused_expression, unused_class), state in zip(accumulators, states)
+        })
+        for group_id, states in (groups[group_key] for group_key in sorted(groups))
+    ]
 
 
 def _handle_group_stage(in_collection, unused_database, options):
     grouped_collection = []
     _id = options['_id']
     if _id:
+        get_id = _compile_expression(_id)
 
         def _key_getter(doc):
             try:
-                return _parse_expression(_id, doc)
+                return get_id(doc)
             except KeyError:
                 return None
 
-        def _sort_key_getter(doc):
-            return filtering.BsonComparable(_key_getter(doc))
-
-        # Sort the collection only for the itertools.groupby.
-        # $group does not order its output document.
-        sorted_collection = sorted(in_collection, key=_sort_key_getter)
-        grouped = itertools.groupby(sorted_collection, _key_getter)
+        grouped = _accumulate_groups(in_collection, _key_getter, options)
     else:
-        grouped = [(None, in_collection)]
+        grouped = _accumulate_groups(
+            in_collection, lambda doc: None, options, group_ids=[None])
 
-    for doc_id, group in grouped:
-        group_list = ([x for x in group])
-        doc_dict = _accumulate_group(options, group_list)
+    for doc_id, doc_dict in grouped:
         doc_dict['_id'] = doc_id
         grouped_collection.append(doc_dict)
 
@@ -1059,6 +1445,8 @@ def _handle_bucket_stage(in_collection, unused_database, options):
                 '$bucket could not find a matching branch for '
                 'an input, and no default was specified.'), err)
 
+    get_group_by = _compile_expression(group_by)
+
     def _get_bucket_id(doc):
         """Get the bucket ID for a document.
 
@@ -1067,7 +1455,7 @@ def _handle_bucket_stage(in_collection, unused_database, options):
         if it's not the same type as the boundaries.
         """
         try:
-            value = _parse_expression(group_by, doc)
+            value = get_group_by(doc)
         except KeyError:
             return (is_default_last, _get_default_bucket())
         index = bisect.bisect_right(boundaries, value)
@@ -1075,14 +1463,9 @@ def _handle_bucket_stage(in_collection, unused_database, options):
             return (False, boundaries[index - 1])
         return (is_default_last, _get_default_bucket())
 
-    in_collection = ((_get_bucket_id(doc), doc) for doc in in_collection)
-    out_collection = sorted(in_collection, key=lambda kv: kv[0])
-    grouped = itertools.groupby(out_collection, lambda kv: kv[0])
-
     out_collection = []
-    for (unused_key, doc_id), group in grouped:
-        group_list = [kv[1] for kv in group]
-        doc_dict = _accumulate_group(output_fields, group_list)
+    grouped = _accumulate_groups(in_collection, _get_bucket_id, output_fields)
+    for (unused_key, doc_id), doc_dict in grouped:
         doc_dict['_id'] = doc_id
         out_collection.append(doc_dict)
     return out_collection
@@ -1101,16 +1484,30 @@ def _handle_sample_stage(in_collection, unused_database, options):
     return shuffled[:size]
 
 
-def _handle_sort_stage(in_collection, unused_database, options):
-    sort_array = reversed([{x: y} for x, y in options.items()])
-    sorted_collection = in_collection
-    for sort_pair in sort_array:
-        for sortKey, sortDirection in sort_pair.items():
-            sorted_collection = sorted(
-                sorted_collection,
-                key=lambda x: filtering.resolve_sort_key(sortKey, x),
-                reverse=sortDirection < 0)
-    return sorted_collection
+def _handle_sort_stage(in_collection, unused_database, options, limit=None):
+    return filtering.sort_documents(in_collection, list(options.items()), limit)
+
+
+def _get_sort_limit(pipeline, sort_index):
+    """Get the number of documents a $sort stage needs to keep.
+
+    As in MongoDB, a $sort followed by a $limit, possibly with $skip stages in between, only
+    needs to keep the first documents. Returns None if all documents are needed.
+    """
+    limit = 0
+    for stage in pipeline[sort_index + 1:]:
+        if len(stage) != 1:
+            return None
+        operator, value = next(six.iteritems(stage))
+        if not isinstance(value, six.integer_types) or isinstance(value, bool) or value < 0:
+            return None
+        if operator == '$skip':
+            limit += value
+            continue
+        if operator == '$limit':
+            return limit + value
+        return None
+    return None
 
 
 def _handle_unwind_stage(in_collection, unused_database, options):
@@ -1124,37 +1521,92 @@ def _handle_unwind_stage(in_collection, unused_database, options):
     path = path[1:]
     should_preserve_null_and_empty = options.get('preserveNullAndEmptyArrays')
     include_array_index = options.get('includeArrayIndex')
-    unwound_collection = []
-    for doc in in_collection:
-        try:
-            array_value = helpers.get_value_by_dot(doc, path)
-        except KeyError:
-            if should_preserve_null_and_empty:
-                unwound_collection.append(doc)
-            continue
-        if array_value is None:
-            if should_preserve_null_and_empty:
-                unwound_collection.append(doc)
-            continue
-        if array_value == []:
-            if should_preserve_null_and_empty:
-                new_doc = copy.deepcopy(doc)
-                # We just ran a get_value_by_dot so we know the value exists.
-                helpers.delete_value_by_dot(new_doc, path)
-                unwound_collection.append(new_doc)
-            continue
-        if isinstance(array_value, list):
-            iter_array = enumerate(array_value)
-        else:
-            iter_array = [(None, array_value)]
-        for index, field_item in iter_array:
-            new_doc = copy.deepcopy(doc)
-            new_doc = helpers.set_value_by_dot(new_doc, path, field_item)
-            if include_array_index:
-                new_doc = helpers.set_value_by_dot(new_doc, include_array_index, index)
-            unwound_collection.append(new_doc)
+    path_parts = path.split('.')
+
+    def _unwind(in_collection):
+        for doc in in_collection:
+            try:
+                array_value = helpers.get_value_by_dot(doc, path)
+            except KeyError:
+                if should_preserve_null_and_empty:
+                    yield doc
+                continue
+            if array_value is None:
+                if should_preserve_null_and_empty:
+                    yield doc
+                continue
+            if array_value == []:
+                if should_preserve_null_and_empty:
+                    new_doc, parent, key = _copy_along_path(doc, path_parts)
+                    # We just ran a get_value_by_dot so we know the value exists.
+                    del parent[key]
+                    yield new_doc
+                continue
+            if isinstance(array_value, list):
+                iter_array = enumerate(array_value)
+            else:
+                iter_array = [(None, array_value)]
+            for index, field_item in iter_array:
+                new_doc, parent, key = _copy_along_path(doc, path_parts)
+                parent[key] = field_item
+                if include_array_index:
+                    new_doc, parent, key = _copy_along_path(
+                        new_doc, include_array_index.split('.'), is_copied=True)
+                    parent[key] = index
+                yield new_doc
+
+    return _unwind(in_collection)
+
 
-    return unwound_collection
+def _copy_document(value):
+    """Copy the documents and arrays of a value.
+
+    Unlike copy.deepcopy, a sub-document appearing several times, e.g. pushed in a group from
+    documents output by $unwind, gets independent copies.
+    """
+    if isinstance(value, dict):
+        return type(value)((key, _copy_document(item)) for key, item in six.iteritems(value))
+    if isinstance(value, list):
+        return [_copy_document(item) for item in value]
+    return value
+
+
+def _copy_along_path(doc, path_parts, is_copied=False):
+    """Copy a document to modify it at a path, without modifying the original document.
+
+    Only the document and the containers along the path are shallowly copied: all the other
+    values are shared with the original document, so they must not be modified in place.
+
+    Args:
+        doc: the document to copy.
+        path_parts: the keys of the path, array indexes included.
+        is_copied: whether the document itself is already a copy.
+
+    Returns:
+        the copy of the document, the copy of the container holding the last part of the
+        path, and the key of the last part in this container.
+    """
+    new_doc = doc if is_copied else copy.copy(doc)
+    parent = new_doc
+    for part in path_parts[:-1]:
+        key = _get_container_key(parent, part)
+        try:
+            value = parent[key]
+        except IndexError as err:
+            raise_from(KeyError(part), err)
+        if not isinstance(value, (dict, list)):
+            raise KeyError(part)
+        parent[key] = parent = copy.copy(value)
+    return new_doc, parent, _get_container_key(parent, path_parts[-1])
+
+
+def _get_container_key(container, part):
+    if not isinstance(container, list):
+        return part
+    try:
+        return int(part)
+    except ValueError as err:
+        raise_from(KeyError(part), err)
 
 
 # TODO(pascal): Combine with the equivalent function in collection but check
@@ -1220,28 +1672,29 @@ def _project_by_spec(doc, proj_spec, is_include):
 def _handle_replace_root_stage(in_collection, unused_database, options):
     if 'newRoot' not in options:
         raise OperationFailure("Parameter 'newRoot' is missing for $replaceRoot operation.")
-    new_root = options['newRoot']
-    out_collection = []
-    for doc in in_collection:
+    get_new_root = _compile_expression(options['newRoot'], ignore_missing_keys=True)
+
+    def _replace_root(doc):
         try:
-            new_doc = _parse_expression(new_root, doc, ignore_missing_keys=True)
+            new_doc = get_new_root(doc)
         except KeyError:
             new_doc = NOTHING
         if not isinstance(new_doc, dict):
             raise OperationFailure(
                 "'newRoot' expression must evaluate to an object, but resulting value was: {}"
                 .format(new_doc))
-        out_collection.append(new_doc)
-    return out_collection
+        return new_doc
+
+    return (_replace_root(doc) for doc in in_collection)
 
 
 def _handle_project_stage(in_collection, unused_database, options):
     filter_list = []
     method = None
     include_id = options.get('_id')
-    # Compute new values for each field, except inclusion/exclusions that are
+    # Compile the expressions of new fields, except inclusion/exclusions that are
     # handled in one final step.
-    new_fields_collection = None
+    new_fields = []
     for field, value in six.iteritems(options):
         if method is None and (field != '_id' or value):
             method = 'include' if value else 'exclude'
@@ -1257,57 +1710,66 @@ def _handle_project_stage(in_collection, unused_database, options):
             if field != '_id':
                 filter_list.append(field)
             continue
-        if not new_fields_collection:
-            new_fields_collection = [{} for unused_doc in in_collection]
+        new_fields.append((field, _compile_expression(value, ignore_missing_keys=True)))
+    if (method == 'include') == (include_id is not False and include_id is not 0):
+        filter_list.append('_id')
+
+    projection_spec = None
+    if filter_list:
+        projection_spec = _combine_projection_spec(filter_list, original_filter=options)
 
-        for in_doc, out_doc in zip(in_collection, new_fields_collection):
+    def _project(doc):
+        new_values = {}
+        for field, get_value in new_fields:
             try:
-                out_doc[field] = _parse_expression(value, in_doc, ignore_missing_keys=True)
+                new_values[field] = get_value(doc)
             except KeyError:
                 pass
-    if (method == 'include') == (include_id is not False and include_id is not 0):
-        filter_list.append('_id')
+        if projection_spec is None:
+            return new_values
 
-    if not filter_list:
-        return new_fields_collection
+        # Final steps: include or exclude fields and merge with newly created fields.
+        out_doc = _project_by_spec(doc, projection_spec, is_include=(method == 'include'))
+        if new_values:
+            return dict(out_doc, **new_values)
+        return out_doc
 
-    # Final steps: include or exclude fields and merge with newly created fields.
-    projection_spec = _combine_projection_spec(filter_list, original_filter=options)
-    out_collection = [
-        _project_by_spec(doc, projection_spec, is_include=(method == 'include'))
-        for doc in in_collection
-    ]
-    if new_fields_collection:
-        return [
-            dict(a, **b)
-            for a, b in zip(out_collection, new_fields_collection)
-        ]
-    return out_collection
+    return (_project(doc) for doc in in_collection)
 
 
 def _handle_add_fields_stage(in_collection, unused_database, options):
     if not options:
         raise OperationFailure(
             'Invalid $addFields :: caused by :: specification must have at least one field')
-    out_collection = [dict(doc) for doc in in_collection]
-    for field, value in six.iteritems(options):
-        for in_doc, out_doc in zip(in_collection, out_collection):
+    new_fields = [
+        (field.split('.'), _compile_expression(value, ignore_missing_keys=True))
+        for field, value in six.iteritems(options)
+    ]
+
+    def _add_fields(in_doc):
+        out_doc = dict(in_doc)
+        for parts, get_value in new_fields:
             try:
-                out_value = _parse_expression(value, in_doc, ignore_missing_keys=True)
+                out_value = get_value(in_doc)
             except KeyError:
                 continue
-            parts = field.split('.')
+            target = out_doc
             for subfield in parts[:-1]:
-                out_doc[subfield] = out_doc.get(subfield, {})
-                if not isinstance(out_doc[subfield], dict):
-                    out_doc[subfield] = {}
-                out_doc = out_doc[subfield]
-            out_doc[parts[-1]] = out_value
-    return out_collection
+                # Copy the sub-documents before modifying them, as they may be shared with
+                # other documents, e.g. by $unwind.
+                sub_doc = target.get(subfield)
+                target[subfield] = dict(sub_doc) if isinstance(sub_doc, dict) else {}
+                target = target[subfield]
+            target[parts[-1]] = out_value
+        return out_doc
+
+    return (_add_fields(doc) for doc in in_collection)
 
 
 def _handle_out_stage(in_collection, database, options):
     # TODO(MetrodataTeam): should leave the origin collection unchanged
+    # Read all the documents first, as they may come from the collection being replaced.
+    in_collection = list(in_collection)
     out_collection = database.get_collection(options)
     if out_collection.count() > 0:
         out_collection.drop()
@@ -1323,23 +1785,29 @@ def _handle_count_stage(in_collection, database, options):
         raise OperationFailure('the count field cannot be a $-prefixed path')
     elif '.' in options:
         raise OperationFailure("the count field cannot contain '.'")
-    return [{options: len(in_collection)}]
+    return [{options: sum(1 for unused_doc in in_collection)}]
 
 
 def _handle_facet_stage(in_collection, database, options):
+    # Each sub-pipeline reads all the documents.
+    in_collection = list(in_collection)
     out_collection_by_pipeline = {}
     for pipeline_title, pipeline in options.items():
         out_collection_by_pipeline[pipeline_title] = list(process_pipeline(
-            in_collection, database, pipeline, None))
+            in_collection, database, pipeline, None, may_contain_datetimes=True))
     return [out_collection_by_pipeline]
 
 
-def _handle_match_stage(in_collection, database, options):
-    spec = helpers.patch_datetime_awareness_in_document(options)
-    return [
+def _handle_match_stage(in_collection, database, options, may_contain_datetimes=True):
+    spec = helpers.patch_datetime_awareness_in_spec(options)
+    matches_spec = filtering.compile_filter(spec)
+    if not may_contain_datetimes:
+        return (doc for doc in in_collection if matches_spec(doc))
+    # The documents built by the previous stages may still need to be patched.
+    return (
         doc for doc in in_collection
-        if filtering.filter_applies(spec, helpers.patch_datetime_awareness_in_document(doc))
-    ]
+        if matches_spec(helpers.patch_datetime_awareness_in_spec(doc))
+    )
 
 
 _PIPELINE_HANDLERS = {
@@ -1354,7 +1822,7 @@ _PIPELINE_HANDLERS = {
     '$graphLookup': _handle_graph_lookup_stage,
     '$group': _handle_group_stage,
     '$indexStats': None,
-    '$limit': lambda c, d, o: c[:o],
+    '$limit': lambda c, d, o: itertools.islice(c, o),
     '$listLocalSessions': None,
     '$listSessions': None,
     '$lookup': _handle_lookup_stage,
@@ -1368,20 +1836,133 @@ _PIPELINE_HANDLERS = {
     '$replaceWith': None,
     '$sample': _handle_sample_stage,
     '$set': _handle_add_fields_stage,
-    '$skip': lambda c, d, o: c[o:],
+    '$skip': lambda c, d, o: itertools.islice(c, o, None),
     '$sort': _handle_sort_stage,
     '$sortByCount': None,
     '$unset': None,
     '$unwind': _handle_unwind_stage,
 }
 
+# Stages whose output only holds values of their input or of stored documents, so that they
+# do not add any datetime that would need to be patched.
+_DATETIME_PRESERVING_STAGES = frozenset([
+    '$count', '$graphLookup', '$limit', '$lookup', '$match', '$sample', '$skip', '$sort',
+    '$unwind',
+])
+
 
-def process_pipeline(collection, database, pipeline, session):
+def _is_non_negative_int(value):
+    return isinstance(value, six.integer_types) and not isinstance(value, bool) and value >= 0
+
+
+def _get_query_sort(options):
+    """Get the sort of a $sort stage, if it can be run by a query, or None otherwise."""
+    if not isinstance(options, dict) or not options:
+        return None
+    sort = list(options.items())
+    for key, direction in sort:
+        if key.startswith('$') or direction not in (1, -1) or isinstance(direction, bool):
+            return None
+    return sort
+
+
+def _is_query_projection(options):
+    """Whether a $project stage gives the same result as a query projection.
+
+    Only exclusions of top-level fields are accepted: an inclusion projection in a query
+    returns the fields in the order of the projection, instead of the order of the document.
+    """
+    if not isinstance(options, dict) or not options:
+        return False
+    for key, value in six.iteritems(options):
+        if not isinstance(key, six.string_types) or not key or key.startswith('$') or \
+                '.' in key:
+            return False
+        if not isinstance(value, six.integer_types) or value != 0:
+            return False
+    return True
+
+
+def split_initial_query(pipeline):
+    """Split the leading stages of a pipeline that can be run as a query on the collection.
+
+    Leading $match stages, then a $sort, $skip and $limit stages and a $project excluding
+    top-level fields are run as a single query, as MongoDB does: it can then use the indexes,
+    and only the documents it returns are copied.
+
+    Returns the arguments of the query, as keyword arguments of
+    Collection._iter_stored_copies, and the remaining stages of the pipeline.
+    """
+    stages = []
+    for stage in pipeline:
+        if len(stage) != 1:
+            break
+        stages.append(next(six.iteritems(stage)))
+
+    query = {}
+    index = 0
+    filters = []
+    while index < len(stages) and stages[index][0] == '$match' and \
+            isinstance(stages[index][1], dict):
+        filters.append(stages[index][1])
+        index += 1
+    if filters:
+        query['filter'] = filters[0] if len(filters) == 1 else {'$and': filters}
+
+    if index < len(stages) and stages[index][0] == '$sort':
+        sort = _get_query_sort(stages[index][1])
+        if sort:
+            query['sort'] = sort
+            index += 1
+
+    skip = 0
+    limit = None
+    while index < len(stages) and stages[index][0] in ('$skip', '$limit') and \
+            _is_non_negative_int(stages[index][1]):
+        operator, value = stages[index]
+        if operator == '$skip':
+            skip += value
+            if limit is not None:
+                limit = max(limit - value, 0)
+        elif not value:
+            # $limit 0 is invalid, leave it to the stage to raise.
+            break
+        else:
+            limit = value if limit is None else min(limit, value)
+        index += 1
+    if skip:
+        query['skip'] = skip
+    if limit is not None:
+        query['limit'] = limit
+
+    if index < len(stages) and stages[index][0] == '$project' and \
+            _is_query_projection(stages[index][1]):
+        query['projection'] = stages[index][1]
+        index += 1
+
+    return query, pipeline[index:]
+
+
+def process_pipeline(collection, database, pipeline, session, may_contain_datetimes=False):
+    """Run the stages of a pipeline on the documents of collection.
+
+    Unless may_contain_datetimes is set, the input documents are considered to be in the form
+    they are stored in, so that $match only patches the datetimes of documents built by
+    earlier stages.
+    """
     if session:
         raise NotImplementedError('Mongomock does not handle sessions yet')
 
-    for stage in pipeline:
+    for index, stage in enumerate(pipeline):
         for operator, options in six.iteritems(stage):
+            if operator == '$sort':
+                collection = _handle_sort_stage(
+                    collection, database, options, limit=_get_sort_limit(pipeline, index))
+                continue
+            if operator == '$match':
+                collection = _handle_match_stage(
+                    collection, database, options, may_contain_datetimes=may_contain_datetimes)
+                continue
             try:
                 handler = _PIPELINE_HANDLERS[operator]
             except KeyError as err:
@@ -1394,5 +1975,12 @@ def process_pipeline(collection, database, pipeline, session):
                     "Although '%s' is a valid operator for the aggregation pipeline, it is "
                     'currently not implemented in Mongomock.' % operator)
             collection = handler(collection, database, options)
+            if operator not in _DATETIME_PRESERVING_STAGES:
+                may_contain_datetimes = True
+
+    if any('$unwind' in stage for stage in pipeline):
+        # $unwind shares the parts of a document it does not change between the documents it
+        # outputs. Copy the results so that they can be modified independently.
+        collection = (_copy_document(doc) for doc in collection)
 
     return command_cursor.CommandCursor(collection)
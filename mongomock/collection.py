@@ -6,11 +6,11 @@ try:
 except ImportError:
     from collections import Iterable, Mapping, MutableMapping
 import copy
+from datetime import datetime
 import functools
 import itertools
 import json
 import math
-import time
 import warnings
 
 try:
@@ -38,6 +38,7 @@ except ImportError:
     from mongomock.read_preferences import PRIMARY as _READ_PREFERENCE_PRIMARY
 
 from sentinels import NOTHING
+from six import integer_types
 from six import iteritems
 from six import iterkeys
 from six import raise_from
@@ -48,14 +49,17 @@ from six import text_type
 import mongomock  # Used for utcnow - please see https://github.com/mongomock/mongomock#utcnow
 from mongomock import aggregate
 from mongomock import codec_options as mongomock_codec_options
+from mongomock.command_cursor import CommandCursor
 from mongomock import ConfigurationError, DuplicateKeyError, BulkWriteError
+from mongomock.filtering import compile_filter
 from mongomock.filtering import filter_applies
 from mongomock.filtering import iter_key_candidates
 from mongomock.filtering import resolve_key
-from mongomock.filtering import resolve_sort_key
+from mongomock.filtering import sort_documents
 from mongomock import helpers
 from mongomock import InvalidOperation
 from mongomock.not_implemented import raise_for_feature as raise_not_implemented
+from mongomock import planner
 from mongomock import ObjectId
 from mongomock import OperationFailure
 from mongomock.read_concern import ReadConcern
@@ -67,10 +71,12 @@ from mongomock.results import UpdateResult
 from mongomock.write_concern import WriteConcern
 from mongomock import WriteError
 
-if hasattr(time, 'perf_counter'):
-    _get_perf_counter = time.perf_counter
-else:
-    _get_perf_counter = time.clock
+_get_perf_counter = helpers.get_perf_counter
+
+_EXPLAIN_VERBOSITIES = ('queryPlanner', 'executionStats', 'allPlansExecution')
+
+# Number of documents fetched at once by a cursor without an explicit batch size.
+_DEFAULT_BATCH_SIZE = 101
 
 _KwargOption = collections.namedtuple('KwargOption', ['typename', 'default', 'attrs'])
 
@@ -231,37 +237,149 @@ def _combine_projection_spec(projection_fields_spec):
     return combined_spec
 
 
-def _project_by_spec(doc, combined_projection_spec, is_include, container):
-    doc_copy = container()
-
-    if not is_include:
-        for key, val in iteritems(doc):
-            doc_copy[key] = val
-
+def _check_no_positional_projection(combined_projection_spec, is_include):
     for key, spec in iteritems(combined_projection_spec):
         if key == '$':
             if is_include:
                 raise NotImplementedError('Positional projection is not implemented in mongomock')
             raise OperationFailure('Cannot exclude array elements with the positional operator')
-        if key not in doc:
-            continue
-
         if isinstance(spec, dict):
-            sub = doc[key]
-            if isinstance(sub, (list, tuple)):
-                doc_copy[key] = [_project_by_spec(sub_doc, spec, is_include, container)
-                                 for sub_doc in sub]
-            elif isinstance(sub, dict):
-                doc_copy[key] = _project_by_spec(sub, spec, is_include, container)
-        else:
-            if is_include:
-                doc_copy[key] = doc[key]
-            else:
-                doc_copy.pop(key, None)
+            _check_no_positional_projection(spec, is_include)
+
+
+def _copy_field(obj, container, tz_aware=False):
+    if isinstance(obj, list):
+        new = []
+        for item in obj:
+            new.append(_copy_field(item, container, tz_aware))
+        return new
+    if isinstance(obj, dict):
+        new = container()
+        for key, value in obj.items():
+            new[key] = _copy_field(value, container, tz_aware)
+        return new
+    if tz_aware and isinstance(obj, datetime):
+        return obj.replace(tzinfo=helpers.utc)
+    return copy.copy(obj)
+
+
+def _copy_by_spec(doc, combined_projection_spec, is_include, container, tz_aware=False,
+                  operator_fields=()):
+    """Copy only the parts of a document selected by a combined projection spec.
+
+    Fields in operator_fields are not copied: they are left to the projection operators,
+    only keeping their position in excluding mode. If tz_aware is set, datetimes are made
+    timezone aware while being copied.
+    """
+    doc_copy = container()
+
+    if is_include:
+        for key, spec in iteritems(combined_projection_spec):
+            if key not in doc:
+                continue
+            value = doc[key]
+            if not isinstance(spec, dict):
+                doc_copy[key] = _copy_field(value, container, tz_aware)
+            elif isinstance(value, (list, tuple)):
+                doc_copy[key] = _copy_array_by_spec(value, spec, is_include, container, tz_aware)
+            elif isinstance(value, dict):
+                doc_copy[key] = _copy_by_spec(value, spec, is_include, container, tz_aware)
+        return doc_copy
 
+    for key, value in iteritems(doc):
+        if key in operator_fields:
+            doc_copy[key] = None
+            continue
+        spec = combined_projection_spec.get(key, NOTHING)
+        if spec is NOTHING:
+            doc_copy[key] = _copy_field(value, container, tz_aware)
+        elif not isinstance(spec, dict):
+            continue
+        elif isinstance(value, (list, tuple)):
+            doc_copy[key] = _copy_array_by_spec(value, spec, is_include, container, tz_aware)
+        elif isinstance(value, dict):
+            doc_copy[key] = _copy_by_spec(value, spec, is_include, container, tz_aware)
+        else:
+            doc_copy[key] = _copy_field(value, container, tz_aware)
     return doc_copy
 
 
+def _copy_array_by_spec(array, combined_projection_spec, is_include, container, tz_aware=False):
+    """Project each item of an array, dropping the non-documents in including mode."""
+    array_copy = []
+    for item in array:
+        if isinstance(item, dict):
+            array_copy.append(_copy_by_spec(
+                item, combined_projection_spec, is_include, container, tz_aware))
+        elif isinstance(item, (list, tuple)):
+            array_copy.append(_copy_array_by_spec(
+                item, combined_projection_spec, is_include, container, tz_aware))
+        elif not is_include:
+            array_copy.append(_copy_field(item, container, tz_aware))
+    return array_copy
+
+
+def _compile_projection_operator(operator_spec):
+    """Compile projection operators into a function applying them to a field value.
+
+    The function returns the projected value, without copying it, or NOTHING if the field
+    should be removed.
+    """
+    for op in operator_spec:
+        if op not in ('$elemMatch', '$slice'):
+            raise ValueError('Unsupported projection option: {}'.format(op))
+    matches_elem = None
+    if '$elemMatch' in operator_spec:
+        matches_elem = compile_filter(operator_spec['$elemMatch'])
+
+    def _apply_projection_operator(value):
+        if '$slice' in operator_spec:
+            # slice the original array so that only the kept items get copied
+            value = _slice_projected_array(value, operator_spec)
+
+        if matches_elem is not None:
+            if not isinstance(value, list):
+                # remove the field since there is nothing to iterate
+                return NOTHING
+            # find the first item that matches
+            for item in value:
+                if matches_elem(item):
+                    return [item]
+            # nothing have matched
+            return NOTHING
+
+        return value
+
+    return _apply_projection_operator
+
+
+def _slice_projected_array(value, op):
+    if not isinstance(value, list):
+        raise OperationFailure(
+            'Unsupported type {} for slicing operation: {}'.format(type(value), op))
+    op_value = op['$slice']
+    if isinstance(op_value, list):
+        if len(op_value) != 2:
+            raise OperationFailure(
+                'Unsupported slice format {} for slicing operation: {}'.format(op_value, op))
+        skip, limit = op_value
+        if skip < 0:
+            skip = len(value) + skip
+        last = min(skip + limit, len(value))
+        return value[skip:last]
+    if isinstance(op_value, int):
+        count = op_value
+        start = 0
+        end = len(value)
+        if count < 0:
+            start = max(0, len(value) + count)
+        else:
+            end = min(count, len(value))
+        return value[start:end]
+    raise OperationFailure(
+        'Unsupported slice value {} for slicing operation: {}'.format(op_value, op))
+
+
 class BulkOperationBuilder(object):
     def __init__(self, collection, ordered=False, bypass_document_validation=False):
         self.collection = collection
@@ -436,9 +554,14 @@ class Collection(object):
         warnings.warn('insert is deprecated. Use insert_one or insert_many '
                       'instead.', DeprecationWarning, stacklevel=2)
         validate_write_concern_params(**kwargs)
+        if isinstance(data, Mapping):
+            data = _copy_read_only_view(data)
+        else:
+            data = [_copy_read_only_view(document) for document in data]
         return self._insert(data)
 
     def insert_one(self, document, bypass_document_validation=False, session=None):
+        document = _copy_read_only_view(document)
         if not bypass_document_validation:
             validate_is_mutable_mapping('document', document)
         return InsertOneResult(self._insert(document, session), acknowledged=True)
@@ -446,7 +569,7 @@ class Collection(object):
     def insert_many(self, documents, ordered=True, bypass_document_validation=False, session=None):
         if not isinstance(documents, Iterable) or not documents:
             raise TypeError('documents must be a non-empty list')
-        documents = list(documents)
+        documents = [_copy_read_only_view(document) for document in documents]
         if not bypass_document_validation:
             for document in documents:
                 validate_is_mutable_mapping('document', document)
@@ -507,34 +630,10 @@ class Collection(object):
 
         data = helpers.patch_datetime_awareness_in_document(data)
 
+        # The store makes sure that the unique indexes are respected.
         self._store[object_id] = data
-        try:
-            self._ensure_uniques(data)
-        except DuplicateKeyError:
-            # Rollback
-            del self._store[object_id]
-            raise
         return data['_id']
 
-    def _ensure_uniques(self, new_data):
-        # Note we consider new_data is already inserted in db
-        for index in self._store.indexes.values():
-            if not index.get('unique'):
-                continue
-            unique = index.get('key')
-            is_sparse = index.get('sparse')
-            find_kwargs = {}
-            for key, _ in unique:
-                try:
-                    find_kwargs[key] = helpers.get_value_by_dot(new_data, key)
-                except KeyError:
-                    find_kwargs[key] = None
-            if is_sparse and set(find_kwargs.values()) == {None}:
-                continue
-            answer_count = len(list(self._iter_documents(find_kwargs)))
-            if answer_count > 1:
-                raise DuplicateKeyError('E11000 Duplicate Key Error', 11000)
-
     def _internalize_dict(self, d):
         return {k: copy.deepcopy(v) for k, v in iteritems(d)}
 
@@ -598,7 +697,8 @@ class Collection(object):
                 'collation',
                 'The collation argument of update is valid but has not been implemented in '
                 'mongomock yet')
-        spec = helpers.patch_datetime_awareness_in_document(spec)
+        spec = helpers.patch_datetime_awareness_in_spec(spec)
+        # The update document is copied as its values end up in the stored documents.
         document = helpers.patch_datetime_awareness_in_document(document)
         validate_is_mapping('spec', spec)
         validate_is_mapping('document', document)
@@ -743,9 +843,13 @@ class Collection(object):
 
                             arr_copy = copy.deepcopy(arr)
                             if isinstance(value, dict):
+                                try:
+                                    matches_value = compile_filter(value)
+                                except OperationFailure:
+                                    matches_value = None
                                 for obj in arr_copy:
                                     try:
-                                        is_matching = filter_applies(value, obj)
+                                        is_matching = matches_value and matches_value(obj)
                                     except OperationFailure:
                                         is_matching = False
                                     if is_matching:
@@ -873,14 +977,18 @@ class Collection(object):
                         "After applying the update, the (immutable) field '_id' was found to have "
                         'been altered to _id: {}'.format(existing_document.get('_id')))
 
-                # Make sure it still respect the unique indexes and, if not, to
-                # revert modifications
+                # Update the indexes of the store with the in-place modifications: this
+                # makes sure it still respects the unique indexes and, if not, we revert
+                # modifications.
+                object_id = existing_document['_id']
+                if isinstance(object_id, dict):
+                    object_id = helpers.hashdict(object_id)
                 try:
-                    self._ensure_uniques(existing_document)
+                    self._store[object_id] = existing_document
                     num_updated += 1
                 except DuplicateKeyError:
                     # Rollback.
-                    self._store[original_document_snapshot['_id']] = original_document_snapshot
+                    self._store[object_id] = original_document_snapshot
                     raise
 
             if not multi:
@@ -1004,168 +1112,148 @@ class Collection(object):
             if value:
                 raise OperationFailure("Unrecognized field '%s'" % kwarg)
         return Cursor(self, spec, sort, projection, skip, limit,
-                      collation=collation).max_time_ms(max_time_ms)
+                      collation=collation, batch_size=batch_size,
+                      copy_on_read=self.database.client.copy_on_read).max_time_ms(max_time_ms)
 
-    def _get_dataset(self, spec, sort, fields, as_class):
-        dataset = self._iter_documents(spec)
+    def _find_copies(self, filter=None, projection=None, sort=None):
+        """Find documents as mutable copies, even if the client does not copy on read."""
+        return Cursor(self, {} if filter is None else filter, sort, projection)
+
+    def _iter_stored_copies(self, filter=None, sort=None, skip=0, limit=None, projection=None,
+                            execution_stats=None):
+        """Iterate over copies of the matching documents, in the form they are stored in.
+
+        Unlike find, datetimes are never made timezone aware, so that the copies can be
+        processed and matched as stored documents, e.g. in aggregation pipelines.
+        """
+        spec = helpers.patch_datetime_awareness_in_spec({} if filter is None else filter)
+        return self._get_dataset(
+            spec, sort, projection, dict, execution_stats, skip=skip, limit=limit,
+            tz_aware=False)
+
+    def _get_dataset(self, spec, sort, fields, as_class, execution_stats=None, skip=0,
+                     limit=None, read_only=False, tz_aware=None):
+        """Iterate over copies of the matching documents, after skip and up to limit.
+
+        Skipped documents and the ones after the limit are never copied nor projected. If
+        read_only is set, read-only views of the documents are returned instead of copies.
+        Datetimes are made timezone aware as configured in the codec options, unless tz_aware
+        is given.
+        """
+        if tz_aware is None:
+            tz_aware = self.codec_options.tz_aware
+        # Skip the conversion altogether if no datetime was ever stored in the collection.
+        tz_aware = tz_aware and self._store.may_contain_datetimes
+        if read_only:
+            project = self._compile_read_only_projection(fields, as_class, tz_aware)
+        else:
+            project = self._compile_projection(fields, as_class, tz_aware)
+        dataset = self._iter_documents(spec, execution_stats)
         if sort:
-            for sort_key, sort_direction in reversed(sort):
+            fields_sort = []
+            for sort_key, sort_direction in sort:
                 if sort_key == '$natural':
                     if sort_direction < 0:
-                        dataset = iter(reversed(list(dataset)))
+                        dataset = reversed(list(dataset))
                     continue
                 if sort_key.startswith('$'):
                     raise NotImplementedError(
                         'Sorting by {} is not implemented in mongomock yet'.format(sort_key))
-                dataset = iter(sorted(
-                    dataset, key=lambda x: resolve_sort_key(sort_key, x),
-                    reverse=sort_direction < 0))
+                fields_sort.append((sort_key, sort_direction))
+            if fields_sort:
+                dataset = sort_documents(
+                    dataset, fields_sort, None if limit is None else skip + limit)
+        if skip or limit is not None:
+            dataset = itertools.islice(dataset, skip, None if limit is None else skip + limit)
         for document in dataset:
-            yield self._copy_only_fields(document, fields, as_class)
-
-    def _copy_field(self, obj, container):
-        if isinstance(obj, list):
-            new = []
-            for item in obj:
-                new.append(self._copy_field(item, container))
-            return new
-        if isinstance(obj, dict):
-            new = container()
-            for key, value in obj.items():
-                new[key] = self._copy_field(value, container)
-            return new
-        return copy.copy(obj)
-
-    def _extract_projection_operators(self, fields):
-        """Removes and returns fields with projection operators."""
-        result = {}
-        allowed_projection_operators = {'$elemMatch', '$slice'}
-        for key, value in iteritems(fields):
-            if isinstance(value, dict):
-                for op in value:
-                    if op not in allowed_projection_operators:
-                        raise ValueError('Unsupported projection option: {}'.format(op))
-                result[key] = value
-
-        for key in result:
-            del fields[key]
-
-        return result
-
-    def _apply_projection_operators(self, ops, doc, doc_copy):
-        """Applies projection operators to copied document."""
-        for field, op in iteritems(ops):
-            if field not in doc_copy:
-                if field in doc:
-                    # field was not copied yet (since we are in include mode)
-                    doc_copy[field] = doc[field]
-                else:
-                    # field doesn't exist in original document, no work to do
-                    continue
-
-            if '$slice' in op:
-                if not isinstance(doc_copy[field], list):
-                    raise OperationFailure(
-                        'Unsupported type {} for slicing operation: {}'.format(
-                            type(doc_copy[field]), op))
-                op_value = op['$slice']
-                slice_ = None
-                if isinstance(op_value, list):
-                    if len(op_value) != 2:
-                        raise OperationFailure(
-                            'Unsupported slice format {} for slicing operation: {}'.format(
-                                op_value, op))
-                    skip, limit = op_value
-                    if skip < 0:
-                        skip = len(doc_copy[field]) + skip
-                    last = min(skip + limit, len(doc_copy[field]))
-                    slice_ = slice(skip, last)
-                elif isinstance(op_value, int):
-                    count = op_value
-                    start = 0
-                    end = len(doc_copy[field])
-                    if count < 0:
-                        start = max(0, len(doc_copy[field]) + count)
-                    else:
-                        end = min(count, len(doc_copy[field]))
-                    slice_ = slice(start, end)
+            yield project(document)
 
-                if slice_:
-                    doc_copy[field] = doc_copy[field][slice_]
-                else:
-                    raise OperationFailure(
-                        'Unsupported slice value {} for slicing operation: {}'.format(
-                            op_value, op))
-
-            if '$elemMatch' in op:
-                if isinstance(doc_copy[field], list):
-                    # find the first item that matches
-                    matched = False
-                    for item in doc_copy[field]:
-                        if filter_applies(op['$elemMatch'], item):
-                            matched = True
-                            doc_copy[field] = [item]
-                            break
-
-                    # nothing have matched
-                    if not matched:
-                        del doc_copy[field]
+    def _compile_read_only_projection(self, fields, container, tz_aware=False):
+        """Compile a projection into a function returning read-only views of documents.
 
-                else:
-                    # remove the field since there is nothing to iterate
-                    del doc_copy[field]
+        Whole documents are not copied at all, projected ones are copied once then wrapped.
+        """
+        if fields is None:
+            return lambda doc: helpers.ReadOnlyDict(doc, tz_aware)
+        project = self._compile_projection(fields, container)
+        return lambda doc: helpers.ReadOnlyDict(project(doc), tz_aware)
 
-    def _copy_only_fields(self, doc, fields, container):
-        """Copy only the specified fields."""
+    def _compile_projection(self, fields, container, tz_aware=False):
+        """Compile a projection into a function copying the projected parts of a document.
 
+        The projection is validated and parsed once, without modifying it, so that the
+        returned function can be applied to all the documents of a query. If tz_aware is set,
+        datetimes are made timezone aware in the same pass.
+        """
         if fields is None:
-            return self._copy_field(doc, container)
+            return functools.partial(_copy_field, container=container, tz_aware=tz_aware)
 
         if not fields:
             fields = {'_id': 1}
         if not isinstance(fields, dict):
             fields = helpers.fields_list_to_dict(fields)
 
-        # we can pass in something like {'_id':0, 'field':1}, so pull the id
-        # value out and hang on to it until later
-        id_value = fields.pop('_id', 1)
+        # we can pass in something like {'_id':0, 'field':1}, so handle the id
+        # value separately
+        id_value = fields.get('_id', 1)
 
-        # filter out fields with projection operators, we will take care of them later
-        projection_operators = self._extract_projection_operators(fields)
+        # fields with projection operators are handled once the other fields are copied
+        fields_spec = OrderedDict()
+        projection_operators = OrderedDict()
+        for key, value in iteritems(fields):
+            if key == '_id':
+                continue
+            if isinstance(value, dict):
+                projection_operators[key] = _compile_projection_operator(value)
+            else:
+                fields_spec[key] = value
 
         # other than the _id field, all fields must be either includes or
         # excludes, this can evaluate to 0
-        if len(set(list(fields.values()))) > 1:
+        if len(set(list(fields_spec.values()))) > 1:
             raise ValueError(
                 'You cannot currently mix including and excluding fields.')
 
-        # if we have novalues passed in, make a doc_copy based on the
-        # id_value
-        if not fields:
+        # if we have no values passed in, make a doc_copy based on the id_value
+        if not fields_spec:
             if id_value == 1:
-                doc_copy = container()
+                def _copy_projected_fields(unused_doc):
+                    return container()
             else:
-                doc_copy = self._copy_field(doc, container)
+                def _copy_projected_fields(doc):
+                    return _copy_by_spec(
+                        doc, {}, False, container, tz_aware, operator_fields=projection_operators)
         else:
-            doc_copy = _project_by_spec(
-                doc, _combine_projection_spec(fields),
-                is_include=list(fields.values())[0],
-                container=container)
-
-        # set the _id value if we requested it, otherwise remove it
-        if id_value == 0:
-            doc_copy.pop('_id', None)
-        else:
-            if '_id' in doc:
-                doc_copy['_id'] = doc['_id']
-
-        fields['_id'] = id_value  # put _id back in fields
+            combined_spec = _combine_projection_spec(fields_spec)
+            is_include = list(fields_spec.values())[0]
+            _check_no_positional_projection(combined_spec, is_include)
+
+            def _copy_projected_fields(doc):
+                return _copy_by_spec(
+                    doc, combined_spec, is_include, container, tz_aware,
+                    operator_fields=projection_operators)
+
+        def _project(doc):
+            doc_copy = _copy_projected_fields(doc)
+
+            # set the _id value if we requested it, otherwise remove it
+            if id_value == 0:
+                doc_copy.pop('_id', None)
+            elif '_id' in doc:
+                doc_copy['_id'] = _copy_field(doc['_id'], container, tz_aware)
+
+            for field, apply_operator in iteritems(projection_operators):
+                if field not in doc:
+                    # field doesn't exist in original document, no work to do
+                    continue
+                value = apply_operator(doc[field])
+                if value is NOTHING:
+                    doc_copy.pop(field, None)
+                else:
+                    doc_copy[field] = _copy_field(value, container, tz_aware)
+            return doc_copy
 
-        # time to apply the projection operators and put back their fields
-        self._apply_projection_operators(projection_operators, doc, doc_copy)
-        for field, op in iteritems(projection_operators):
-            fields[field] = op
-        return doc_copy
+        return _project
 
     def _update_document_fields(self, doc, fields, updater):
         """Implements the $set behavior on an existing document"""
@@ -1250,13 +1338,43 @@ class Collection(object):
         field_name = field_name_parts[-1]
         updater(doc, field_name, field_value)
 
-    def _iter_documents(self, filter):
+    def _plan_query(self, filter):
+        """Plan how to find the documents matching a filter.
+
+        Returns the query plan and a function to check the documents it finds, or None if they
+        all match the filter.
+        """
+        matches_filter = compile_filter(filter)
         # Validate the filter even if no documents can be returned.
         if self._store.is_empty:
-            filter_applies(filter, {})
+            matches_filter({})
+
+        query_plan = planner.plan_query(self._store, filter)
+        if query_plan.residual_filter is not filter:
+            matches_filter = None
+            if query_plan.residual_filter:
+                matches_filter = compile_filter(query_plan.residual_filter)
+        return query_plan, matches_filter
+
+    def _has_index_on(self, field):
+        """Whether queries on a field can use an index, as it starts the keys of the index."""
+        return field == '_id' or any(
+            index_store.fields[0] == field for unused_name, index_store
+            in self._store.get_index_stores())
+
+    def _iter_documents(self, filter, execution_stats=None):
+        query_plan, matches_filter = self._plan_query(filter)
+        if query_plan.candidate_ids is None:
+            documents = self._store.documents
+        else:
+            documents = self._store.get_documents_by_ids(query_plan.candidate_ids)
 
-        return (document for document in list(self._store.documents)
-                if filter_applies(filter, document))
+        if execution_stats is not None:
+            execution_stats.query_plan = query_plan
+            return execution_stats.filter_documents(documents, matches_filter)
+        if matches_filter is None:
+            return iter(documents)
+        return (document for document in documents if matches_filter(document))
 
     def find_one(self, filter=None, *args, **kwargs):  # pylint: disable=keyword-arg-before-vararg
         # Allow calling find_one with a non-dict argument that gets used as
@@ -1318,7 +1436,7 @@ class Collection(object):
         if remove and update:
             raise ValueError("Can't do both update and remove")
 
-        old = self.find_one(query, projection=projection, sort=sort)
+        old = next(self._find_copies(query, projection, sort), None)
         if not old and not upsert:
             return
 
@@ -1369,21 +1487,22 @@ class Collection(object):
                 'implemented in mongomock yet')
         if session:
             raise_not_implemented('session', 'Mongomock does not handle sessions yet')
-        filter = helpers.patch_datetime_awareness_in_document(filter)
+        filter = helpers.patch_datetime_awareness_in_spec(filter)
         if filter is None:
             filter = {}
         if not isinstance(filter, Mapping):
             filter = {'_id': filter}
-        to_delete = list(self.find(filter))
+        # Read the stored documents directly: find may return read-only views.
+        matches = self._iter_documents(filter)
+        if not multi:
+            matches = itertools.islice(matches, 1)
+        to_delete = [doc['_id'] for doc in matches]
         deleted_count = 0
-        for doc in to_delete:
-            doc_id = doc['_id']
+        for doc_id in to_delete:
             if isinstance(doc_id, dict):
                 doc_id = helpers.hashdict(doc_id)
             del self._store[doc_id]
             deleted_count += 1
-            if not multi:
-                break
 
         return {
             'connectionId': self.database.client._id,
@@ -1409,8 +1528,8 @@ class Collection(object):
             raise_not_implemented('session', 'Mongomock does not handle sessions yet')
         if filter is None:
             return len(self._store)
-        spec = helpers.patch_datetime_awareness_in_document(filter)
-        return len(list(self._iter_documents(spec)))
+        spec = helpers.patch_datetime_awareness_in_spec(filter)
+        return self._count_documents(spec)
 
     def count_documents(self, filter, **kwargs):
         if kwargs.pop('collation', None):
@@ -1434,11 +1553,30 @@ class Collection(object):
         if unknown_kwargs:
             raise OperationFailure("unrecognized field '%s'" % unknown_kwargs.pop())
 
-        spec = helpers.patch_datetime_awareness_in_document(filter)
-        doc_num = len(list(self._iter_documents(spec)))
+        spec = helpers.patch_datetime_awareness_in_spec(filter)
+        doc_num = self._count_documents(spec, limit=None if limit is None else skip + limit)
         count = max(doc_num - skip, 0)
         return count if limit is None else min(count, limit)
 
+    def _count_documents(self, filter, limit=None):
+        """Count the documents matching a filter, up to limit, without copying them."""
+        if not filter:
+            count = len(self._store)
+        else:
+            query_plan, matches_filter = self._plan_query(filter)
+            if query_plan.candidate_ids is not None and matches_filter is None:
+                # The index alone gives the matching documents.
+                count = self._store.count_documents_by_ids(query_plan.candidate_ids)
+            else:
+                if query_plan.candidate_ids is None:
+                    documents = self._store.documents
+                else:
+                    documents = self._store.get_documents_by_ids(query_plan.candidate_ids)
+                if matches_filter is not None:
+                    documents = (document for document in documents if matches_filter(document))
+                return sum(1 for unused_document in itertools.islice(documents, limit))
+        return count if limit is None else min(count, limit)
+
     def estimated_document_count(self, **kwargs):
         if kwargs.pop('session', None):
             raise ConfigurationError('estimated_document_count does not support sessions')
@@ -1477,32 +1615,7 @@ class Collection(object):
             raise OperationFailure(
                 'Index with name: %s already exists with different options' % index_name)
 
-        # Check that documents already verify the uniquess of this new index.
-        if is_unique:
-            indexed = set()
-            indexed_list = []
-            for doc in self._store.documents:
-                index = []
-                for key, unused_order in index_list:
-                    try:
-                        index.append(helpers.get_value_by_dot(doc, key))
-                    except KeyError:
-                        if is_sparse:
-                            continue
-                        index.append(None)
-                if is_sparse and not index:
-                    continue
-                index = tuple(index)
-                try:
-                    if index in indexed:
-                        raise DuplicateKeyError('E11000 Duplicate Key Error', 11000)
-                    indexed.add(index)
-                except TypeError as err:
-                    # index is not hashable.
-                    if index in indexed_list:
-                        raise_from(DuplicateKeyError('E11000 Duplicate Key Error', 11000), err)
-                    indexed_list.append(index)
-
+        # This also checks that documents already verify the uniqueness of this new index.
         self._store.create_index(index_name, index_dict)
 
         return index_name
@@ -1539,7 +1652,7 @@ class Collection(object):
     def drop_indexes(self, session=None):
         if session:
             raise_not_implemented('session', 'Mongomock does not handle sessions yet')
-        self._store.indexes = {}
+        self._store.drop_indexes()
 
     def reindex(self, session=None):
         if session:
@@ -1630,7 +1743,7 @@ class Collection(object):
             }
         ''')
         doc_list = [json.dumps(doc, default=json_util.default)
-                    for doc in self.find(query)]
+                    for doc in self._find_copies(query)]
         mapped_rows = map_ctx.call('doMap', map_func, doc_list)
         reduced_rows = reduce_ctx.call('doReduce', reduce_func, mapped_rows)[:limit]
         for reduced_row in reduced_rows:
@@ -1703,7 +1816,7 @@ class Collection(object):
         doc_list_copy = []
         ret_array_copy = []
         reduced_val = {}
-        doc_list = [doc for doc in self.find(condition)]
+        doc_list = [doc for doc in self._find_copies(condition)]
         for doc in doc_list:
             doc_copy = copy.deepcopy(doc)
             for doc_key in doc:
@@ -1738,9 +1851,62 @@ class Collection(object):
         ret_array = ret_array_copy
         return ret_array
 
-    def aggregate(self, pipeline, session=None, **unused_kwargs):
-        in_collection = [doc for doc in self.find()]
-        return aggregate.process_pipeline(in_collection, self.database, pipeline, session)
+    def aggregate(self, pipeline, session=None, explain=False, **unused_kwargs):
+        if explain:
+            return self._explain_aggregate(pipeline, session, explain)
+        # The documents are read lazily: streaming stages only copy the documents they need.
+        query, pipeline = aggregate.split_initial_query(pipeline)
+        in_collection = self._iter_stored_copies(**query)
+        results = aggregate.process_pipeline(in_collection, self.database, pipeline, session)
+        if self.codec_options.tz_aware:
+            return CommandCursor(
+                helpers.make_datetime_timezone_aware_in_document(doc) for doc in results)
+        return results
+
+    def _explain_aggregate(self, pipeline, session, verbosity):
+        if verbosity is True:
+            verbosity = 'queryPlanner'
+        if verbosity not in _EXPLAIN_VERBOSITIES:
+            raise OperationFailure(
+                'verbosity string must be one of {}'.format(', '.join(_EXPLAIN_VERBOSITIES)))
+
+        query, pipeline = aggregate.split_initial_query(pipeline)
+        execution_stats = planner.ExecutionStats()
+        start_time = _get_perf_counter()
+        documents = list(self._iter_stored_copies(execution_stats=execution_stats, **query))
+        execution_time_millis = int(round((_get_perf_counter() - start_time) * 1000))
+        spec = helpers.patch_datetime_awareness_in_spec(query.get('filter', {}))
+        cursor_explain = planner.explain_query(
+            self.full_name, spec, execution_stats, len(documents), execution_time_millis,
+            sort=query.get('sort'), skip=query.get('skip', 0), limit=query.get('limit'),
+            projection=query.get('projection'))
+        cursor_stage = {'query': query.get('filter', {})}
+        if 'sort' in query:
+            cursor_stage['sort'] = collections.OrderedDict(query['sort'])
+        for key in ('skip', 'limit'):
+            if key in query:
+                cursor_stage[key] = query[key]
+        if 'projection' in query:
+            cursor_stage['fields'] = query['projection']
+        cursor_stage['queryPlanner'] = cursor_explain['queryPlanner']
+        if verbosity == 'queryPlanner':
+            return {
+                'stages': [{'$cursor': cursor_stage}] + [dict(stage) for stage in pipeline],
+                'ok': 1.0,
+            }
+
+        cursor_stage['executionStats'] = cursor_explain['executionStats']
+        stages = [{'$cursor': cursor_stage}]
+        for stage in pipeline:
+            stage_explain = dict(stage)
+            start_time = _get_perf_counter()
+            documents = list(aggregate.process_pipeline(
+                documents, self.database, [stage], session))
+            stage_explain['nReturned'] = len(documents)
+            stage_explain['executionTimeMillisEstimate'] = \
+                int(round((_get_perf_counter() - start_time) * 1000))
+            stages.append(stage_explain)
+        return {'stages': stages, 'ok': 1.0}
 
     def with_options(
             self, codec_options=None, read_preference=None, write_concern=None, read_concern=None):
@@ -1804,58 +1970,91 @@ class Collection(object):
 class Cursor(object):
 
     def __init__(self, collection, spec=None, sort=None, projection=None, skip=0, limit=0,
-                 collation=None, no_cursor_timeout=False, batch_size=0, session=None):
+                 collation=None, no_cursor_timeout=False, batch_size=0, session=None,
+                 copy_on_read=True):
         super(Cursor, self).__init__()
         self.collection = collection
-        spec = helpers.patch_datetime_awareness_in_document(spec)
+        spec = helpers.patch_datetime_awareness_in_spec(spec)
         self._spec = spec
         self._sort = sort
         self._projection = projection
         self._skip = skip
         self._factory_last_generated_results = None
         self._results = None
+        self._dataset = None
+        self._dataset_skip = 0
+        self._dataset_limit = None
         self._factory = functools.partial(
             collection._get_dataset, spec, sort, projection, dict)
         # pymongo limit defaults to 0, returning everything
         self._limit = limit if limit != 0 else None
+        self._batch_size = 0
+        self.batch_size(batch_size)
         self._collation = collation
+        self._copy_on_read = copy_on_read
         self.session = session
         self.rewind()
 
-    def _compute_results(self, with_limit_and_skip=False):
-        # Recompute the result only if the query has changed
-        if not self._results or self._factory_last_generated_results != self._factory:
-            if self.collection.codec_options.tz_aware:
-                results = [helpers.make_datetime_timezone_aware_in_document(x)
-                           for x in self._factory()]
-            else:
-                results = list(self._factory())
+    def _fetch_results(self, num_results=None):
+        """Fetch results, after the skipped documents, until num_results are buffered.
+
+        Results are copied in batches of batch_size documents, and batches are cut short so
+        that no document past the limit gets copied. All the results are fetched if
+        num_results is None.
+        """
+        limit = self._get_results_limit()
+        # Restart from the beginning only if the query or skip has changed, or if the dataset
+        # was generated for a smaller limit than the one now needed.
+        if self._results is None or self._factory_last_generated_results is not self._factory \
+                or self._dataset_skip != self._skip or self._dataset_limit is not None and \
+                (num_results is None or num_results > self._dataset_limit):
+            self._results = []
+            self._dataset_skip = self._skip
+            self._dataset_limit = limit if num_results is not None else None
+            self._dataset = self._factory(
+                skip=self._skip, limit=self._dataset_limit, read_only=not self._copy_on_read)
             self._factory_last_generated_results = self._factory
-            self._results = results
-        if with_limit_and_skip:
-            results = self._results[self._skip:]
-            if self._limit:
-                results = results[:self._limit]
-        else:
-            results = self._results
+        results = self._results
+        while self._dataset is not None and (num_results is None or len(results) < num_results):
+            batch_size = self._batch_size or _DEFAULT_BATCH_SIZE
+            if limit is not None and len(results) < limit:
+                batch_size = min(batch_size, limit - len(results))
+            batch = list(itertools.islice(self._dataset, batch_size))
+            results.extend(batch)
+            if len(batch) < batch_size:
+                self._dataset = None
         return results
 
+    def _get_results_limit(self):
+        if not self._limit:
+            return None
+        return abs(self._limit)
+
+    def _compute_results(self):
+        """Compute copies of all the results, ignoring skip and limit."""
+        return list(self._factory())
+
     def __iter__(self):
         return self
 
     def clone(self):
         cursor = Cursor(self.collection,
-                        self._spec, self._sort, self._projection, self._skip, self._limit)
+                        self._spec, self._sort, self._projection, self._skip, self._limit,
+                        batch_size=self._batch_size, copy_on_read=self._copy_on_read)
         cursor._factory = self._factory
         return cursor
 
+    def _has_result(self, index):
+        if self._limit and index >= abs(self._limit):
+            return False
+        return len(self._fetch_results(index + 1)) > index
+
     def __next__(self):
-        try:
-            doc = self._compute_results(with_limit_and_skip=True)[self._emitted]
-            self._emitted += 1
-            return doc
-        except IndexError as err:
-            raise_from(StopIteration(), err)
+        if not self._has_result(self._emitted):
+            raise StopIteration()
+        doc = self._results[self._emitted]
+        self._emitted += 1
+        return doc
 
     next = __next__
 
@@ -1875,8 +2074,12 @@ class Cursor(object):
         warnings.warn(
             'count is deprecated. Use Collection.count_documents instead.',
             DeprecationWarning, stacklevel=2)
-        results = self._compute_results(with_limit_and_skip)
-        return len(results)
+        if not with_limit_and_skip:
+            return self.collection._count_documents(self._spec)
+        limit = self._get_results_limit()
+        count = self.collection._count_documents(
+            self._spec, limit=None if limit is None else self._skip + limit)
+        return max(count - self._skip, 0)
 
     def skip(self, count):
         self._skip = count
@@ -1887,6 +2090,11 @@ class Cursor(object):
         return self
 
     def batch_size(self, count):
+        if not isinstance(count, integer_types):
+            raise TypeError('batch_size must be an integer')
+        if count < 0:
+            raise ValueError('batch_size must be >= 0')
+        self._batch_size = count
         return self
 
     def close(self):
@@ -1950,7 +2158,9 @@ class Cursor(object):
             raise TypeError("index '%s' cannot be applied to Cursor instances" % index)
         if index < 0:
             raise IndexError('Cursor instances do not support negativeindices')
-        return self._compute_results(with_limit_and_skip=True)[index]
+        if not self._has_result(index):
+            raise IndexError('no such item for Cursor instance')
+        return self._results[index]
 
     def __enter__(self):
         return self
@@ -1960,7 +2170,20 @@ class Cursor(object):
 
     @property
     def alive(self):
-        return self._emitted != self.count()
+        return self._has_result(self._emitted)
+
+    def explain(self):
+        """Run the query and describe how it was run, as MongoDB's explain command."""
+        execution_stats = planner.ExecutionStats()
+        start_time = _get_perf_counter()
+        results = list(self.collection._get_dataset(
+            self._spec, self._sort, self._projection, dict, execution_stats,
+            skip=self._skip, limit=self._get_results_limit()))
+        execution_time_millis = int(round((_get_perf_counter() - start_time) * 1000))
+        return planner.explain_query(
+            self.collection.full_name, self._spec, execution_stats, len(results),
+            execution_time_millis, sort=self._sort, skip=self._skip, limit=self._limit,
+            projection=self._projection)
 
     def max_time_ms(self, max_time_ms):
         if max_time_ms is not None and not isinstance(max_time_ms, int):
@@ -1969,6 +2192,13 @@ class Cursor(object):
         return self
 
 
+def _copy_read_only_view(document):
+    """Get a mutable copy of a document read without copy_on_read, to insert it."""
+    if isinstance(document, helpers.ReadOnlyDict):
+        return document.copy()
+    return document
+
+
 def _set_updater(doc, field_name, value):
     if isinstance(value, (tuple, list)):
         value = copy.deepcopy(value)
@@ -2055,7 +2285,7 @@ def _current_date_updater(doc, field_name, value):
             # as it currently using time.time internally
             doc[field_name] = helpers.get_current_timestamp()
         else:
-            doc[field_name] = mongomock.utcnow()
+            doc[field_name] = helpers.patch_datetime_awareness_in_document(mongomock.utcnow())
 
 
 _updaters = {
@@ -1,9 +1,14 @@
+import itertools
 
 
 class CommandCursor(object):
 
     def __init__(self, collection, curser_info=None, address=None, retrieved=0):
-        self._collection = iter(collection)
+        collection = iter(collection)
+        # Fetch the first document right away, as a server runs the command until it gets
+        # the first batch: errors are raised when creating the cursor. The other documents
+        # are only pulled when iterating.
+        self._collection = itertools.chain(list(itertools.islice(collection, 1)), collection)
         self._id = None
         self._address = address
         self._data = {}
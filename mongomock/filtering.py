@@ -1,5 +1,9 @@
+import collections
+import copy
 from datetime import datetime
+import heapq
 import itertools
+import threading
 import uuid
 
 from .helpers import ObjectId, RE_TYPE
@@ -45,33 +49,110 @@ def filter_applies(search_filter, document):
     This function implements MongoDB's matching strategy over documents in the find() method
     and other related scenarios (like $elemMatch)
     """
-    return _filterer_inst.apply(search_filter, document)
+    return compile_filter(search_filter)(document)
+
+
+def compile_filter(search_filter):
+    """Compile a filter into a function that tells whether a document matches it.
+
+    The filter is validated once and turned into a tree of closures, so that it can be applied
+    to many documents without interpreting it again. Compiled filters are kept in a cache, so
+    compiling the same filter many times is cheap.
+    """
+    return _compiled_filters.get(search_filter)
+
+
+class _CompiledFiltersCache(object):
+    """A bounded LRU cache of compiled filters, keyed by the canonical form of the filters."""
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._compiled_filters = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, search_filter):
+        if not isinstance(search_filter, dict):
+            raise OperationFailure('the match filter must be an expression in an object')
+
+        try:
+            cache_key = _get_canonical_form(search_filter)
+            hash(cache_key)
+        except TypeError:
+            # Some values cannot be hashed, do not cache this filter.
+            return _filterer_inst.compile(search_filter)
+
+        with self._lock:
+            compiled_filter = self._compiled_filters.pop(cache_key, None)
+            if compiled_filter is not None:
+                self._compiled_filters[cache_key] = compiled_filter
+                return compiled_filter
+
+        # Compile a copy as the caller might modify the values of its filter later on.
+        compiled_filter = _filterer_inst.compile(copy.deepcopy(search_filter))
+        with self._lock:
+            self._compiled_filters[cache_key] = compiled_filter
+            while len(self._compiled_filters) > self._max_size:
+                self._compiled_filters.popitem(last=False)
+        return compiled_filter
+
+    def clear(self):
+        with self._lock:
+            self._compiled_filters.clear()
+
+
+def _get_canonical_form(value):
+    """Get a hashable value identifying a filter.
+
+    Types are kept so that e.g. 1 and True, which have the same hash in Python but not the
+    same meaning in a filter, are not mixed up.
+    """
+    if isinstance(value, dict):
+        return type(value), tuple((k, _get_canonical_form(v)) for k, v in iteritems(value))
+    if isinstance(value, (list, tuple)):
+        return type(value), tuple(_get_canonical_form(v) for v in value)
+    return type(value), value
+
+
+def _match_all(unused_document):
+    return True
+
+
+def _call_compiled_filter(compiled_filter, document):
+    return compiled_filter(document)
 
 
 class _Filterer(object):
-    """An object to help applying a filter, using the MongoDB query language."""
+    """An object to compile filters, using the MongoDB query language."""
 
     def __init__(self):
         self._operator_map = dict({
             '$eq': _list_expand(operator_eq),
             '$ne': _list_expand(lambda dv, sv: not operator_eq(dv, sv), negative=True),
-            '$all': self._all_op,
             '$in': _in_op,
             '$nin': lambda dv, sv: not _in_op(dv, sv),
             '$exists': lambda dv, sv: bool(sv) == (dv is not NOTHING),
             '$regex': _not_nothing_and(_regex),
-            '$elemMatch': self._elem_match_op,
             '$size': _size_op,
             '$type': _type_op
         }, **{
             key: _not_nothing_and(_list_expand(_compare_objects(op)))
             for key, op in iteritems(SORTING_OPERATOR_MAP)
         })
+        # Operators whose search value is compiled on its own.
+        self._operator_compilers = {
+            '$all': self._compile_all_op,
+            '$elemMatch': self._compile_elem_match_op,
+        }
+        self._operators = set(self._operator_map) | set(self._operator_compilers)
 
     def apply(self, search_filter, document):
+        return self.compile(search_filter)(document)
+
+    def compile(self, search_filter):
         if not isinstance(search_filter, dict):
             raise OperationFailure('the match filter must be an expression in an object')
 
+        matchers = []
         for key, search in iteritems(search_filter):
             # Top level operators.
             if key == '$comment':
@@ -79,8 +160,7 @@ class _Filterer(object):
             if key in LOGICAL_OPERATOR_MAP:
                 if not search:
                     raise OperationFailure('BadValue $and/$or/$nor must be a nonempty array')
-                if not LOGICAL_OPERATOR_MAP[key](document, search, self.apply):
-                    return False
+                matchers.append(self._compile_logical_op(key, search))
                 continue
             if key in _TOP_LEVEL_OPERATORS:
                 raise NotImplementedError(
@@ -88,58 +168,82 @@ class _Filterer(object):
             if key.startswith('$'):
                 raise OperationFailure('unknown top level operator: ' + key)
 
-            is_match = False
-
-            is_checking_negative_match = \
-                isinstance(search, dict) and {'$ne', '$nin'} & set(search.keys())
-            is_checking_positive_match = \
-                not isinstance(search, dict) or (set(search.keys()) - {'$ne', '$nin'})
-            has_candidates = False
+            matchers.append(self._compile_field(key, search))
 
-            if search == {'$exists': False} and not iter_key_candidates(key, document):
-                continue
+        if not matchers:
+            return _match_all
+        if len(matchers) == 1:
+            return matchers[0]
 
-            if isinstance(search, dict) and '$all' in search:
-                if not self._all_op(iter_key_candidates(key, document), search['$all']):
+        def _match(document):
+            for matcher in matchers:
+                if not matcher(document):
+                    return False
+            return True
+        return _match
+
+    def _compile_item_filter(self, query):
+        """Compile a query on the items of an array.
+
+        The query can either be a filter on subdocuments, e.g. {'a': {'$gt': 1}}, or directly
+        operators on the items, e.g. {'$gt': 1}.
+        """
+        try:
+            item_filter = self.compile(query)
+        except OperationFailure:
+            item_filter = None
+        # The query might be made of operators applying directly to the items: in this case
+        # it is used as a query on a wrapping field.
+        field_filter = []
+
+        def _match(item):
+            if item_filter is not None:
+                try:
+                    return item_filter(item)
+                except OperationFailure:
+                    pass
+            if not field_filter:
+                field_filter.append(compile_filter({'field': query}))
+            return field_filter[0]({'field': item})
+        return _match
+
+    def _compile_logical_op(self, key, search):
+        logical_op = LOGICAL_OPERATOR_MAP[key]
+        sub_filters = [self.compile(sub_filter) for sub_filter in search]
+        return lambda document: logical_op(document, sub_filters, _call_compiled_filter)
+
+    def _compile_field(self, key, search):
+        get_candidates = _compile_key_candidates(key)
+
+        is_checking_negative_match = \
+            isinstance(search, dict) and bool({'$ne', '$nin'} & set(search.keys()))
+        is_checking_positive_match = \
+            not isinstance(search, dict) or bool(set(search.keys()) - {'$ne', '$nin'})
+        is_exists_false = search == {'$exists': False}
+
+        check_all = None
+        is_only_all = False
+        if isinstance(search, dict) and '$all' in search:
+            check_all = self._compile_all_op(search['$all'])
+            # if there are no query operators then no need to check the values
+            is_only_all = len(search) == 1
+        match_value = None if is_only_all else self._compile_value_matcher(key, search)
+
+        def _match(document):
+            if is_exists_false and not get_candidates(document):
+                return True
+
+            if check_all:
+                if not check_all(get_candidates(document)):
                     return False
-                # if there are no query operators then continue
-                if len(search) == 1:
-                    continue
+                if is_only_all:
+                    return True
 
-            for doc_val in iter_key_candidates(key, document):
+            is_match = False
+            has_candidates = False
+            for doc_val in get_candidates(document):
                 has_candidates |= doc_val is not NOTHING
-                is_ops_filter = search and isinstance(search, dict) and \
-                    all(key.startswith('$') for key in search.keys())
-                if is_ops_filter:
-                    if '$options' in search and '$regex' in search:
-                        search = _combine_regex_options(search)
-                    unknown_operators = set(search) - set(self._operator_map) - {'$not'}
-                    if unknown_operators:
-                        not_implemented_operators = unknown_operators & _NOT_IMPLEMENTED_OPERATORS
-                        if not_implemented_operators:
-                            raise NotImplementedError(
-                                "'%s' is a valid operation but it is not supported by Mongomock "
-                                'yet.' % list(not_implemented_operators)[0])
-                        raise OperationFailure('unknown operator: ' + list(unknown_operators)[0])
-                    is_match = all(
-                        operator_string in self._operator_map and
-                        self._operator_map[operator_string](doc_val, search_val) or
-                        operator_string == '$not' and
-                        self._not_op(document, key, search_val)
-                        for operator_string, search_val in iteritems(search)
-                    ) and search
-                elif isinstance(search, _RE_TYPES) and isinstance(doc_val, (string_types, list)):
-                    is_match = _regex(doc_val, search)
-                elif key in LOGICAL_OPERATOR_MAP:
-                    if not search:
-                        raise OperationFailure('BadValue $and/$or/$nor must be a nonempty array')
-                    is_match = LOGICAL_OPERATOR_MAP[key](document, search, self.apply)
-                elif isinstance(doc_val, (list, tuple)):
-                    is_match = (search in doc_val or search == doc_val)
-                    if isinstance(search, ObjectId):
-                        is_match |= (str(search) in doc_val)
-                else:
-                    is_match = (doc_val == search) or (search is None and doc_val is NOTHING)
+                is_match = match_value(doc_val, document)
 
                 # When checking negative match, all the elements should match.
                 if is_checking_negative_match and not is_match:
@@ -151,45 +255,180 @@ class _Filterer(object):
 
             if not is_match and (has_candidates or is_checking_positive_match):
                 return False
-
-        return True
-
-    def _not_op(self, d, k, s):
+            return True
+        return _match
+
+    def _compile_value_matcher(self, key, search):
+        """Compile a function to check the candidate values of a field against the filter."""
+        is_ops_filter = search and isinstance(search, dict) and \
+            all(key.startswith('$') for key in search.keys())
+        if is_ops_filter:
+            if '$options' in search and '$regex' in search:
+                search = _combine_regex_options(search)
+            unknown_operators = set(search) - self._operators - {'$not'}
+            if unknown_operators:
+                not_implemented_operators = unknown_operators & _NOT_IMPLEMENTED_OPERATORS
+                if not_implemented_operators:
+                    raise NotImplementedError(
+                        "'%s' is a valid operation but it is not supported by Mongomock "
+                        'yet.' % list(not_implemented_operators)[0])
+                raise OperationFailure('unknown operator: ' + list(unknown_operators)[0])
+            op_matchers = [
+                self._compile_operator(key, operator_string, search_val)
+                for operator_string, search_val in iteritems(search)
+            ]
+
+            def _match_ops(doc_val, document):
+                for op_matcher in op_matchers:
+                    if not op_matcher(doc_val, document):
+                        return False
+                return True
+            return _match_ops
+
+        if isinstance(search, _RE_TYPES):
+            regex = _compile_regex(search)
+
+            def _match_regex(doc_val, unused_document):
+                if isinstance(doc_val, (string_types, list)):
+                    return _regex(doc_val, regex)
+                if isinstance(doc_val, tuple):
+                    return search in doc_val or search == doc_val
+                return doc_val == search
+            return _match_regex
+
+        is_object_id = isinstance(search, ObjectId)
+
+        def _match_value(doc_val, unused_document):
+            if isinstance(doc_val, (list, tuple)):
+                is_match = (search in doc_val or search == doc_val)
+                if is_object_id:
+                    is_match |= (str(search) in doc_val)
+                return is_match
+            return (doc_val == search) or (search is None and doc_val is NOTHING)
+        return _match_value
+
+    def _compile_operator(self, key, operator_string, search_val):
+        if operator_string == '$not':
+            negated_filter = self._compile_not_op(key, search_val)
+            return lambda unused_doc_val, document: not negated_filter(document)
+
+        if operator_string in self._operator_compilers:
+            op_matcher = self._operator_compilers[operator_string](search_val)
+            return lambda doc_val, unused_document: op_matcher(doc_val)
+
+        if operator_string == '$regex':
+            search_val = _compile_regex(search_val)
+        operator_func = self._operator_map[operator_string]
+        return lambda doc_val, unused_document: operator_func(doc_val, search_val)
+
+    def _compile_not_op(self, k, s):
         if isinstance(s, dict):
             for key in s.keys():
-                if key not in self._operator_map and key not in LOGICAL_OPERATOR_MAP:
+                if key not in self._operators and key not in LOGICAL_OPERATOR_MAP:
                     raise OperationFailure('unknown operator: %s' % key)
         elif isinstance(s, _RE_TYPES):
             pass
         else:
             raise OperationFailure('$not needs a regex or a document')
-        return not self.apply({k: s}, d)
+        return self.compile({k: s})
 
-    def _elem_match_op(self, doc_val, query):
-        if not isinstance(doc_val, list):
-            return False
+    def _compile_elem_match_op(self, query):
         if not isinstance(query, dict):
-            raise OperationFailure('$elemMatch needs an Object')
-        for item in doc_val:
-            try:
-                if self.apply(query, item):
-                    return True
-            except OperationFailure:
-                if self.apply({'field': query}, {'field': item}):
+            def _fail_on_list(doc_val):
+                if not isinstance(doc_val, list):
+                    return False
+                raise OperationFailure('$elemMatch needs an Object')
+            return _fail_on_list
+
+        item_filter = self._compile_item_filter(query)
+
+        def _elem_match(doc_val):
+            if not isinstance(doc_val, list):
+                return False
+            for item in doc_val:
+                if item_filter(item):
                     return True
-        return False
+            return False
+        return _elem_match
+
+    def _compile_all_op(self, search_val):
+        item_checks = [
+            (self._compile_elem_match_op(x['$elemMatch']), NOTHING)
+            if isinstance(x, dict) and '$elemMatch' in x else (None, x)
+            for x in search_val
+        ]
+
+        def _all(doc_val):
+            if isinstance(doc_val, list) and doc_val and isinstance(doc_val[0], list):
+                doc_val = list(itertools.chain.from_iterable(doc_val))
+            dv = _force_list(doc_val)
+            matches = [
+                elem_match(doc_val) if elem_match else x in dv
+                for elem_match, x in item_checks
+            ]
+            return all(matches)
+        return _all
+
+
+def _compile_key_candidates(key):
+    """Compile a function getting the candidates of a key, see iter_key_candidates."""
+    if not key:
+        return lambda doc: () if doc is None else [doc]
+
+    key_parts = []
+    for part in key.split('.'):
+        try:
+            part_int = int(part)
+        except ValueError:
+            part_int = None
+        key_parts.append((part, part_int))
+    key_parts = tuple(key_parts)
+
+    if len(key_parts) == 1:
+        field = key
+
+        def _get_field_candidates(doc):
+            if isinstance(doc, dict):
+                return [doc.get(field, NOTHING)]
+            return _get_key_parts_candidates(key_parts, 0, doc)
+        return _get_field_candidates
+
+    return lambda doc: _get_key_parts_candidates(key_parts, 0, doc)
+
+
+def _get_key_parts_candidates(key_parts, index, doc):
+    if doc is None:
+        return ()
+
+    num_parts = len(key_parts)
+    if index == num_parts or index == num_parts - 1 and not key_parts[index][0]:
+        # The remaining key is empty.
+        return [doc]
+
+    if isinstance(doc, list):
+        sub_key, sub_key_int = key_parts[index]
+        if sub_key_int is None:
+            # subkey is not an integer...
+            return [x
+                    for sub_doc in doc
+                    if isinstance(sub_doc, dict) and sub_key in sub_doc
+                    for x in _get_key_parts_candidates(key_parts, index + 1, sub_doc[sub_key])]
+
+        # subkey is an index
+        if sub_key_int >= len(doc):
+            return ()  # dead end
+        sub_doc = doc[sub_key_int]
+        if index + 1 < num_parts:
+            return _get_key_parts_candidates(key_parts, index + 1, sub_doc)
+        return [sub_doc]
+
+    if not isinstance(doc, dict):
+        return ()
+
+    if index == num_parts - 1:
+        return [doc.get(key_parts[index][0], NOTHING)]
 
-    def _all_op(self, doc_val, search_val):
-        if isinstance(doc_val, list) and doc_val and isinstance(doc_val[0], list):
-            doc_val = list(itertools.chain.from_iterable(doc_val))
-        dv = _force_list(doc_val)
-        matches = []
-        for x in search_val:
-            if isinstance(x, dict) and '$elemMatch' in x:
-                matches.append(self._elem_match_op(doc_val, x['$elemMatch']))
-            else:
-                matches.append(x in dv)
-        return all(matches)
+    return _get_key_parts_candidates(key_parts, index + 1, doc.get(key_parts[index][0], {}))
 
 
 def iter_key_candidates(key, doc):
@@ -373,6 +612,53 @@ def _get_compare_type(val):
         (val, type(val)))
 
 
+def bson_sort_key(val):
+    """Get a key that orders values the same way as bson_compare.
+
+    The key is a tuple starting with the BSON type rank (see _get_compare_type) and only made
+    of natively comparable and hashable items, so that it can be used directly with sorted,
+    bisect or as a dict key.
+    """
+    compare_type = _get_compare_type(val)
+    if compare_type == 10:
+        if val != val:
+            # NaN is lower than any other number in BSON order, even -inf.
+            return 10,
+        return 10, val
+    if compare_type in (15, 40, 45):
+        return compare_type, val
+    if compare_type == 5:
+        return 5,
+    if compare_type == 20:
+        if type(val).__name__ == 'DBRef' and hasattr(val, 'as_doc'):
+            val = val.as_doc()
+        return 20, tuple(
+            (_get_compare_type(v), k, bson_sort_key(v)) for k, v in iteritems(val))
+    if compare_type == 25:
+        return 25, tuple(bson_sort_key(v) for v in val)
+    if compare_type == 30:
+        if isinstance(val, uuid.UUID):
+            val = val.bytes
+        return 30, len(val), val
+    if compare_type == 35:
+        return 35, getattr(val, 'binary', None) or str(val)
+    # Regular expressions.
+    return 50, val.pattern, str(val.flags)
+
+
+def _compile_regex(regex):
+    """Compile a regex ahead of its use, if possible."""
+    try:
+        if isinstance(regex, string_types):
+            return re.compile(regex)
+        if not isinstance(regex, RE_TYPE):
+            # bson.Regex
+            return regex.try_compile()
+    except re.error:
+        pass
+    return regex
+
+
 def _regex(doc_val, regex):
     if not (isinstance(doc_val, (string_types, list)) or isinstance(doc_val, RE_TYPE)):
         return False
@@ -494,28 +780,94 @@ def resolve_key(key, doc):
 
 
 def resolve_sort_key(key, doc):
+    """Get a natively comparable key to sort documents by one of their fields."""
     value = resolve_key(key, doc)
     # see http://docs.mongodb.org/manual/reference/method/cursor.sort/#ascending-descending-sort
     if value is NOTHING:
-        return 1, BsonComparable(None)
+        return 1, _NONE_SORT_KEY
 
     # List or tuples are sorted solely by their first value.
     if isinstance(value, (tuple, list)):
         if not value:
-            return 0, BsonComparable(None)
-        return 1, BsonComparable(value[0])
+            return 0, _NONE_SORT_KEY
+        return 1, bson_sort_key(value[0])
+
+    return 1, bson_sort_key(value)
+
 
-    return 1, BsonComparable(value)
+_NONE_SORT_KEY = bson_sort_key(None)
 
 
-class BsonComparable(object):
-    """Wraps a value in an BSON like object that can be compared one to another."""
+class _DescendingSortKey(object):
+    """Wraps a sort key to reverse its order."""
 
-    def __init__(self, obj):
-        self.obj = obj
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
 
     def __lt__(self, other):
-        return bson_compare(operator.lt, self.obj, other.obj)
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __ne__(self, other):
+        return self.key != other.key
+
+
+def _reverse_sort_key(sort_key):
+    """Get a key ordering values in the reverse order of a key from resolve_sort_key.
+
+    Numbers and booleans are negated so that they stay natively comparable, other values are
+    wrapped in a _DescendingSortKey that is only ever compared to values of the same type.
+    """
+    order, value_key = sort_key
+    compare_type = value_key[0]
+    if len(value_key) == 1:
+        if compare_type == 10:
+            # NaN is the lowest number so it gets the highest reversed key, even above -inf.
+            return -order, -compare_type, float('inf'), 0
+        return -order, -compare_type
+    if compare_type in (10, 40):
+        return -order, -compare_type, -value_key[1]
+    return -order, -compare_type, _DescendingSortKey(value_key[1:])
+
+
+def sort_documents(documents, sort, limit=None):
+    """Sort documents by a list of (key, direction) pairs.
+
+    The sort is stable and is done in a single pass with a key computed once per document. If
+    limit is given, only the first limit documents are returned and they are selected with a
+    bounded heap instead of sorting all the documents.
+    """
+    if not sort:
+        documents = list(documents)
+        return documents[:limit] if limit is not None else documents
+
+    keys = [key for key, unused_direction in sort]
+    is_descending = sort[0][1] < 0
+    if all((direction < 0) == is_descending for unused_key, direction in sort):
+        # Same direction for all keys: reverse the whole sort instead of each key.
+        reverse = is_descending
+
+        def _get_sort_key(doc):
+            return tuple(resolve_sort_key(key, doc) for key in keys)
+    else:
+        reverse = False
+        descending_keys = [(key, direction < 0) for key, direction in sort]
+
+        def _get_sort_key(doc):
+            return tuple(
+                _reverse_sort_key(resolve_sort_key(key, doc)) if is_descending
+                else resolve_sort_key(key, doc)
+                for key, is_descending in descending_keys)
+
+    if limit is not None:
+        select = heapq.nlargest if reverse else heapq.nsmallest
+        return select(limit, documents, key=_get_sort_key)
+    return sorted(documents, key=_get_sort_key, reverse=reverse)
 
 
 _filterer_inst = _Filterer()
+_compiled_filters = _CompiledFiltersCache(max_size=1000)
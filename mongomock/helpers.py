@@ -1,4 +1,9 @@
 from collections import OrderedDict
+try:
+    from collections.abc import Mapping, Sequence
+except ImportError:
+    from collections import Mapping, Sequence
+import copy
 from datetime import datetime, timedelta, tzinfo
 from mongomock import InvalidURI
 import re
@@ -44,6 +49,11 @@ except ImportError:
             return timedelta(0)
     utc = _FixedOffset(0, 'UTC')
 
+if hasattr(time, 'perf_counter'):
+    get_perf_counter = time.perf_counter
+else:
+    get_perf_counter = time.clock
+
 
 ASCENDING = 1
 DESCENDING = -1
@@ -160,6 +170,124 @@ class hashdict(dict):
         return result
 
 
+def _raise_read_only(self, *args, **kwargs):
+    raise TypeError(
+        '{0} is a read-only view of a stored document, use copy() to get a mutable copy or '
+        'create the MongoClient with copy_on_read=True'.format(self.__class__.__name__))
+
+
+class ReadOnlyDict(Mapping):
+    """Read-only view of a stored document or sub-document, returned instead of a copy.
+
+    Nested documents and arrays are returned as read-only views as well, and datetimes are
+    made timezone aware on access if tz_aware is set. As nothing is copied, the view reflects
+    later changes to the stored document. Views are not dict and list instances, so that
+    encoders that require them, e.g. json.dumps, need a copy.
+    """
+
+    __slots__ = ('_data', '_tz_aware')
+
+    def __init__(self, data, tz_aware=False):
+        self._data = data
+        self._tz_aware = tz_aware
+
+    def __getitem__(self, key):
+        return read_only_view(self._data[key], self._tz_aware)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __eq__(self, other):
+        if isinstance(other, (ReadOnlyDict, ReadOnlyList)):
+            other = other.copy()
+        return self.copy() == other if self._tz_aware else self._data == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(self.__class__.__name__, self.copy())
+
+    def copy(self):
+        """Get a mutable deep copy of the document."""
+        copied = copy.deepcopy(self._data)
+        if self._tz_aware:
+            return make_datetime_timezone_aware_in_document(copied)
+        return copied
+
+    def __deepcopy__(self, unused_memo):
+        return self.copy()
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _raise_read_only
+
+
+class ReadOnlyList(Sequence):
+    """Read-only view of an array of a stored document, see ReadOnlyDict."""
+
+    __slots__ = ('_data', '_tz_aware')
+
+    def __init__(self, data, tz_aware=False):
+        self._data = data
+        self._tz_aware = tz_aware
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ReadOnlyList(self._data[index], self._tz_aware)
+        return read_only_view(self._data[index], self._tz_aware)
+
+    def __iter__(self):
+        for item in self._data:
+            yield read_only_view(item, self._tz_aware)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __eq__(self, other):
+        if isinstance(other, (ReadOnlyDict, ReadOnlyList)):
+            other = other.copy()
+        return self.copy() == other if self._tz_aware else self._data == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(self.__class__.__name__, self.copy())
+
+    def copy(self):
+        """Get a mutable deep copy of the array."""
+        copied = copy.deepcopy(self._data)
+        if self._tz_aware:
+            return make_datetime_timezone_aware_in_document(copied)
+        return copied
+
+    def __deepcopy__(self, unused_memo):
+        return self.copy()
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = append = extend = insert = pop = \
+        remove = reverse = sort = _raise_read_only
+
+
+def read_only_view(value, tz_aware=False):
+    """Get a read-only view of a stored value, without copying it."""
+    if isinstance(value, dict):
+        return ReadOnlyDict(value, tz_aware)
+    if isinstance(value, (list, tuple)):
+        return ReadOnlyList(value, tz_aware)
+    if tz_aware and isinstance(value, datetime):
+        return value.replace(tzinfo=utc)
+    return value
+
+
 def fields_list_to_dict(fields):
     """Takes a list of field names and returns a matching dictionary.
 
@@ -319,6 +447,8 @@ def patch_datetime_awareness_in_document(value):
     # mixing tz aware and naive.
     # On top of that, MongoDB date precision is up to millisecond, where Python
     # datetime use microsecond, so we must lower the precision to mimic mongo.
+    if isinstance(value, (ReadOnlyDict, ReadOnlyList)):
+        value = value.copy()
     for best_type in (OrderedDict, dict):
         if isinstance(value, best_type):
             return best_type((k, patch_datetime_awareness_in_document(v)) for k, v in value.items())
@@ -334,6 +464,31 @@ def patch_datetime_awareness_in_document(value):
     return value
 
 
+def patch_datetime_awareness_in_spec(value):
+    """Patch datetimes in a spec as patch_datetime_awareness_in_document does.
+
+    Specs are only read, so the original object is returned unchanged, without copying it, if
+    it contains nothing to patch.
+    """
+    if _needs_datetime_awareness_patch(value):
+        return patch_datetime_awareness_in_document(value)
+    return value
+
+
+def _needs_datetime_awareness_patch(value):
+    if isinstance(value, dict):
+        return any(_needs_datetime_awareness_patch(v) for v in value.values())
+    if isinstance(value, list):
+        return any(_needs_datetime_awareness_patch(item) for item in value)
+    if isinstance(value, (tuple, ReadOnlyDict, ReadOnlyList)):
+        return True
+    if isinstance(value, datetime):
+        return value.tzinfo is not None or value.microsecond % 1000 != 0
+    if Timestamp and isinstance(value, Timestamp):
+        return not value.time and not value.inc
+    return False
+
+
 def make_datetime_timezone_aware_in_document(value):
     # MongoClient support tz_aware=True parameter to return timezone-aware
     # datetime objects. Given the date is stored internally without timezone
@@ -23,7 +23,7 @@ class MongoClient(object):
 
     def __init__(self, host=None, port=None, document_class=dict,
                  tz_aware=False, connect=True, _store=None, read_preference=None,
-                 **kwargs):
+                 ttl_monitor_interval=None, copy_on_read=True, **kwargs):
         if host:
             self.host = host[0] if isinstance(host, (list, tuple)) else host
         else:
@@ -31,9 +31,13 @@ class MongoClient(object):
         self.port = port or self.PORT
 
         self._tz_aware = tz_aware
+        self._copy_on_read = copy_on_read
         self._codec_options = mongomock_codec_options.CodecOptions(tz_aware=tz_aware)
         self._database_accesses = {}
         self._store = _store or ServerStore()
+        self._ttl_monitor = None
+        if ttl_monitor_interval is not None:
+            self._ttl_monitor = self._store.start_ttl_monitor(ttl_monitor_interval)
         self._id = next(self._CONNECTION_ID)
         self._document_class = document_class
         if read_preference is not None:
@@ -67,7 +71,23 @@ class MongoClient(object):
         return "mongomock.MongoClient('{0}', {1})".format(self.host, self.port)
 
     def close(self):
-        pass
+        if self._ttl_monitor and self._store.ttl_monitor is self._ttl_monitor:
+            self._store.stop_ttl_monitor()
+        self._ttl_monitor = None
+
+    @property
+    def ttl_monitor(self):
+        """The thread removing expired documents in the background, if any."""
+        return self._store.ttl_monitor
+
+    @property
+    def copy_on_read(self):
+        """Whether documents read with find are copies, or read-only views if False.
+
+        The views are mappings and sequences, not dict and list instances: use their copy
+        method to get a mutable document, e.g. to encode it with bson.BSON.encode or json.dumps.
+        """
+        return self._copy_on_read
 
     @property
     def is_mongos(self):
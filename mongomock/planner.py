@@ -0,0 +1,492 @@
+"""Choose how to find the documents matching a filter: with an index or a full scan."""
+
+import collections
+import numbers
+import re
+
+import six
+from six import iteritems
+
+from mongomock.filtering import bson_sort_key
+from mongomock import helpers
+from mongomock.helpers import ObjectId, RE_TYPE
+
+try:
+    from bson import Regex
+    _RE_TYPES = (RE_TYPE, Regex)
+except ImportError:
+    _RE_TYPES = (RE_TYPE,)
+
+
+_RANGE_OPERATORS = ('$gt', '$gte', '$lt', '$lte')
+
+# Types of values for which matching a filter is exactly the same as finding the index keys
+# within bounds.
+_EXACT_VALUE_TYPES = six.integer_types + (float,) + six.string_types
+
+# Regex flags that prevent from using the prefix of a regex.
+_NON_PREFIX_REGEX_FLAGS = re.IGNORECASE | re.MULTILINE | re.VERBOSE
+
+_REGEX_SPECIAL_CHARS = frozenset('\\.^$*+?{}[]|()')
+
+_NAN_KEY = bson_sort_key(float('nan'))
+
+
+class QueryPlan(object):
+    """The way to find the documents matching a filter.
+
+    Attributes:
+        residual_filter: the part of the filter that still needs to be checked on the
+            documents.
+        index_name: the name of the index to use, or None for a full collection scan.
+        index_store: the IndexStore of the index.
+        index_bounds: the bounds on the keys of the index, a list with for each of the first
+            indexed fields a list of (lower, upper, include_lower, include_upper) intervals.
+        candidate_ids: the IDs of the documents found with the index, a superset of the
+            matching documents, or None for a full collection scan.
+        keys_examined: the number of index keys examined to find the candidates.
+        is_id_lookup: whether the candidates are directly the IDs given in the filter.
+    """
+
+    def __init__(self, residual_filter, index_name=None, index_store=None, index_bounds=None,
+                 candidate_ids=None, keys_examined=0, is_id_lookup=False):
+        self.residual_filter = residual_filter
+        self.is_id_lookup = is_id_lookup
+        self.index_name = index_name
+        self.index_store = index_store
+        self.index_bounds = index_bounds
+        self.candidate_ids = candidate_ids
+        self.keys_examined = keys_examined
+
+    @property
+    def stage(self):
+        if self.is_id_lookup:
+            return 'IDHACK'
+        return 'COLLSCAN' if self.index_name is None else 'IXSCAN'
+
+
+class ExecutionStats(object):
+    """Counters of the work done to run a query, as reported by explain."""
+
+    def __init__(self):
+        self.query_plan = None
+        self.docs_examined = 0
+        self.num_matched = 0
+
+    @property
+    def keys_examined(self):
+        return self.query_plan.keys_examined if self.query_plan else 0
+
+    def filter_documents(self, documents, matches_filter=None):
+        """Iterate over the documents matching a filter while counting them."""
+        for document in documents:
+            self.docs_examined += 1
+            if matches_filter is None or matches_filter(document):
+                self.num_matched += 1
+                yield document
+
+
+def plan_query(collection_store, search_filter):
+    """Choose the best index to find the documents matching a filter.
+
+    The filter is split in predicates on single fields, the ones that can be answered with the
+    index keys are turned into index bounds, and the index that returns the fewest documents
+    is used.
+
+    Queries on _id values are answered directly as documents are stored by _id.
+    """
+    if not isinstance(search_filter, dict):
+        return QueryPlan(search_filter)
+
+    if '_id' in search_filter:
+        id_plan = _plan_id_lookup(search_filter)
+        if id_plan:
+            return id_plan
+
+    index_stores = collection_store.get_index_stores()
+    if not index_stores:
+        return QueryPlan(search_filter)
+
+    predicates = list(_iter_predicates(search_filter))
+    if not predicates:
+        return QueryPlan(search_filter)
+
+    best_plan = None
+    for index_name, index_store in index_stores:
+        is_multikey = index_store.is_multikey
+        index_bounds = []
+        exact_fields = set()
+        for field in index_store.fields:
+            field_bounds = None
+            for predicate_field, search, is_top_level in predicates:
+                if predicate_field != field:
+                    continue
+                search_bounds = get_index_bounds(search, is_multikey)
+                if search_bounds is None:
+                    continue
+                if field_bounds is None:
+                    field_bounds = search_bounds
+                elif not is_multikey:
+                    # Each predicate can be matched by a different element of an array, so
+                    # bounds are only combined for indexes without arrays.
+                    field_bounds = _intersect_bounds(field_bounds, search_bounds)
+                if is_top_level and not is_multikey and '.' not in field and \
+                        _is_exact_search(search):
+                    exact_fields.add(field)
+            if field_bounds is None:
+                break
+            index_bounds.append(field_bounds)
+        if not index_bounds:
+            continue
+
+        candidate_ids, keys_examined = index_store.find_ids(index_bounds)
+        if best_plan is not None and len(candidate_ids) >= len(best_plan.candidate_ids):
+            continue
+        residual_filter = {
+            key: search for key, search in iteritems(search_filter) if key not in exact_fields
+        }
+        best_plan = QueryPlan(
+            residual_filter, index_name=index_name, index_store=index_store,
+            index_bounds=index_bounds, candidate_ids=candidate_ids, keys_examined=keys_examined)
+
+    return best_plan or QueryPlan(search_filter)
+
+
+def _plan_id_lookup(search_filter):
+    search = search_filter['_id']
+    values = [search]
+    # Whether the IDs found are exactly the ones matching the search.
+    is_exact = True
+    if isinstance(search, dict) and search and all(key.startswith('$') for key in search):
+        if '$eq' in search:
+            values = [search['$eq']]
+        elif '$in' in search and isinstance(search['$in'], (list, tuple)):
+            values = search['$in']
+        else:
+            return None
+        is_exact = len(search) == 1
+
+    ids = set()
+    for value in values:
+        if isinstance(value, (list, tuple) + _RE_TYPES):
+            return None
+        if isinstance(value, dict):
+            value = helpers.hashdict(value)
+        try:
+            ids.add(value)
+        except TypeError:
+            return None
+        is_exact = is_exact and \
+            (value is None or isinstance(value, ObjectId) or _is_exact_value(value))
+
+    residual_filter = search_filter
+    if is_exact:
+        residual_filter = {
+            key: value for key, value in iteritems(search_filter) if key != '_id'
+        }
+    return QueryPlan(
+        residual_filter, index_name='_id_', candidate_ids=ids, keys_examined=len(ids),
+        is_id_lookup=True)
+
+
+def _iter_predicates(search_filter):
+    """List the (field, search, is_top_level) predicates that a document must all match."""
+    for key, search in iteritems(search_filter):
+        if key == '$and' and isinstance(search, (list, tuple)):
+            for sub_filter in search:
+                if not isinstance(sub_filter, dict):
+                    continue
+                for field, sub_search, unused_is_top_level in _iter_predicates(sub_filter):
+                    yield field, sub_search, False
+            continue
+        if key.startswith('$'):
+            continue
+        yield key, search, True
+
+
+def get_index_bounds(search, is_multikey):
+    """Get the ranges of index keys that contain all the values matching a query.
+
+    Returns a list of (lower, upper, include_lower, include_upper) ranges on the keys of an
+    index computed with filtering.bson_sort_key, or None if the query cannot use an index.
+    """
+    if isinstance(search, _RE_TYPES):
+        bounds = _get_regex_bounds(search)
+        equality_bounds = _get_index_equality_bounds(search)
+        if bounds is None or equality_bounds is None:
+            return None
+        # A regex also matches the regex values.
+        return bounds + equality_bounds
+    if not isinstance(search, dict) or not search:
+        return _get_index_equality_bounds(search)
+    if not all(key.startswith('$') for key in search):
+        return None
+    if '$eq' in search:
+        return _get_index_equality_bounds(search['$eq'])
+    if '$in' in search:
+        return _get_index_in_bounds(search['$in'])
+    if '$regex' in search:
+        if search.get('$options'):
+            return None
+        return _get_regex_bounds(search['$regex'])
+
+    bounds = None
+    for operator_string in _RANGE_OPERATORS:
+        if operator_string not in search:
+            continue
+        value = search[operator_string]
+        if isinstance(value, (dict, list, tuple) + _RE_TYPES):
+            continue
+        try:
+            key = bson_sort_key(value)
+        except NotImplementedError:
+            continue
+        # Comparison operators only match values of the same BSON type, but not NaN which
+        # is keyed as the lowest number.
+        type_lower, type_upper = (key[0],), (key[0] + 1,)
+        if operator_string.startswith('$gt'):
+            new_bounds = key, type_upper, operator_string == '$gte', False
+        else:
+            new_bounds = type_lower, key, type_lower != _NAN_KEY, operator_string == '$lte'
+        if bounds is None:
+            bounds = new_bounds
+            if is_multikey:
+                # Each operator can be matched by a different element of an array, so
+                # bounds cannot be combined.
+                break
+            continue
+        bounds = _intersect_range(bounds, new_bounds)
+    if bounds is None:
+        return None
+    return [bounds]
+
+
+def _get_index_equality_bounds(value):
+    if isinstance(value, (dict, list, tuple)) or value != value:
+        return None
+    try:
+        keys = [bson_sort_key(value)]
+    except NotImplementedError:
+        return None
+    # Python equality is used to match values: 1 == True.
+    if isinstance(value, bool):
+        keys.append(bson_sort_key(int(value)))
+    elif isinstance(value, numbers.Number) and value in (0, 1):
+        keys.append(bson_sort_key(bool(value)))
+    elif isinstance(value, ObjectId):
+        # ObjectIds also match their string representation in arrays.
+        keys.append(bson_sort_key(str(value)))
+    return [(key, key, True, True) for key in keys]
+
+
+def _get_index_in_bounds(values):
+    if not isinstance(values, (list, tuple)):
+        return None
+    bounds = []
+    seen_bounds = set()
+    for value in values:
+        if isinstance(value, _RE_TYPES):
+            value_bounds = _get_regex_bounds(value)
+            if value_bounds is not None:
+                value_bounds += _get_index_equality_bounds(value) or []
+        else:
+            value_bounds = _get_index_equality_bounds(value)
+        if value_bounds is None:
+            return None
+        for value_bound in value_bounds:
+            if value_bound not in seen_bounds:
+                seen_bounds.add(value_bound)
+                bounds.append(value_bound)
+    return bounds
+
+
+def _get_regex_bounds(regex):
+    """Get the range of strings that can match a regex anchored at the start."""
+    if isinstance(regex, six.string_types):
+        pattern, flags = regex, 0
+    else:
+        pattern, flags = regex.pattern, regex.flags
+    if not isinstance(pattern, six.string_types) or not isinstance(flags, int) or \
+            flags & _NON_PREFIX_REGEX_FLAGS or not pattern.startswith('^') or \
+            '|' in pattern or '(?' in pattern:
+        return None
+
+    prefix = []
+    for index, char in enumerate(pattern[1:], 1):
+        if char in _REGEX_SPECIAL_CHARS:
+            # The previous character might be optional.
+            if char in '*?{' and prefix:
+                prefix.pop()
+            break
+        prefix.append(char)
+    prefix = ''.join(prefix)
+
+    string_rank = bson_sort_key('')[0]
+    if not prefix or ord(prefix[-1]) >= 0x10FFFF:
+        return [(bson_sort_key(prefix), (string_rank + 1,), True, False)]
+    upper = prefix[:-1] + six.unichr(ord(prefix[-1]) + 1)
+    return [(bson_sort_key(prefix), bson_sort_key(upper), True, False)]
+
+
+def _intersect_range(bounds, other_bounds):
+    lower, upper, include_lower, include_upper = bounds
+    if other_bounds[0] > lower:
+        lower, include_lower = other_bounds[0], other_bounds[2]
+    elif other_bounds[0] == lower:
+        include_lower = include_lower and other_bounds[2]
+    if other_bounds[1] < upper:
+        upper, include_upper = other_bounds[1], other_bounds[3]
+    elif other_bounds[1] == upper:
+        include_upper = include_upper and other_bounds[3]
+    return lower, upper, include_lower, include_upper
+
+
+def _intersect_bounds(field_bounds, other_field_bounds):
+    """Intersect two unions of ranges of keys."""
+    intersection = []
+    for bounds in field_bounds:
+        for other_bounds in other_field_bounds:
+            lower, upper, include_lower, include_upper = _intersect_range(bounds, other_bounds)
+            if lower < upper or lower == upper and include_lower and include_upper:
+                intersection.append((lower, upper, include_lower, include_upper))
+    return intersection
+
+
+def _is_exact_value(value, allow_bool=True):
+    if isinstance(value, bool):
+        return allow_bool
+    return isinstance(value, _EXACT_VALUE_TYPES) and value == value
+
+
+def _is_exact_search(search):
+    """Whether index bounds find exactly the documents matching a query on a non-array field.
+
+    The check is conservative: only simple comparisons with numbers and strings are exact.
+    """
+    if not isinstance(search, dict):
+        return _is_exact_value(search)
+    if not search:
+        return False
+    if len(search) == 1 and '$eq' in search:
+        return _is_exact_value(search['$eq'])
+    if len(search) == 1 and '$in' in search:
+        values = search['$in']
+        return isinstance(values, (list, tuple)) and all(_is_exact_value(v) for v in values)
+    return all(
+        operator_string in _RANGE_OPERATORS and _is_exact_value(value, allow_bool=False)
+        for operator_string, value in iteritems(search))
+
+
+def explain_query(
+        namespace, query, execution_stats, num_returned, execution_time_millis,
+        sort=None, skip=0, limit=None, projection=None):
+    """Describe how a query was run, in the same format as MongoDB's explain command."""
+    query_plan = execution_stats.query_plan or QueryPlan(query)
+    return {
+        'queryPlanner': {
+            'plannerVersion': 1,
+            'namespace': namespace,
+            'indexFilterSet': False,
+            'parsedQuery': query,
+            'winningPlan': _get_plan_stage(query_plan, sort, skip, limit, projection),
+            'rejectedPlans': [],
+        },
+        'executionStats': {
+            'executionSuccess': True,
+            'nReturned': num_returned,
+            'executionTimeMillis': execution_time_millis,
+            'totalKeysExamined': execution_stats.keys_examined,
+            'totalDocsExamined': execution_stats.docs_examined,
+            'executionStages': _get_plan_stage(
+                query_plan, sort, skip, limit, projection, execution_stats=execution_stats,
+                num_returned=num_returned),
+        },
+        'ok': 1.0,
+    }
+
+
+def _get_plan_stage(
+        query_plan, sort, skip, limit, projection, execution_stats=None, num_returned=None):
+    if query_plan.is_id_lookup:
+        stage = {'stage': 'IDHACK'}
+        if execution_stats:
+            stage['keysExamined'] = query_plan.keys_examined
+    elif query_plan.index_name is None:
+        stage = {'stage': 'COLLSCAN', 'direction': 'forward'}
+    else:
+        index_store = query_plan.index_store
+        index_stage = {
+            'stage': 'IXSCAN',
+            'keyPattern': collections.OrderedDict(index_store.key),
+            'indexName': query_plan.index_name,
+            'isMultiKey': index_store.is_multikey,
+            'direction': 'forward',
+            'indexBounds': collections.OrderedDict(
+                (field, [_format_index_bounds(b) for b in field_bounds])
+                for field, field_bounds in zip(index_store.fields, query_plan.index_bounds)),
+        }
+        for field in index_store.fields[len(query_plan.index_bounds):]:
+            index_stage['indexBounds'][field] = ['[MinKey, MaxKey]']
+        if execution_stats:
+            index_stage['keysExamined'] = query_plan.keys_examined
+            index_stage['nReturned'] = len(query_plan.candidate_ids)
+        stage = {'stage': 'FETCH', 'inputStage': index_stage}
+    if query_plan.residual_filter:
+        stage['filter'] = query_plan.residual_filter
+    if execution_stats:
+        stage['docsExamined'] = execution_stats.docs_examined
+        stage['nReturned'] = execution_stats.num_matched
+
+    if sort:
+        stage = {
+            'stage': 'SORT',
+            'sortPattern': collections.OrderedDict(sort),
+            'inputStage': stage,
+        }
+    if skip:
+        stage = {'stage': 'SKIP', 'skipAmount': skip, 'inputStage': stage}
+    if limit:
+        stage = {'stage': 'LIMIT', 'limitAmount': limit, 'inputStage': stage}
+    if projection:
+        stage = {'stage': 'PROJECTION', 'transformBy': projection, 'inputStage': stage}
+    if execution_stats:
+        stage['nReturned'] = num_returned
+    return stage
+
+
+_NULL_KEY = bson_sort_key(None)
+
+# How to display the limits of each type in index bounds.
+_TYPE_LIMITS = {
+    bson_sort_key(0)[0]: ('-inf.0', 'inf.0'),
+    bson_sort_key('')[0]: ('""', '{}'),
+    bson_sort_key({})[0]: ('{}', '[]'),
+}
+
+
+def _format_index_bounds(bounds):
+    lower, upper, include_lower, include_upper = bounds
+    return '{}{}, {}{}'.format(
+        '[' if include_lower else '(', _format_index_key(lower, is_lower=True),
+        _format_index_key(upper, is_lower=False), ']' if include_upper else ')')
+
+
+def _format_index_key(key, is_lower):
+    if key is None:
+        return 'MinKey' if is_lower else 'MaxKey'
+    if key == _NULL_KEY:
+        return 'null'
+    if len(key) == 1:
+        # The limit of a type.
+        limits = _TYPE_LIMITS.get(key[0] if is_lower else key[0] - 1)
+        if limits:
+            return limits[0 if is_lower else 1]
+        return 'MinKey' if is_lower else 'MaxKey'
+    value = key[1]
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, six.string_types):
+        return '"{}"'.format(value)
+    if key[0] == bson_sort_key(re.compile(''))[0]:
+        return '/{}/'.format(value)
+    return repr(value)
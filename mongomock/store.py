@@ -1,6 +1,12 @@
+import bisect
 import collections
 import datetime
+import heapq
+import itertools
 import mongomock  # Used for utcnow - please see https://github.com/mongomock/mongomock#utcnow
+from mongomock import filtering
+from mongomock import helpers
+from sentinels import NOTHING
 import six
 import six.moves
 import threading
@@ -13,12 +19,13 @@ class ServerStore(object):
 
     def __init__(self):
         self._databases = {}
+        self.ttl_monitor = None
 
     def __getitem__(self, db_name):
         try:
             return self._databases[db_name]
         except KeyError:
-            db = self._databases[db_name] = DatabaseStore()
+            db = self._databases[db_name] = DatabaseStore(self)
             return db
 
     def __contains__(self, db_name):
@@ -27,18 +34,45 @@ class ServerStore(object):
     def list_created_database_names(self):
         return [name for name, db in self._databases.items() if db.is_created]
 
+    def start_ttl_monitor(self, interval):
+        """Start a thread removing the expired documents every `interval` seconds.
+
+        While the monitor runs, documents are not expired anymore when the collections are read.
+        """
+        with lock:
+            if self.ttl_monitor is None:
+                self.ttl_monitor = TTLMonitor(self, interval)
+                self.ttl_monitor.start()
+            return self.ttl_monitor
+
+    def stop_ttl_monitor(self):
+        with lock:
+            ttl_monitor, self.ttl_monitor = self.ttl_monitor, None
+        if ttl_monitor:
+            ttl_monitor.stop()
+
+    def remove_expired_documents(self):
+        """Remove the expired documents of all collections and count them."""
+        with lock:
+            return sum(
+                col.remove_expired_documents()
+                for db in list(self._databases.values())
+                for col in list(db._collections.values())
+            )
+
 
 class DatabaseStore(object):
     """Object holding the data for a database (many collections)."""
 
-    def __init__(self):
+    def __init__(self, server_store=None):
         self._collections = {}
+        self._server_store = server_store
 
     def __getitem__(self, col_name):
         try:
             return self._collections[col_name]
         except KeyError:
-            col = self._collections[col_name] = CollectionStore(col_name)
+            col = self._collections[col_name] = CollectionStore(col_name, self._server_store)
             return col
 
     def __contains__(self, col_name):
@@ -53,7 +87,9 @@ class DatabaseStore(object):
         return col
 
     def rename(self, name, new_name):
-        col = self._collections.pop(name, CollectionStore(new_name))
+        col = self._collections.pop(name, None)
+        if col is None:
+            col = CollectionStore(new_name, self._server_store)
         col.name = new_name
         self._collections[new_name] = col
 
@@ -65,12 +101,20 @@ class DatabaseStore(object):
 class CollectionStore(object):
     """Object holding the data for a collection."""
 
-    def __init__(self, name):
+    def __init__(self, name, server_store=None):
         self._documents = collections.OrderedDict()
         self.indexes = {}
+        self._index_stores = {}
         self._is_force_created = False
         self.name = name
         self._ttl_indexes = {}
+        self._server_store = server_store
+        # Insertion rank of each document, to give back documents in their natural order.
+        self._positions = {}
+        self._next_position = itertools.count()
+        # Whether a datetime was stored since the collection was last emptied: if not, there
+        # is no need to make datetimes timezone aware when reading documents.
+        self.may_contain_datetimes = False
 
     def create(self):
         self._is_force_created = True
@@ -81,14 +125,44 @@ class CollectionStore(object):
 
     def drop(self):
         self._documents = collections.OrderedDict()
-        self.indexes = {}
-        self._ttl_indexes = {}
+        self._positions = {}
+        self.may_contain_datetimes = False
+        self.drop_indexes()
         self._is_force_created = False
 
     def create_index(self, index_name, index_dict):
-        self.indexes[index_name] = index_dict
-        if index_dict.get('expireAfterSeconds') is not None:
-            self._ttl_indexes[index_name] = index_dict
+        with lock:
+            if self.indexes.get(index_name) != index_dict or \
+                    index_name not in self._index_stores:
+                index_store = IndexStore(
+                    index_dict['key'], unique=index_dict.get('unique', False),
+                    sparse=index_dict.get('sparse', False))
+                for doc_id, doc in six.iteritems(self._documents):
+                    keys = index_store.get_keys(doc)
+                    index_store.ensure_unique(doc_id, keys)
+                    index_store.add(doc_id, keys)
+                self._index_stores[index_name] = index_store
+                self._ttl_indexes.pop(index_name, None)
+                if index_dict.get('expireAfterSeconds') is not None:
+                    self._create_ttl_index(index_name, index_dict)
+            self.indexes[index_name] = index_dict
+
+    def _create_ttl_index(self, index_name, index_dict):
+        # Ignore non-integer values
+        try:
+            expiry = int(index_dict['expireAfterSeconds'])
+        except ValueError:
+            return
+
+        # Ignore commpound keys
+        if len(index_dict['key']) > 1:
+            return
+
+        # "key" structure = list of (field name, direction) tuples
+        expiry_queue = ExpiryQueue(index_dict['key'][0][0], expiry)
+        for doc_id, doc in six.iteritems(self._documents):
+            expiry_queue.add(doc_id, doc)
+        self._ttl_indexes[index_name] = expiry_queue
 
     def drop_index(self, index_name):
         self._remove_expired_documents()
@@ -96,73 +170,365 @@ class CollectionStore(object):
         # The main index object should raise a KeyError, but the
         # TTL indexes have no meaning to the outside.
         del self.indexes[index_name]
+        self._index_stores.pop(index_name, None)
         self._ttl_indexes.pop(index_name, None)
 
+    def drop_indexes(self):
+        self.indexes = {}
+        self._index_stores = {}
+        self._ttl_indexes = {}
+
+    def get_index_stores(self):
+        """List the (name, IndexStore) pairs of all the indexes of the collection."""
+        return list(six.iteritems(self._index_stores))
+
     @property
     def is_empty(self):
         self._remove_expired_documents()
-        return not self._documents
+        with lock:
+            return not self._documents
 
     def __contains__(self, key):
         self._remove_expired_documents()
-        return key in self._documents
+        with lock:
+            return key in self._documents
 
     def __getitem__(self, key):
         self._remove_expired_documents()
-        return self._documents[key]
+        with lock:
+            return self._documents[key]
 
     def __setitem__(self, key, val):
         with lock:
+            index_keys = [
+                (index_store, index_store.get_keys(val))
+                for index_store in six.itervalues(self._index_stores)
+            ]
+            # Check all unique indexes before modifying anything.
+            for index_store, keys in index_keys:
+                index_store.ensure_unique(key, keys)
+
+            if key in self._documents:
+                for index_store in six.itervalues(self._index_stores):
+                    index_store.remove(key)
+            else:
+                self._positions[key] = next(self._next_position)
+            if not self.may_contain_datetimes:
+                self.may_contain_datetimes = _contains_datetime(val)
             self._documents[key] = val
+            for index_store, keys in index_keys:
+                index_store.add(key, keys)
+            for expiry_queue in six.itervalues(self._ttl_indexes):
+                expiry_queue.add(key, val)
 
     def __delitem__(self, key):
-        del self._documents[key]
+        with lock:
+            del self._documents[key]
+            del self._positions[key]
+            for index_store in six.itervalues(self._index_stores):
+                index_store.remove(key)
+            for expiry_queue in six.itervalues(self._ttl_indexes):
+                expiry_queue.remove(key)
+            if not self._documents:
+                self.may_contain_datetimes = False
 
     def __len__(self):
         self._remove_expired_documents()
-        return len(self._documents)
+        with lock:
+            return len(self._documents)
 
     @property
     def documents(self):
+        """List the documents in their natural order.
+
+        The list is a snapshot, taken under the lock so that the TTL monitor cannot remove
+        documents while it is built.
+        """
         self._remove_expired_documents()
-        for doc in six.itervalues(self._documents):
-            yield doc
+        with lock:
+            return list(six.itervalues(self._documents))
 
-    def _remove_expired_documents(self):
-        for index in six.itervalues(self._ttl_indexes):
-            self._expire_documents(index)
+    def get_documents_by_ids(self, ids):
+        """Get the documents for the given IDs, in their natural order.
 
-    def _expire_documents(self, index):
-        # TODO(juannyg): use a caching mechanism to avoid re-expiring the documents if
-        # we just did and no document was added / updated
+        IDs that do not match any document are ignored.
+        """
+        self._remove_expired_documents()
+        with lock:
+            positions = self._positions
+            return [
+                self._documents[doc_id]
+                for doc_id in sorted((i for i in ids if i in positions), key=positions.__getitem__)
+            ]
+
+    def count_documents_by_ids(self, ids):
+        """Count the documents for the given IDs, ignoring IDs that do not match any."""
+        self._remove_expired_documents()
+        with lock:
+            documents = self._documents
+            return sum(1 for doc_id in ids if doc_id in documents)
 
-        # Ignore non-integer values
-        try:
-            expiry = int(index['expireAfterSeconds'])
-        except ValueError:
+    def _remove_expired_documents(self):
+        if self._server_store and self._server_store.ttl_monitor:
+            # Expiry is handled in the background.
             return
+        self.remove_expired_documents()
 
-        # Ignore commpound keys
-        if len(index['key']) > 1:
+    def remove_expired_documents(self):
+        """Remove the documents expired by the TTL indexes and count them."""
+        if not self._ttl_indexes:
+            return 0
+        ttl_now = mongomock.utcnow()
+        num_removed = 0
+        with lock:
+            for expiry_queue in list(six.itervalues(self._ttl_indexes)):
+                for expired_id in expiry_queue.pop_expired(ttl_now):
+                    del self[expired_id]
+                    num_removed += 1
+        return num_removed
+
+
+def _contains_datetime(value):
+    if isinstance(value, dict):
+        return any(_contains_datetime(v) for v in six.itervalues(value))
+    if isinstance(value, (list, tuple)):
+        return any(_contains_datetime(v) for v in value)
+    return isinstance(value, datetime.datetime)
+
+
+class TTLMonitor(threading.Thread):
+    """Thread removing the expired documents of a server at a regular interval.
+
+    It keeps some counters to follow the cost of expiry: the number of passes, the number of
+    deleted documents and the total time spent in passes (in seconds).
+    """
+
+    def __init__(self, server_store, interval):
+        super(TTLMonitor, self).__init__(name='TTLMonitor')
+        self.daemon = True
+        self._server_store = server_store
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self.passes = 0
+        self.deleted_documents = 0
+        self.time_spent = 0.
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.run_pass()
+
+    def run_pass(self):
+        start_time = helpers.get_perf_counter()
+        deleted_documents = self._server_store.remove_expired_documents()
+        with lock:
+            self.passes += 1
+            self.deleted_documents += deleted_documents
+            self.time_spent += helpers.get_perf_counter() - start_time
+
+    def stop(self):
+        self._stop_event.set()
+        if self.is_alive() and self is not threading.current_thread():
+            self.join()
+
+
+class ExpiryQueue(object):
+    """Object holding the expiry dates of documents for a TTL index.
+
+    Expiry dates are kept in a heap so that finding expired documents only costs the number
+    of expired documents. Entries of documents that were updated or deleted are left in the
+    heap and skipped when they come up.
+    """
+
+    def __init__(self, field, expiry):
+        self._field = field
+        self._expiry = datetime.timedelta(seconds=expiry)
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+
+    def add(self, doc_id, doc):
+        expiry_date = self._get_expiry_date(doc.get(self._field))
+        if expiry_date is None:
+            self._entries.pop(doc_id, None)
             return
+        entry = self._entries[doc_id] = (expiry_date, next(self._counter), doc_id)
+        heapq.heappush(self._heap, entry)
+        if len(self._heap) > 2 * len(self._entries) + 16:
+            # Drop the outdated entries.
+            self._heap = list(six.itervalues(self._entries))
+            heapq.heapify(self._heap)
+
+    def remove(self, doc_id):
+        self._entries.pop(doc_id, None)
+
+    def pop_expired(self, ttl_now):
+        """Remove and list the IDs of the documents that are expired."""
+        expired_ids = []
+        heap = self._heap
+        while heap and heap[0][0] <= ttl_now:
+            entry = heapq.heappop(heap)
+            doc_id = entry[2]
+            if self._entries.get(doc_id) is entry:
+                del self._entries[doc_id]
+                expired_ids.append(doc_id)
+        return expired_ids
+
+    def _get_expiry_date(self, val):
+        val_to_compare = _get_min_datetime_from_value(val)
+        if not isinstance(val_to_compare, datetime.datetime) or val_to_compare.tzinfo or \
+                val_to_compare == datetime.datetime.max:
+            return None
+        try:
+            return val_to_compare + self._expiry
+        except OverflowError:
+            return None
+
+
+class IndexStore(object):
+    """Object holding the sorted keys of an index and the documents they point to.
+
+    Each document is indexed with one key per value found at the indexed fields: a document
+    with an array value gets a key for each of its elements (a "multikey" index). Keys are
+    tuples with one item per indexed field, computed by filtering.bson_sort_key so that they
+    are sorted in BSON order.
+    """
+
+    def __init__(self, key, unique=False, sparse=False):
+        self.key = key
+        self._fields = [field for field, unused_direction in key]
+        self._unique = unique
+        self._sparse = sparse
+        self._sorted_keys = []
+        self._ids_by_key = {}
+        self._keys_by_id = {}
+        self._multikey_ids = set()
 
-        # "key" structure = list of (field name, direction) tuples
-        ttl_field_name = index['key'][0][0]
-        ttl_now = mongomock.utcnow()
-        expired_ids = [
-            doc['_id'] for doc in six.itervalues(self._documents)
-            if self._value_meets_expiry(doc.get(ttl_field_name), expiry, ttl_now)
-        ]
+    @property
+    def fields(self):
+        return self._fields
+
+    @property
+    def is_multikey(self):
+        return bool(self._multikey_ids)
 
-        for exp_id in expired_ids:
-            del self[exp_id]
+    def get_keys(self, doc):
+        """Compute the keys of a document for this index, to use with add."""
+        return _get_index_keys(doc, self._fields)
 
-    def _value_meets_expiry(self, val, expiry, ttl_now):
-        val_to_compare = _get_min_datetime_from_value(val)
-        try:
-            return (ttl_now - val_to_compare).total_seconds() >= expiry
-        except TypeError:
-            return False
+    def ensure_unique(self, doc_id, keys):
+        """Raise a DuplicateKeyError if another document already holds one of the keys."""
+        keys, unused_is_multikey = keys
+        if not self._unique:
+            return
+        if self._sparse and keys <= {(_NULL_KEY,) * len(self._fields)}:
+            return
+        for key in keys:
+            ids = self._ids_by_key.get(key)
+            if ids and (len(ids) > 1 or doc_id not in ids):
+                raise mongomock.DuplicateKeyError('E11000 Duplicate Key Error', 11000)
+
+    def add(self, doc_id, keys):
+        keys, is_multikey = keys
+        for key in keys:
+            ids = self._ids_by_key.get(key)
+            if ids is None:
+                ids = self._ids_by_key[key] = set()
+                bisect.insort(self._sorted_keys, key)
+            ids.add(doc_id)
+        self._keys_by_id[doc_id] = keys
+        if is_multikey:
+            self._multikey_ids.add(doc_id)
+
+    def remove(self, doc_id):
+        for key in self._keys_by_id.pop(doc_id, ()):
+            ids = self._ids_by_key[key]
+            ids.discard(doc_id)
+            if not ids:
+                del self._ids_by_key[key]
+                del self._sorted_keys[bisect.bisect_left(self._sorted_keys, key)]
+        self._multikey_ids.discard(doc_id)
+
+    def find_ids(self, index_bounds):
+        """Find the IDs of the documents whose keys are within bounds.
+
+        The bounds are a list with for each of the first indexed fields a list of
+        (lower, upper, include_lower, include_upper) ranges on the values computed by
+        filtering.bson_sort_key. A None lower or upper value means no bound.
+
+        Returns the set of IDs and the number of keys that were examined.
+        """
+        with lock:
+            return self._find_ids(index_bounds)
+
+    def _find_ids(self, index_bounds):
+        sorted_keys = self._sorted_keys
+        other_fields_bounds = list(enumerate(index_bounds[1:], 1))
+        ids = set()
+        num_keys_examined = 0
+        for lower, upper, include_lower, include_upper in index_bounds[0]:
+            start = 0 if lower is None else bisect.bisect_left(sorted_keys, (lower,))
+            for position in six.moves.range(start, len(sorted_keys)):
+                key = sorted_keys[position]
+                first = key[0]
+                if upper is not None and (first > upper or not include_upper and first == upper):
+                    break
+                if not include_lower and first == lower:
+                    continue
+                key_ids = self._ids_by_key[key]
+                # Count an index entry per document, as MongoDB does.
+                num_keys_examined += len(key_ids)
+                if other_fields_bounds and not all(
+                        _is_within_bounds(key[index], field_bounds)
+                        for index, field_bounds in other_fields_bounds):
+                    continue
+                ids.update(key_ids)
+        return ids, num_keys_examined
+
+
+def _is_within_bounds(value, field_bounds):
+    for lower, upper, include_lower, include_upper in field_bounds:
+        if lower is not None and (value < lower or not include_lower and value == lower):
+            continue
+        if upper is not None and (value > upper or not include_upper and value == upper):
+            continue
+        return True
+    return False
+
+
+_NULL_KEY = filtering.bson_sort_key(None)
+
+
+def _get_index_value_key(value):
+    try:
+        return filtering.bson_sort_key(value)
+    except NotImplementedError:
+        # Types that cannot be compared are sorted after all the others.
+        return 100, type(value).__name__, repr(value)
+
+
+def _get_index_keys(doc, fields):
+    """Compute the keys of a document for an index on the given fields.
+
+    Returns the set of keys and whether the document needs several keys.
+    """
+    is_multikey = False
+    keys_per_field = []
+    for field in fields:
+        values = []
+        candidates = filtering.iter_key_candidates(field, doc)
+        if len(candidates) > 1:
+            is_multikey = True
+        for candidate in candidates:
+            if isinstance(candidate, (list, tuple)):
+                is_multikey = True
+                # An empty array is indexed as is, so that it can be found by unique indexes.
+                values.extend(candidate or [candidate])
+            else:
+                values.append(None if candidate is NOTHING else candidate)
+        if not candidates:
+            values.append(None)
+        keys_per_field.append({_get_index_value_key(value) for value in values})
+    return set(itertools.product(*keys_per_field)), is_multikey
 
 
 def _get_min_datetime_from_value(val):
@@ -1,3 +1,5 @@
+import datetime
+import time
 import unittest
 
 try:
@@ -135,3 +137,56 @@ class MongoClientApiTest(unittest.TestCase):
         client = mongomock.MongoClient()
         with self.assertRaises(NotImplementedError):
             client.start_session()
+
+    def test_ttl_monitor(self):
+        client = mongomock.MongoClient(ttl_monitor_interval=1000)
+        self.assertTrue(client.ttl_monitor.is_alive())
+        collection = client.db.coll
+        collection.create_index('value', expireAfterSeconds=0)
+        collection.insert_one({'value': datetime.datetime.utcnow()})
+        collection.insert_one({'value': 'not a date'})
+
+        # Expiry is left to the monitor.
+        self.assertEqual(2, collection.count_documents({}))
+
+        client.ttl_monitor.run_pass()
+        self.assertEqual(1, collection.count_documents({}))
+        self.assertEqual(1, client.ttl_monitor.passes)
+        self.assertEqual(1, client.ttl_monitor.deleted_documents)
+        self.assertGreaterEqual(client.ttl_monitor.time_spent, 0)
+
+        ttl_monitor = client.ttl_monitor
+        client.close()
+        self.assertFalse(ttl_monitor.is_alive())
+        self.assertIsNone(client.ttl_monitor)
+
+    def test_ttl_monitor_runs_in_background(self):
+        with mongomock.MongoClient(ttl_monitor_interval=.01) as client:
+            client.db.coll.create_index('value', expireAfterSeconds=0)
+            client.db.coll.insert_one({'value': datetime.datetime.utcnow()})
+            for unused_i in range(500):
+                if client.ttl_monitor.deleted_documents:
+                    break
+                time.sleep(.01)
+            self.assertEqual(1, client.ttl_monitor.deleted_documents)
+            self.assertEqual(0, client.db.coll.count_documents({}))
+
+    def test_read_while_ttl_monitor_expires_documents(self):
+        with mongomock.MongoClient(ttl_monitor_interval=.001) as client:
+            collection = client.db.coll
+            collection.create_index('value', expireAfterSeconds=0)
+            now = datetime.datetime.utcnow()
+            collection.insert_many([
+                {'value': now + datetime.timedelta(milliseconds=i % 200), 'i': i}
+                for i in range(2000)
+            ])
+            for unused_i in range(500):
+                # Full scans, index scans and _id lookups while documents are removed.
+                collection.count_documents({'i': {'$gte': 0}})
+                collection.find_one({'i': -1})
+                collection.count_documents({'value': {'$gte': now}})
+                list(collection.find({'value': {'$gte': now}, 'i': {'$lt': 100}}))
+                collection.find_one({'_id': 1})
+                if not collection.count_documents({}):
+                    break
+            self.assertEqual(2000, client.ttl_monitor.deleted_documents)
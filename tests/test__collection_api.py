@@ -2,6 +2,7 @@ import collections
 import copy
 from datetime import datetime, tzinfo, timedelta
 from distutils import version  # pylint: disable=no-name-in-module
+import json
 import platform
 import random
 import re
@@ -26,6 +27,7 @@ except ImportError:
         _HAVE_MOCK = False
 
 try:
+    import bson
     from bson import codec_options
     from bson.errors import InvalidDocument
     from bson import tz_util, ObjectId, Regex, decimal128, Timestamp, DBRef
@@ -65,6 +67,12 @@ class UTCPlus2(tzinfo):
         return timedelta()
 
 
+def _iter_explain_stages(stage):
+    while stage:
+        yield stage
+        stage = stage.get('inputStage')
+
+
 class CollectionAPITest(TestCase):
 
     def setUp(self):
@@ -255,6 +263,80 @@ class CollectionAPITest(TestCase):
         refetched_obj = self.db.collection.find_one({'a': 1})
         self.assertNotEqual(fetched_obj, refetched_obj)
 
+    def test_cursor_returns_read_only_views_without_copy_on_read(self):
+        client = mongomock.MongoClient(copy_on_read=False, tz_aware=True)
+        self.assertFalse(client.copy_on_read)
+        collection = client.db.collection
+        collection.insert_one(
+            {'_id': 1, 'a': [1, {'b': 2}], 'd': datetime(2020, 1, 1), 's': 'x'})
+
+        fetched_obj = collection.find_one({'_id': 1})
+        self.assertEqual({'_id': 1, 'a': [1, {'b': 2}], 's': 'x'}, collection.find_one(
+            {'_id': 1}, {'d': 0}))
+        self.assertEqual(2, fetched_obj['a'][1]['b'])
+        self.assertEqual(timedelta(0), fetched_obj['d'].utcoffset())
+        with self.assertRaises(TypeError):
+            fetched_obj['b'] = 3
+        with self.assertRaises(TypeError):
+            fetched_obj.pop('s')
+        with self.assertRaises(TypeError):
+            fetched_obj['a'].append(3)
+        with self.assertRaises(TypeError):
+            fetched_obj['a'][1]['b'] = 3
+
+        # Mutable copies can be requested.
+        obj_copy = fetched_obj.copy()
+        obj_copy['a'].append(3)
+        self.assertEqual([1, {'b': 2}], collection.find_one({}, {'a': 1})['a'])
+
+        # Views can be used as inputs of other operations.
+        collection.update_one(fetched_obj, {'$set': {'s': 'y'}})
+        self.assertEqual('y', fetched_obj['s'])
+        self.assertEqual(['y'], collection.distinct('s'))
+        old = collection.find_one_and_update({'_id': 1}, {'$set': {'s': 'z'}})
+        self.assertEqual('y', old['s'])
+        old['s'] = 'w'
+        self.assertEqual(
+            [{'_id': 1, 'b': 2}],
+            list(collection.aggregate([{'$unwind': '$a'}, {'$project': {'b': '$a.b'}},
+                                       {'$match': {'b': {'$exists': True}}}])))
+
+    @skipIf(not _HAVE_PYMONGO, 'pymongo not installed')
+    def test_encode_read_only_views_without_copy_on_read(self):
+        collection = mongomock.MongoClient(copy_on_read=False).db.collection
+        collection.insert_one({'_id': 1, 'a': [1, {'b': 2}]})
+        fetched_obj = collection.find_one()
+
+        # Views are neither dict nor list instances, so they cannot be encoded as such.
+        self.assertNotIsInstance(fetched_obj, dict)
+        self.assertNotIsInstance(fetched_obj['a'], list)
+        with self.assertRaises(InvalidDocument):
+            bson.BSON.encode(fetched_obj)
+        with self.assertRaises(TypeError):
+            json.dumps(fetched_obj)
+
+        # Their copies can.
+        obj_copy = fetched_obj.copy()
+        self.assertEqual(obj_copy, bson.BSON.decode(bson.BSON.encode(obj_copy)))
+        self.assertEqual(obj_copy, json.loads(json.dumps(obj_copy)))
+
+    def test_write_with_dict_ids_without_copy_on_read(self):
+        collection = mongomock.MongoClient(copy_on_read=False).db.collection
+        collection.insert_many([{'_id': {'a': i}, 'v': i % 2} for i in range(5)])
+
+        self.assertEqual(1, collection.delete_one({'v': 0}).deleted_count)
+        self.assertEqual(2, collection.delete_many({'v': 1}).deleted_count)
+        self.assertEqual({'_id': {'a': 2}, 'v': 0}, collection.find_one_and_delete({}))
+        self.assertEqual([{'_id': {'a': 4}, 'v': 0}], list(collection.find()))
+
+        # Read-only views can be inserted back.
+        fetched_obj = collection.find_one()
+        collection.delete_one({'_id': fetched_obj['_id']})
+        collection.insert_one(fetched_obj)
+        collection.database.other.insert_many([fetched_obj])
+        self.assertEqual([{'_id': {'a': 4}, 'v': 0}], list(collection.find()))
+        self.assertEqual([{'_id': {'a': 4}, 'v': 0}], list(collection.database.other.find()))
+
     def test__update_retval(self):
         self.db.col.save({'a': 1})
         retval = self.db.col.update({'a': 1}, {'b': 2})
@@ -479,6 +561,37 @@ class CollectionAPITest(TestCase):
         with self.assertRaises(mongomock.OperationFailure):
             self.db.collection.count_documents('unique')
 
+    def test__count_documents_does_not_copy(self):
+        collection = self.db.collection
+        collection.insert_many([{'_id': i, 'value': i % 10} for i in range(100)])
+        collection.create_index('value')
+
+        compile_filter = mongomock.collection.compile_filter
+        filtered_docs = []
+
+        def _compile_counting_filter(search_filter):
+            matches_filter = compile_filter(search_filter)
+
+            def _matches(doc):
+                filtered_docs.append(doc)
+                return matches_filter(doc)
+            return _matches
+
+        with mock.patch.object(collection, '_compile_projection') as compile_projection, \
+                mock.patch('mongomock.collection.compile_filter',
+                           side_effect=_compile_counting_filter):
+            self.assertEqual(100, collection.estimated_document_count())
+            self.assertEqual(10, collection.count_documents({'value': 3}))
+            self.assertEqual([], filtered_docs)
+            self.assertEqual(8, collection.count_documents({'value': {'$lt': 4}}, skip=32))
+            self.assertEqual(
+                5, collection.count_documents({'value': 3, '_id': {'$gt': 50}}))
+            self.assertEqual(10, len(filtered_docs))
+            self.assertEqual(
+                3, collection.find({'value': 3}).skip(2).limit(3).count(with_limit_and_skip=True))
+            self.assertEqual(10, collection.find({'value': 3}).skip(2).limit(3).count())
+            compile_projection.assert_not_called()
+
     def test__find_returns_cursors(self):
         collection = self.db.collection
         self.assertEqual(type(collection.find()).__name__, 'Cursor')
@@ -1423,6 +1536,41 @@ class CollectionAPITest(TestCase):
             mongomock_utcnow.return_value = now + timedelta(100)
             self.assertEqual(self.db.collection.find({}).count(), 0)
 
+    @skipIf(not _HAVE_MOCK, 'mock not installed')
+    def test__ttl_expiry_only_removes_expired_documents(self):
+        now = datetime.utcnow()
+        self.db.collection.create_index([('value', 1)], expireAfterSeconds=10)
+        self.db.collection.insert_many([
+            {'_id': i, 'value': now + timedelta(seconds=i)} for i in range(20)
+        ])
+        self.db.collection.insert_one({'_id': 'no-date', 'value': 'a'})
+
+        with mock.patch('mongomock.utcnow') as mongomock_utcnow:
+            mongomock_utcnow.return_value = now + timedelta(seconds=15)
+            self.assertEqual(
+                [doc['_id'] for doc in self.db.collection.find()],
+                [6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 'no-date'])
+
+            mongomock_utcnow.return_value = now + timedelta(seconds=100)
+            self.assertEqual(['no-date'], [doc['_id'] for doc in self.db.collection.find()])
+
+    @skipIf(not _HAVE_MOCK, 'mock not installed')
+    def test__ttl_expiry_follows_updates(self):
+        now = datetime.utcnow()
+        self.db.collection.create_index([('value', 1)], expireAfterSeconds=100)
+        self.db.collection.insert_many([
+            {'_id': 1, 'value': now},
+            {'_id': 2, 'value': now},
+            {'_id': 3, 'value': now + timedelta(seconds=1000)},
+        ])
+        self.db.collection.update_one({'_id': 1}, {'$set': {'value': now + timedelta(1)}})
+        self.db.collection.update_one({'_id': 2}, {'$unset': {'value': ''}})
+        self.db.collection.update_one({'_id': 3}, {'$set': {'value': now}})
+
+        with mock.patch('mongomock.utcnow') as mongomock_utcnow:
+            mongomock_utcnow.return_value = now + timedelta(seconds=200)
+            self.assertEqual([1, 2], [doc['_id'] for doc in self.db.collection.find()])
+
     def test__ttl_index_is_removed_if_collection_dropped(self):
         self.db.collection.create_index([('value', 1)], expireAfterSeconds=0)
         self.db.collection.insert_one({'value': datetime.utcnow()})
@@ -1618,6 +1766,32 @@ class CollectionAPITest(TestCase):
         with self.assertRaises(mongomock.DuplicateKeyError):
             self.db.collection.insert_one({'_id': 4, 'a': {'b': 2}})
 
+    @skipIf(not _HAVE_MOCK, 'mock not installed')
+    def test_unique_index_does_not_scan_collection(self):
+        self.db.collection.create_index('email', unique=True)
+        with mock.patch('mongomock.collection.filter_applies') as filter_applies:
+            self.db.collection.insert_many(
+                [{'email': 'user%d@example.com' % i} for i in range(100)])
+            with self.assertRaises(mongomock.DuplicateKeyError):
+                self.db.collection.insert_one({'email': 'user42@example.com'})
+        self.assertFalse(filter_applies.called)
+        self.assertEqual(100, self.db.collection.count_documents({}))
+
+    def test_unique_index_on_array(self):
+        self.db.collection.create_index('tags', unique=True)
+        self.db.collection.insert_one({'_id': 1, 'tags': ['a', 'b', 'b']})
+        with self.assertRaises(mongomock.DuplicateKeyError):
+            self.db.collection.insert_one({'_id': 2, 'tags': 'b'})
+        with self.assertRaises(mongomock.DuplicateKeyError):
+            self.db.collection.insert_one({'_id': 3, 'tags': ['c', 'a']})
+        self.db.collection.insert_one({'_id': 4, 'tags': []})
+        with self.assertRaises(mongomock.DuplicateKeyError):
+            self.db.collection.insert_one({'_id': 5, 'tags': []})
+
+        self.db.collection.update_one({'_id': 1}, {'$pull': {'tags': 'b'}})
+        self.db.collection.insert_one({'_id': 6, 'tags': ['b']})
+        self.assertEqual([1, 4, 6], [doc['_id'] for doc in self.db.collection.find()])
+
     def test_sparse_unique_index_dup(self):
         self.db.collection.ensure_index([('value', 1)], unique=True, sparse=True)
 
@@ -1690,6 +1864,267 @@ class CollectionAPITest(TestCase):
         with self.assertRaises(mongomock.OperationFailure):
             self.db.collection.drop_index('unknownIndex')
 
+    @skipIf(not _HAVE_MOCK, 'mock not installed')
+    def test__find_uses_index(self):
+        self.db.collection.insert_many([{'_id': i, 'value': i % 10} for i in range(100)])
+        self.db.collection.create_index('value')
+
+        compile_filter = mongomock.collection.compile_filter
+        filtered_docs = []
+
+        def _compile_counting_filter(search_filter):
+            matches_filter = compile_filter(search_filter)
+
+            def _matches(doc):
+                filtered_docs.append(doc)
+                return matches_filter(doc)
+            return _matches
+
+        with mock.patch(
+                'mongomock.collection.compile_filter', side_effect=_compile_counting_filter):
+            self.assertEqual(
+                [3, 13, 23],
+                [doc['_id'] for doc in self.db.collection.find({
+                    'value': 3, 'other': {'$exists': False},
+                })][:3])
+            self.assertEqual(10, len(filtered_docs))
+
+            # Documents are not checked again when the index gives exactly the matches.
+            del filtered_docs[:]
+            self.assertEqual(
+                [3, 13, 23], [doc['_id'] for doc in self.db.collection.find({'value': 3})][:3])
+            self.assertEqual(0, len(filtered_docs))
+
+            del filtered_docs[:]
+            self.assertEqual(
+                20, len(list(self.db.collection.find({'value': {'$gt': 2, '$lte': 4}}))))
+            self.assertEqual(0, len(filtered_docs))
+
+            del filtered_docs[:]
+            self.assertEqual(
+                20, len(list(self.db.collection.find({'$and': [
+                    {'value': {'$gt': 2}}, {'value': {'$lte': 4}},
+                ]}))))
+            self.assertEqual(20, len(filtered_docs))
+
+            del filtered_docs[:]
+            self.assertEqual(
+                [], list(self.db.collection.find({'value': {'$gt': 2, '$lt': 'z'}})))
+            self.assertEqual(0, len(filtered_docs))
+
+    def test__find_with_index_on_other_operators(self):
+        self.db.collection.insert_many([
+            {'_id': 1, 'name': 'apple', 'tags': ['fruit', 'red']},
+            {'_id': 2, 'name': 'apricot', 'tags': ['fruit']},
+            {'_id': 3, 'name': 'banana', 'tags': 'fruit'},
+            {'_id': 4, 'name': 'Avocado'},
+            {'_id': 5, 'name': re.compile('^ap')},
+            {'_id': 6, 'name': None, 'tags': []},
+        ])
+        self.db.collection.create_index('name')
+        self.db.collection.create_index([('tags', 1), ('name', 1)])
+
+        def _find_ids(search_filter):
+            return [doc['_id'] for doc in self.db.collection.find(search_filter)]
+
+        self.assertEqual([1, 2], _find_ids({'name': {'$regex': '^ap'}}))
+        self.assertEqual([1, 2, 5], _find_ids({'name': re.compile('^ap')}))
+        self.assertEqual([1, 2], _find_ids({'name': {'$regex': '^apr?'}}))
+        self.assertEqual([4], _find_ids({'name': {'$regex': '^AV', '$options': 'i'}}))
+        self.assertEqual([1, 4], _find_ids({'name': {'$regex': '^(apple|Avo)'}}))
+        self.assertEqual([3, 4, 6], _find_ids({'name': {'$in': ['banana', 'Avocado', None]}}))
+        self.assertEqual([1, 3], _find_ids({'name': {'$in': [re.compile('^b'), 'apple']}}))
+        self.assertEqual([2, 3], _find_ids({'tags': 'fruit', 'name': {'$gt': 'apple'}}))
+        self.assertEqual([1], _find_ids({'$and': [{'tags': 'red'}, {'tags': 'fruit'}]}))
+        self.assertEqual([6], _find_ids({'tags': []}))
+        self.assertEqual([4, 5], _find_ids({'tags': None}))
+
+    def test__find_explain(self):
+        self.db.collection.insert_many([{'_id': i, 'value': i % 10} for i in range(100)])
+
+        explanation = self.db.collection.find({'value': 3}).explain()
+        self.assertEqual(
+            {'stage': 'COLLSCAN', 'filter': {'value': 3}, 'direction': 'forward'},
+            explanation['queryPlanner']['winningPlan'])
+        execution_stats = explanation['executionStats']
+        self.assertEqual(10, execution_stats['nReturned'])
+        self.assertEqual(100, execution_stats['totalDocsExamined'])
+        self.assertEqual(0, execution_stats['totalKeysExamined'])
+        self.assertIn('executionTimeMillis', execution_stats)
+
+        self.db.collection.create_index('value')
+        explanation = self.db.collection.find({'value': {'$gte': 3, '$lt': 5}, 'other': None}) \
+            .sort('_id', -1).skip(2).limit(5).explain()
+        winning_plan = explanation['queryPlanner']['winningPlan']
+        self.assertEqual(
+            ['LIMIT', 'SKIP', 'SORT', 'FETCH', 'IXSCAN'],
+            [stage['stage'] for stage in _iter_explain_stages(winning_plan)])
+        fetch_stage = winning_plan['inputStage']['inputStage']['inputStage']
+        self.assertEqual({'other': None}, fetch_stage['filter'])
+        index_stage = fetch_stage['inputStage']
+        self.assertEqual('value_1', index_stage['indexName'])
+        self.assertEqual({'value': 1}, dict(index_stage['keyPattern']))
+        self.assertFalse(index_stage['isMultiKey'])
+        self.assertEqual({'value': ['[3, 5)']}, dict(index_stage['indexBounds']))
+        execution_stats = explanation['executionStats']
+        self.assertEqual(5, execution_stats['nReturned'])
+        self.assertEqual(20, execution_stats['totalDocsExamined'])
+        self.assertEqual(20, execution_stats['totalKeysExamined'])
+
+        explanation = self.db.collection.find({'value': 3}, {'value': 1}).explain()
+        self.assertEqual(
+            ['PROJECTION', 'FETCH', 'IXSCAN'],
+            [stage['stage'] for stage in _iter_explain_stages(
+                explanation['queryPlanner']['winningPlan'])])
+        self.assertNotIn('filter', explanation['queryPlanner']['winningPlan']['inputStage'])
+        self.assertEqual(10, explanation['executionStats']['nReturned'])
+        self.assertEqual(10, explanation['executionStats']['totalDocsExamined'])
+
+    def test__find_by_id_does_not_scan(self):
+        self.db.collection.insert_many([{'_id': i, 'value': i % 10} for i in range(100)])
+        self.db.collection.insert_one({'_id': {'a': 1, 'b': [1, 2]}, 'value': 'dict'})
+
+        explanation = self.db.collection.find({'_id': 42}).explain()
+        self.assertEqual('IDHACK', explanation['queryPlanner']['winningPlan']['stage'])
+        self.assertEqual(1, explanation['executionStats']['totalDocsExamined'])
+
+        explanation = self.db.collection.find({'_id': {'$in': [3, 5, 1000]}}).explain()
+        self.assertEqual('IDHACK', explanation['queryPlanner']['winningPlan']['stage'])
+        self.assertEqual(2, explanation['executionStats']['nReturned'])
+        self.assertEqual(2, explanation['executionStats']['totalDocsExamined'])
+
+        self.assertEqual(
+            [3, 5], [doc['_id'] for doc in self.db.collection.find({'_id': {'$in': [5, 3]}})])
+        self.assertEqual(
+            [], list(self.db.collection.find({'_id': {'$in': [5, 3]}, 'value': 4})))
+        self.assertEqual({'_id': 7, 'value': 7}, self.db.collection.find_one(7))
+        self.assertEqual(
+            'dict', self.db.collection.find_one({'_id': {'b': [1, 2], 'a': 1}})['value'])
+        self.assertEqual(
+            'dict', self.db.collection.find_one({'_id': {'$eq': {'a': 1, 'b': [1, 2]}}})['value'])
+
+        self.db.collection.update_one({'_id': 7}, {'$set': {'value': 'updated'}})
+        self.assertEqual('updated', self.db.collection.find_one(7)['value'])
+        self.db.collection.update_one({'_id': {'a': 1, 'b': [1, 2]}}, {'$set': {'value': 'new'}})
+        self.assertEqual(
+            'new', self.db.collection.find_one({'_id': {'a': 1, 'b': [1, 2]}})['value'])
+        self.assertEqual(
+            8, self.db.collection.find_one_and_delete({'_id': {'$eq': 8}})['_id'])
+        self.assertEqual(1, self.db.collection.delete_one({'_id': 9}).deleted_count)
+        self.assertEqual(99, self.db.collection.count_documents({}))
+
+    def test__aggregate_explain(self):
+        self.db.collection.insert_many([{'_id': i, 'value': i % 10} for i in range(100)])
+        pipeline = [{'$match': {'value': 3}}, {'$count': 'total'}]
+
+        explanation = self.db.collection.aggregate(pipeline, explain=True)
+        self.assertEqual(1, explanation['ok'])
+        cursor_stage = explanation['stages'][0]['$cursor']
+        self.assertEqual('COLLSCAN', cursor_stage['queryPlanner']['winningPlan']['stage'])
+        self.assertNotIn('executionStats', cursor_stage)
+        self.assertEqual({'value': 3}, cursor_stage['query'])
+        self.assertEqual(pipeline[1:], explanation['stages'][1:])
+
+        explanation = self.db.collection.aggregate(pipeline, explain='executionStats')
+        cursor_stage = explanation['stages'][0]['$cursor']
+        self.assertEqual(10, cursor_stage['executionStats']['nReturned'])
+        self.assertEqual(
+            [1], [stage['nReturned'] for stage in explanation['stages'][1:]])
+
+        with self.assertRaises(mongomock.OperationFailure):
+            self.db.collection.aggregate(pipeline, explain='unknown')
+
+    def test__aggregate_leading_stages_run_as_query(self):
+        self.db.collection.insert_many([
+            {'_id': i, 'tenant': i % 10, 'value': i, 'payload': [i]} for i in range(100)])
+        self.db.collection.create_index('tenant')
+        pipeline = [
+            {'$match': {'tenant': 3}},
+            {'$match': {'value': {'$gte': 20}}},
+            {'$sort': {'value': -1}},
+            {'$skip': 1},
+            {'$limit': 3},
+            {'$project': {'payload': 0}},
+            {'$addFields': {'double': {'$multiply': ['$value', 2]}}},
+        ]
+
+        explanation = self.db.collection.aggregate(pipeline, explain='executionStats')
+        cursor_stage = explanation['stages'][0]['$cursor']
+        self.assertEqual({'$and': [{'tenant': 3}, {'value': {'$gte': 20}}]}, cursor_stage['query'])
+        self.assertEqual({'value': -1}, cursor_stage['sort'])
+        self.assertEqual(1, cursor_stage['skip'])
+        self.assertEqual(3, cursor_stage['limit'])
+        self.assertEqual({'payload': 0}, cursor_stage['fields'])
+        self.assertEqual(10, cursor_stage['executionStats']['totalKeysExamined'])
+        self.assertEqual(3, cursor_stage['executionStats']['nReturned'])
+        self.assertEqual(2, len(explanation['stages']))
+        self.assertEqual(pipeline[-1]['$addFields'], explanation['stages'][1]['$addFields'])
+
+        with mock.patch.object(
+                mongomock.collection, '_copy_by_spec',
+                side_effect=mongomock.collection._copy_by_spec) as mock_copy_by_spec:
+            actual = list(self.db.collection.aggregate(pipeline))
+        self.assertEqual([
+            {'_id': 83, 'tenant': 3, 'value': 83, 'double': 166},
+            {'_id': 73, 'tenant': 3, 'value': 73, 'double': 146},
+            {'_id': 63, 'tenant': 3, 'value': 63, 'double': 126},
+        ], actual)
+        # Only the documents returned by the query are copied.
+        self.assertEqual(
+            [83, 73, 63], [call[0][0]['_id'] for call in mock_copy_by_spec.call_args_list])
+
+        # A $limit before the $sort or an inclusion $project remain pipeline stages.
+        pipeline = [
+            {'$match': {'tenant': 3}},
+            {'$limit': 2},
+            {'$sort': {'value': -1}},
+            {'$project': {'value': 1}},
+        ]
+        explanation = self.db.collection.aggregate(pipeline, explain=True)
+        self.assertEqual(2, explanation['stages'][0]['$cursor']['limit'])
+        self.assertEqual(pipeline[2:], explanation['stages'][1:])
+        self.assertEqual(
+            [{'_id': 13, 'value': 13}, {'_id': 3, 'value': 3}],
+            list(self.db.collection.aggregate(pipeline)))
+
+    def test__find_with_filter_modified_between_calls(self):
+        self.db.collection.insert_many([{'_id': 1, 'a': 1}, {'_id': 2, 'a': 2}])
+        search_filter = {'a': {'$in': [1]}}
+        self.assertEqual([1], [doc['_id'] for doc in self.db.collection.find(search_filter)])
+
+        search_filter['a']['$in'][0] = 2
+        self.assertEqual([2], [doc['_id'] for doc in self.db.collection.find(search_filter)])
+
+    def test__find_with_filters_equal_in_python(self):
+        self.db.collection.insert_one({'_id': 1, 'a': 1})
+        self.assertEqual(1, len(list(self.db.collection.find({'a': {'$gt': 0}}))))
+        self.assertEqual(0, len(list(self.db.collection.find({'a': {'$gt': False}}))))
+        self.assertEqual(1, len(list(self.db.collection.find({'a': {'$gt': 0}}))))
+
+    def test__find_with_index_after_writes(self):
+        self.db.collection.create_index([('value', 1), ('other', 1)])
+        self.db.collection.insert_many([
+            {'_id': 1, 'value': 1},
+            {'_id': 2, 'value': 2},
+            {'_id': 3, 'value': [0, 10]},
+            {'_id': 4},
+            {'_id': 5, 'value': True},
+        ])
+        self.db.collection.update_one({'_id': 2}, {'$set': {'value': 3}})
+        self.db.collection.delete_one({'_id': 1})
+
+        self.assertEqual([], list(self.db.collection.find({'value': 2})))
+        self.assertEqual([2], [d['_id'] for d in self.db.collection.find({'value': 3})])
+        self.assertEqual(
+            [2, 3], [d['_id'] for d in self.db.collection.find({'value': {'$gt': 1, '$lt': 5}})])
+        self.assertEqual(
+            [3], [d['_id'] for d in self.db.collection.find({'value': {'$lt': 1}})])
+        self.assertEqual([4], [d['_id'] for d in self.db.collection.find({'value': None})])
+        self.assertEqual([5], [d['_id'] for d in self.db.collection.find({'value': 1})])
+
+        self.db.collection.drop_index('value_1_other_1')
+        self.assertEqual([5], [d['_id'] for d in self.db.collection.find({'value': 1})])
+
     @skipIf(not _HAVE_PYMONGO, 'pymongo not installed')
     def test__create_unique_idx_information_with_ascending_ordering(self):
         index = self.db.collection.create_index([('value', pymongo.ASCENDING)], unique=True)
@@ -1970,6 +2405,30 @@ class CollectionAPITest(TestCase):
         result = self.db.collection.find_one({'a': 1}, {'_id': 0, 'a': 1, 'b.c.f': 1})
         self.assertEqual(result, {'a': 1, 'b': [{}, {}]})
 
+    def test__find_projection_is_not_modified(self):
+        self.db.collection.insert_many([
+            {'_id': i, 'a': {'b': [i], 'c': i}, 'd': [{'e': j} for j in range(i + 3)]}
+            for i in range(3)])
+        projection = collections.OrderedDict([
+            ('_id', 0), ('a.b', 1), ('d', {'$slice': [1, 2]})])
+        projection_copy = copy.deepcopy(projection)
+
+        results = list(self.db.collection.find({}, projection))
+        self.assertEqual(projection_copy, projection)
+        self.assertEqual(list(projection_copy), list(projection))
+        self.assertEqual([
+            {'a': {'b': [0]}, 'd': [{'e': 1}, {'e': 2}]},
+            {'a': {'b': [1]}, 'd': [{'e': 1}, {'e': 2}]},
+            {'a': {'b': [2]}, 'd': [{'e': 1}, {'e': 2}]},
+        ], results)
+
+        # Projected values are copies of the stored ones.
+        results[0]['a']['b'].append(1)
+        results[0]['d'][0]['e'] = 5
+        self.assertEqual(
+            {'_id': 0, 'a': {'b': [0], 'c': 0}, 'd': [{'e': 0}, {'e': 1}, {'e': 2}]},
+            self.db.collection.find_one({'_id': 0}))
+
     def test__find_projection_with_subdoc_lists_refinements(self):
         doc = {'a': 1, 'b': [{'c': 2, 'd': 3, 'e': 4}, {'c': 5, 'd': 6, 'e': 7}]}
         self.db.collection.insert_one(doc)
@@ -2209,6 +2668,39 @@ class CollectionAPITest(TestCase):
         self.assertTrue(dates[0].tzinfo)
         self.assertEqual(dates[0].tzinfo, dates[1].tzinfo)
 
+    def test__tz_aware_projection(self):
+        client = mongomock.MongoClient(tz_aware=True)
+        collection = client.db.collection
+        collection.insert_one({
+            '_id': 1, 'a': {'b': datetime(2000, 1, 1), 'c': 1},
+            'dates': [datetime(2000, 1, 2), datetime(2000, 1, 3)],
+        })
+        self.assertEqual(
+            {'_id': 1, 'a': {'b': datetime(2000, 1, 1, tzinfo=mongomock.helpers.utc)}},
+            collection.find_one({}, {'a.b': 1}))
+        self.assertEqual(
+            {'a': {'c': 1}, 'dates': [datetime(2000, 1, 3, tzinfo=mongomock.helpers.utc)]},
+            collection.find_one({}, {'_id': 0, 'a.b': 0, 'dates': {'$slice': -1}}))
+        self.assertEqual(
+            [datetime(2000, 1, 2, tzinfo=mongomock.helpers.utc)],
+            collection.find().sort('a.b').distinct('dates')[:1])
+
+    def test__tz_aware_skipped_without_datetimes(self):
+        collection = mongomock.MongoClient(tz_aware=True).db.collection
+        collection.insert_one({'_id': 1, 'a': 1})
+        self.assertFalse(collection._store.may_contain_datetimes)
+
+        collection.insert_one({'_id': 2, 'a': [{'b': datetime(2000, 1, 1)}]})
+        self.assertTrue(collection._store.may_contain_datetimes)
+        self.assertTrue(collection.find_one({'_id': 2})['a'][0]['b'].tzinfo)
+
+        collection.delete_many({})
+        self.assertFalse(collection._store.may_contain_datetimes)
+        collection.insert_one({'_id': 1})
+        collection.update_one({'_id': 1}, {'$currentDate': {'date': True}})
+        self.assertTrue(collection._store.may_contain_datetimes)
+        self.assertTrue(collection.find_one()['date'].tzinfo)
+
     @skipIf(_HAVE_PYMONGO, 'pymongo installed')
     def test__current_date_timestamp_requires_pymongo(self):
         with self.assertRaises(NotImplementedError):
@@ -2292,6 +2784,53 @@ class CollectionAPITest(TestCase):
         self.assertEqual(next(curs)['a'], 1)
         self.assertEqual(next(curs)['a'], 2)
 
+    def test__cursor_fetches_results_in_batches(self):
+        coll = self.db.create_collection('a')
+        coll.insert_many([{'_id': i} for i in range(500)])
+
+        copied_docs = []
+        compile_projection = coll._compile_projection
+
+        def _compile_counting_projection(*args):
+            project = compile_projection(*args)
+
+            def _project(doc):
+                copied_docs.append(doc)
+                return project(doc)
+            return _project
+
+        with mock.patch.object(
+                coll, '_compile_projection', side_effect=_compile_counting_projection):
+            self.assertEqual([0, 1, 2], [doc['_id'] for doc in coll.find().limit(3)])
+            self.assertEqual(3, len(copied_docs))
+
+            del copied_docs[:]
+            cursor = coll.find().batch_size(10)
+            self.assertEqual(0, next(cursor)['_id'])
+            self.assertTrue(cursor.alive)
+            self.assertEqual(10, len(copied_docs))
+            self.assertEqual(25, cursor[25]['_id'])
+            self.assertEqual(30, len(copied_docs))
+            cursor.rewind()
+            self.assertEqual(0, next(cursor)['_id'])
+            self.assertEqual(30, len(copied_docs))
+
+            del copied_docs[:]
+            cursor = coll.find().skip(495)
+            self.assertEqual([495, 496, 497, 498, 499], [doc['_id'] for doc in cursor])
+            self.assertFalse(cursor.alive)
+            self.assertEqual(5, len(copied_docs))
+
+            del copied_docs[:]
+            cursor = coll.find().sort('_id', -1).skip(100).limit(10)
+            self.assertEqual(list(range(399, 389, -1)), [doc['_id'] for doc in cursor])
+            self.assertEqual(10, len(copied_docs))
+
+        with self.assertRaises(IndexError):
+            coll.find().limit(3)[3]  # pylint: disable=expression-not-assigned
+        with self.assertRaises(TypeError):
+            coll.find().batch_size('10')
+
     def test__cursor_sort(self):
         coll = self.db.create_collection('a')
         coll.insert_many([{'a': 1}, {'a': 3}, {'a': 2}])
@@ -2327,6 +2866,53 @@ class CollectionAPITest(TestCase):
         self.assertEqual(
             [2, 3, 1], [doc['_id'] for doc in coll.find().sort((('b', 1), ('a', 1)))])
 
+    def test__cursor_sort_mixed_directions_and_types(self):
+        coll = self.db.create_collection('a')
+        coll.insert_many([
+            {'_id': 1, 'a': 1, 'b': 'x'},
+            {'_id': 2, 'a': 'one', 'b': 2},
+            {'_id': 3, 'a': 1, 'b': float('nan')},
+            {'_id': 4, 'a': 1, 'b': float('-inf')},
+            {'_id': 5, 'b': 'y'},
+            {'_id': 6, 'a': 1, 'b': None},
+            {'_id': 7, 'a': 'one', 'b': {'c': 1}},
+            {'_id': 8, 'a': 1, 'b': 'y'},
+        ])
+
+        self.assertEqual(
+            [5, 8, 1, 4, 3, 6, 7, 2],
+            [doc['_id'] for doc in coll.find().sort([('a', 1), ('b', -1)])])
+        self.assertEqual(
+            [2, 7, 6, 3, 4, 1, 8, 5],
+            [doc['_id'] for doc in coll.find().sort([('a', -1), ('b', 1)])])
+        self.assertEqual(
+            [7, 5, 8, 1, 2, 4, 3, 6],
+            [doc['_id'] for doc in coll.find().sort([('b', -1), ('a', 1)])])
+
+    def test__cursor_sort_with_limit(self):
+        coll = self.db.create_collection('a')
+        coll.insert_many([{'_id': i, 'score': i % 7, 'rank': i % 3} for i in range(50)])
+        sort = [('score', -1), ('rank', 1)]
+        all_ids = [doc['_id'] for doc in coll.find().sort(sort)]
+
+        cursor = coll.find().sort(sort).limit(5)
+        self.assertEqual(all_ids[:5], [doc['_id'] for doc in cursor])
+        self.assertEqual(all_ids[10:15], [doc['_id'] for doc in coll.find().sort(sort)[10:15]])
+
+        # Raising the limit after the first results were fetched.
+        cursor = coll.find().sort(sort).limit(2)
+        self.assertEqual(all_ids[0], next(cursor)['_id'])
+        cursor.limit(20)
+        self.assertEqual(all_ids[1:20], [doc['_id'] for doc in cursor])
+
+        self.assertEqual(
+            all_ids[3:8],
+            [doc['_id'] for doc in coll.aggregate([
+                {'$sort': collections.OrderedDict(sort)},
+                {'$skip': 3},
+                {'$limit': 5},
+            ])])
+
     def test__cursor_sort_projection(self):
         col = self.db.col
         col.insert_many([{'a': 1, 'b': 1}, {'a': 3, 'b': 3}, {'a': 2, 'b': 2}])
@@ -2697,6 +3283,120 @@ class CollectionAPITest(TestCase):
             {'_id': 3, 'b': [{'_id': 4, 'arr': [1, 3]}]}
         ], list(actual))
 
+    def test__aggregate_lookup_hash_join(self):
+        self.db.a.insert_many([
+            {'_id': 1, 'k': [3, 1]},
+            {'_id': 2, 'k': 'x'},
+            {'_id': 3},
+            {'_id': 4, 'k': re.compile('^x')},
+        ])
+        self.db.b.insert_many([
+            {'_id': 'b1', 'k': [1, 2]},
+            {'_id': 'b2', 'k': 3.0},
+            {'_id': 'b3', 'k': None},
+            {'_id': 'b4', 'sub': {'k': 'x'}},
+            {'_id': 'b5', 'k': ['x', 1]},
+        ])
+        pipeline = [
+            {'$lookup': {'from': 'b', 'localField': 'k', 'foreignField': 'k', 'as': 'b'}},
+            {'$project': {'b': '$b._id'}},
+        ]
+        expected = [
+            {'_id': 1, 'b': ['b1', 'b2', 'b5']},
+            {'_id': 2, 'b': ['b5']},
+            {'_id': 3, 'b': ['b3', 'b4']},
+            {'_id': 4, 'b': ['b5']},
+        ]
+        self.assertEqual(expected, list(self.db.a.aggregate(pipeline)))
+
+        iter_stored_copies = mongomock.collection.Collection._iter_stored_copies
+        with mock.patch.object(
+                mongomock.collection.Collection, '_iter_stored_copies', autospec=True,
+                side_effect=iter_stored_copies) as mock_iter_stored_copies:
+            list(self.db.a.aggregate(pipeline))
+        # Each collection is scanned once.
+        self.assertEqual(2, mock_iter_stored_copies.call_count)
+
+        # Joined documents are independent copies.
+        joined = list(self.db.a.aggregate(pipeline[:1]))
+        joined[0]['b'][2]['k'].append(4)
+        self.assertEqual(['x', 1], joined[1]['b'][0]['k'])
+        self.assertEqual(['x', 1], self.db.b.find_one({'_id': 'b5'})['k'])
+
+        # With an index, the documents are looked up with queries.
+        self.db.b.create_index('k')
+        self.assertEqual(expected, list(self.db.a.aggregate(pipeline)))
+
+    def test__aggregate_lookup_hash_join_equality(self):
+        self.db.a.insert_many([
+            {'_id': 1, 'k': True},
+            {'_id': 2, 'k': 1},
+            {'_id': 3, 'k': {'x': 1, 'y': 2}},
+        ])
+        self.db.b.insert_many([
+            {'_id': 'b1', 'k': 1},
+            {'_id': 'b2', 'k': {'y': 2, 'x': 1}},
+            {'_id': 'b3', 'k': [[1]]},
+        ])
+        pipeline = [
+            {'$lookup': {'from': 'b', 'localField': 'k', 'foreignField': 'k', 'as': 'b'}},
+            {'$project': {'b': '$b._id'}},
+        ]
+        expected = [
+            {'_id': 1, 'b': ['b1']},
+            {'_id': 2, 'b': ['b1']},
+            {'_id': 3, 'b': ['b2']},
+        ]
+        self.assertEqual(expected, list(self.db.a.aggregate(pipeline)))
+
+        # The hash join gives the same results as the queries used with an index.
+        self.db.b.create_index('k')
+        self.assertEqual(expected, list(self.db.a.aggregate(pipeline)))
+
+    def test__aggregate_lookup_with_and_without_index(self):
+        values = [
+            {}, {'a': 1}, {'a': {}}, [], [{}], [[]], None, 1, True, [1, {}], 'a', [None],
+            float('nan'),
+        ]
+        self.db.a.insert_many(
+            [{'_id': i, 'k': value} for i, value in enumerate(values)] + [{'_id': 100}])
+        self.db.b.insert_many([{'_id': i, 'k': value} for i, value in enumerate(values)])
+        self.db.b.insert_many(
+            [{'_id': 100}, {'_id': 101, 'k': {'a': 1, 'b': 2}}, {'_id': 102, 'k': [{'a': 1}]}])
+        pipeline = [
+            {'$lookup': {'from': 'b', 'localField': 'k', 'foreignField': 'k', 'as': 'b'}},
+            {'$project': {'b': '$b._id'}},
+        ]
+        results = []
+        for has_index in (False, True):
+            if has_index:
+                self.db.b.create_index('k')
+            results.append(list(self.db.a.aggregate(pipeline)))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual([0, 4, 9, 100], results[0][0]['b'])
+        self.assertEqual([7, 8, 9], results[0][8]['b'])
+        self.assertEqual([], results[0][12]['b'])
+
+    @skipIf(not _HAVE_PYMONGO, 'pymongo not installed')
+    def test__aggregate_lookup_decimal128(self):
+        self.db.a.insert_many([
+            {'_id': 1, 'k': decimal128.Decimal128('1.5')},
+            {'_id': 2, 'k': 2},
+        ])
+        self.db.b.insert_many([
+            {'_id': 'b1', 'k': decimal128.Decimal128('1.5')},
+            {'_id': 'b2', 'k': [2, decimal128.Decimal128('2.5')]},
+            {'_id': 'b3', 'k': 2},
+        ])
+        pipeline = [
+            {'$lookup': {'from': 'b', 'localField': 'k', 'foreignField': 'k', 'as': 'b'}},
+            {'$project': {'b': '$b._id'}},
+        ]
+        self.assertEqual([
+            {'_id': 1, 'b': ['b1']},
+            {'_id': 2, 'b': ['b2', 'b3']},
+        ], list(self.db.a.aggregate(pipeline)))
+
     def test__aggregate_lookup_not_implemented_operators(self):
         with self.assertRaises(NotImplementedError) as err:
             self.db.a.aggregate([
@@ -2942,6 +3642,36 @@ class CollectionAPITest(TestCase):
             ]
         }], list(actual))
 
+    def test__aggregate_graph_lookup_in_facet(self):
+        self.db.a.insert_one({'_id': 1, 'parent_name': 'b', 'sub': {'c': 1}})
+        self.db.b.insert_many([
+            {'_id': 2, 'name': 'a', 'parent': 'b'},
+            {'_id': 3, 'name': 'b', 'parent': 'a'},
+        ])
+        graph_lookup = {'$graphLookup': {
+            'from': 'b',
+            'startWith': '$parent_name',
+            'connectFromField': 'name',
+            'connectToField': 'parent',
+            'as': 'b',
+        }}
+        actual = self.db.a.aggregate([{'$facet': {
+            'first': [graph_lookup, {'$project': {'b._id': 1}}],
+            'second': [graph_lookup],
+            'unchanged': [],
+        }}])
+        self.assertEqual([{
+            'first': [{'_id': 1, 'b': [{'_id': 2}, {'_id': 3}]}],
+            'second': [{
+                '_id': 1, 'parent_name': 'b', 'sub': {'c': 1},
+                'b': [
+                    {'_id': 2, 'name': 'a', 'parent': 'b'},
+                    {'_id': 3, 'name': 'b', 'parent': 'a'},
+                ],
+            }],
+            'unchanged': [{'_id': 1, 'parent_name': 'b', 'sub': {'c': 1}}],
+        }], list(actual))
+
     def test__aggregate_graph_lookup_restrict_search(self):
         self.db.a.insert_one({'_id': 1, 'item': 2})
         self.db.b.insert_many([
@@ -3827,6 +4557,33 @@ class CollectionAPITest(TestCase):
               'upper_err': ''}],
             [{k: v for k, v in doc.items() if k != '_id'} for doc in actual])
 
+    def test__aggregate_match_added_datetime(self):
+        self.db.collection.insert_one({'_id': 1})
+        date = datetime(2020, 1, 1, 0, 0, 0, 123456)
+        actual = self.db.collection.aggregate([
+            {'$addFields': {'d': date}},
+            {'$match': {'d': date}},
+            {'$project': {'_id': 1}},
+        ])
+        self.assertEqual([{'_id': 1}], list(actual))
+
+    def test__aggregate_match_stored_datetimes_without_patching(self):
+        date = datetime(2020, 1, 1, 0, 0, 0, 123000)
+        self.db.collection.insert_many([{'_id': i, 'd': [date, i]} for i in range(10)])
+        patch_datetime_awareness_in_spec = mongomock.helpers.patch_datetime_awareness_in_spec
+        with mock.patch.object(
+                mongomock.helpers, 'patch_datetime_awareness_in_spec',
+                side_effect=patch_datetime_awareness_in_spec) as mock_patch:
+            actual = self.db.collection.aggregate([
+                {'$unwind': '$d'},
+                {'$match': {'d': date}},
+                {'$project': {'_id': 1}},
+            ])
+            self.assertEqual([{'_id': i} for i in range(10)], list(actual))
+        # Only the filter of the initial query and the spec of the $match stage are patched, not
+        # the unwound documents.
+        self.assertEqual(2, mock_patch.call_count)
+
     def test__aggregate_regexpmatch(self):
         self.db.collection.insert_one({
             'a': 'Hello',
@@ -4000,13 +4757,42 @@ class CollectionAPITest(TestCase):
 
         with self.assertRaises(NotImplementedError):
             self.db.collection.aggregate([
-                {'$group': {'_id': '$b', 'a': {'$mergeObjects': '$a'}}},
+                {'$project': {'a': {'$mergeObjects': [{'a': 2, 'b': 3}, {'a': 5}]}}},
             ])
 
-        with self.assertRaises(NotImplementedError):
-            self.db.collection.aggregate([
-                {'$project': {'a': {'$mergeObjects': [{'a': 2, 'b': 3}, {'a': 5}]}}},
+    def test__aggregate_compiles_expressions_once(self):
+        self.db.collection.insert_many([{'_id': i, 'a': i, 'b': [i]} for i in range(10)])
+        compile_parser_expression = mongomock.aggregate._compile_parser_expression
+        with mock.patch.object(
+                mongomock.aggregate, '_compile_parser_expression',
+                side_effect=compile_parser_expression) as mock_compile:
+            actual = self.db.collection.aggregate([
+                {'$project': {
+                    'a': {'$add': ['$a', 1]},
+                    'b': {'$filter': {'input': '$b', 'cond': {'$gt': ['$$this', 4]}}},
+                }},
+                {'$group': {'_id': {'$mod': ['$a', 2]}, 'count': {'$sum': 1}}},
             ])
+            self.assertEqual(
+                [{'_id': 0, 'count': 5}, {'_id': 1, 'count': 5}],
+                sorted(actual, key=lambda doc: doc['_id']))
+        # $add, '$a' and 1; $filter, '$b', $gt, '$$this' and 4; $mod, '$a' and 2; 1.
+        self.assertEqual(12, mock_compile.call_count)
+
+    def test__aggregate_uses_one_parser_per_expression(self):
+        self.db.collection.insert_many([{'_id': i, 'a': i} for i in range(10)])
+        parser_class = mongomock.aggregate._Parser
+        with mock.patch.object(
+                mongomock.aggregate, '_Parser', side_effect=parser_class) as mock_parser:
+            actual = self.db.collection.aggregate([
+                {'$project': {'a': {'$add': ['$a', 1]}}},
+                {'$group': {'_id': {'$mod': ['$a', 2]}, 'count': {'$sum': 1}}},
+            ])
+            self.assertEqual(
+                [{'_id': 0, 'count': 5}, {'_id': 1, 'count': 5}],
+                sorted(actual, key=lambda doc: doc['_id']))
+        # One for each of the $add, $mod and $sum expressions, whatever the number of documents.
+        self.assertEqual(3, mock_parser.call_count)
 
     def test__aggregate_project_rotate(self):
         self.db.collection.insert_one({'_id': 1, 'a': 1, 'b': 2, 'c': 3})
@@ -4193,6 +4979,80 @@ class CollectionAPITest(TestCase):
             ],
             list(actual))
 
+    def test__unwind_shares_untouched_values(self):
+        self.db.collection.insert_one({
+            '_id': 1, 'payload': {'a': [1, 2]}, 'nest': {'sizes': ['S', 'M'], 'other': {'b': 1}},
+        })
+        documents = list(self.db.collection._iter_stored_copies())
+        with mock.patch.object(copy, 'deepcopy', side_effect=AssertionError('deepcopy')):
+            unwound = list(mongomock.aggregate._handle_unwind_stage(
+                documents, self.db, {'path': '$nest.sizes', 'includeArrayIndex': 'nest.index'}))
+        self.assertEqual([
+            {'_id': 1, 'payload': {'a': [1, 2]},
+             'nest': {'sizes': 'S', 'index': 0, 'other': {'b': 1}}},
+            {'_id': 1, 'payload': {'a': [1, 2]},
+             'nest': {'sizes': 'M', 'index': 1, 'other': {'b': 1}}},
+        ], unwound)
+        self.assertIs(unwound[0]['payload'], unwound[1]['payload'])
+        self.assertIs(unwound[0]['nest']['other'], unwound[1]['nest']['other'])
+        self.assertEqual(['S', 'M'], documents[0]['nest']['sizes'])
+
+        actual = self.db.collection.aggregate([
+            {'$unwind': '$nest.sizes'},
+            {'$addFields': {'payload.b': '$nest.sizes', 'nest.other.c': 2}},
+        ])
+        self.assertEqual([
+            {'_id': 1, 'payload': {'a': [1, 2], 'b': 'S'},
+             'nest': {'sizes': 'S', 'other': {'b': 1, 'c': 2}}},
+            {'_id': 1, 'payload': {'a': [1, 2], 'b': 'M'},
+             'nest': {'sizes': 'M', 'other': {'b': 1, 'c': 2}}},
+        ], list(actual))
+
+    def test__unwind_returns_independent_documents(self):
+        self.db.collection.insert_one({'_id': 1, 'items': [1, 2, 3], 'meta': {'x': 1}})
+        unwound = list(self.db.collection.aggregate([{'$unwind': '$items'}]))
+        unwound[0]['meta']['x'] = 99
+        self.assertEqual([{'x': 99}, {'x': 1}, {'x': 1}], [doc['meta'] for doc in unwound])
+
+        grouped = list(self.db.collection.aggregate([
+            {'$unwind': '$items'},
+            {'$group': {'_id': None, 'metas': {'$push': '$meta'}}},
+        ]))
+        grouped[0]['metas'][0]['x'] = 99
+        self.assertEqual([{'x': 99}, {'x': 1}, {'x': 1}], grouped[0]['metas'])
+
+    def test__aggregate_streams_documents(self):
+        pulled = []
+
+        def _documents():
+            for i in range(100):
+                pulled.append(i)
+                yield {'_id': i, 'a': i, 'sizes': ['S', 'M']}
+
+        cursor = mongomock.aggregate.process_pipeline(_documents(), self.db, [
+            {'$match': {'a': {'$gte': 10}}},
+            {'$unwind': '$sizes'},
+            {'$addFields': {'b': '$a'}},
+            {'$project': {'b': 1, 'sizes': 1}},
+            {'$skip': 1},
+            {'$limit': 2},
+        ], None)
+        # Only the first document is computed when creating the cursor.
+        self.assertEqual(11, len(pulled))
+        self.assertEqual([
+            {'_id': 10, 'b': 10, 'sizes': 'M'},
+            {'_id': 11, 'b': 11, 'sizes': 'S'},
+        ], list(cursor))
+        self.assertEqual(12, len(pulled))
+
+    def test__aggregate_out_to_source_collection(self):
+        self.db.collection.insert_many([{'_id': i, 'a': i} for i in range(3)])
+        self.db.collection.aggregate([
+            {'$match': {'a': {'$gte': 1}}},
+            {'$out': 'collection'},
+        ])
+        self.assertEqual([{'_id': 1, 'a': 1}, {'_id': 2, 'a': 2}], list(self.db.collection.find()))
+
     def test__array_size_non_array(self):
         self.db.collection.insert_one({'_id': 1, 'arr0': [], 'arr3': [1, 2, 3]})
         with self.assertRaises(mongomock.OperationFailure) as err:
@@ -4726,6 +5586,30 @@ class CollectionAPITest(TestCase):
             list(actual)
         )
 
+    def test__aggregate_group_equal_keys(self):
+        collection = self.db.collection
+        collection.insert_many(
+            [
+                {'a': 1, 'b': [1, 2]},
+                {'a': 1.0, 'b': [1.0, 2]},
+                {'a': float('nan'), 'b': {'c': 1}},
+                {'a': float('nan'), 'b': {'c': 1.0}},
+                {'a': '1', 'b': [1, 2]},
+            ]
+        )
+        actual = collection.aggregate([
+            {'$group': {'_id': '$a', 'count': {'$sum': 1}}},
+        ])
+        counts = sorted((doc['count'], repr(doc['_id'])) for doc in actual)
+        self.assertEqual([(1, "'1'"), (2, '1'), (2, 'nan')], counts)
+
+        actual = collection.aggregate([
+            {'$group': {'_id': '$b', 'count': {'$sum': 1}}},
+        ])
+        self.assertEqual(
+            [{'_id': [1, 2], 'count': 3}, {'_id': {'c': 1}, 'count': 2}],
+            sorted(actual, key=lambda doc: -doc['count']))
+
     @skipIf(not _HAVE_PYMONGO, 'pymongo not installed')
     def test__aggregate_group_dbref_key(self):
         collection = self.db.collection
@@ -4796,6 +5680,45 @@ class CollectionAPITest(TestCase):
         }]
         self.assertEqual(expect, list(actual))
 
+    def test__aggregate_group_accumulators(self):
+        collection = self.db.collection
+        collection.insert_many([
+            {'_id': 1, 'a': 2, 'b': {'x': 1}, 'c': [1]},
+            {'_id': 2, 'a': 4, 'b': {'y': 2}, 'c': [1.0]},
+            {'_id': 3, 'a': 'not a number', 'b': None, 'c': [2]},
+            {'_id': 4, 'a': 6, 'b': {'x': 3}},
+        ])
+        actual = collection.aggregate([{'$group': {
+            '_id': None,
+            'std_dev_pop': {'$stdDevPop': '$a'},
+            'std_dev_samp': {'$stdDevSamp': '$a'},
+            'merged': {'$mergeObjects': '$b'},
+            'set': {'$addToSet': '$c'},
+            'first': {'$first': '$c'},
+            'last': {'$last': '$c'},
+        }}])
+        self.assertEqual([{
+            '_id': None,
+            'std_dev_pop': (8 / 3.) ** .5,
+            'std_dev_samp': 2.,
+            'merged': {'x': 3, 'y': 2},
+            'set': [[1], [2]],
+            'first': [1],
+            'last': [2],
+        }], list(actual))
+
+        actual = collection.aggregate([{'$group': {
+            '_id': '$_id',
+            'std_dev_pop': {'$stdDevPop': '$a'},
+            'std_dev_samp': {'$stdDevSamp': '$a'},
+            'merged': {'$mergeObjects': '$b'},
+        }}, {'$match': {'_id': 3}}])
+        self.assertEqual(
+            [{'_id': 3, 'std_dev_pop': None, 'std_dev_samp': None, 'merged': {}}], list(actual))
+
+        with self.assertRaises(mongomock.OperationFailure):
+            collection.aggregate([{'$group': {'_id': None, 'a': {'$mergeObjects': '$a'}}}])
+
     def test__aggregate_bucket(self):
         collection = self.db.collection
         collection.drop()
@@ -5384,6 +6307,36 @@ class CollectionAPITest(TestCase):
         }]
         self.assertEqual(expect, list(actual))
 
+    @skipIf(not _HAVE_PYMONGO, 'pymongo not installed')
+    def test__add_to_set_unsortable_values(self):
+        collection = self.db.collection
+        collection.insert_many([
+            {'v': decimal128.Decimal128('1.5')},
+            {'v': Timestamp(1, 1)},
+            {'v': decimal128.Decimal128('1.5')},
+            {'v': 1},
+        ])
+        actual = collection.aggregate([{'$group': {'_id': None, 'v': {'$addToSet': '$v'}}}])
+        self.assertEqual(
+            [{'_id': None, 'v': [decimal128.Decimal128('1.5'), Timestamp(1, 1), 1]}],
+            list(actual))
+
+    def test__group_unknown_operators(self):
+        collection = self.db.collection
+        collection.insert_one({'v': 1})
+        with self.assertRaises(NotImplementedError) as err:
+            collection.aggregate([{'$group': {'_id': None, 'v': {'$unknown': '$v'}}}])
+        self.assertIn('$unknown is not a valid group operator', str(err.exception))
+
+        accumulators = dict(mongomock.aggregate._ACCUMULATORS)
+        del accumulators['$stdDevSamp']
+        with mock.patch.object(mongomock.aggregate, '_ACCUMULATORS', accumulators):
+            with self.assertRaises(NotImplementedError) as err:
+                collection.aggregate([{'$group': {'_id': None, 'v': {'$stdDevSamp': '$v'}}}])
+        self.assertIn(
+            'Although $stdDevSamp is a valid group operator for the aggregation pipeline, '
+            'it is currently not implemented in Mongomock.', str(err.exception))
+
     def test__not_implemented_operator(self):
         collection = self.db.collection
         with self.assertRaises(NotImplementedError):
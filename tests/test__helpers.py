@@ -1,7 +1,9 @@
+from datetime import datetime
 import json
 import os
 
 from mongomock.helpers import hashdict
+from mongomock.helpers import patch_datetime_awareness_in_spec
 from mongomock.helpers import get_value_by_dot, set_value_by_dot
 from mongomock.helpers import parse_uri
 from mongomock.helpers import print_deprecation_warning
@@ -162,3 +164,16 @@ class ValueByDotTest(TestCase):
                 ({'a': [{'b': 1}]}, 'a.1.b'),
                 ({'a': [{'b': 1}]}, 'a.1')):
             self.assertRaises(KeyError, set_value_by_dot, doc, key, 42)
+
+
+class PatchDatetimeAwarenessTest(TestCase):
+
+    def test__patch_datetime_awareness_in_spec(self):
+        spec = {'a': {'$in': [1, 'b']}, 'c': {'d': datetime(2000, 1, 1, 2, 0, 0, 3000)}}
+        self.assertIs(spec, patch_datetime_awareness_in_spec(spec))
+
+        spec = {'a': [1, {'b': datetime(2000, 1, 1, 2, 0, 0, 3500)}], 'c': (1, 2)}
+        patched_spec = patch_datetime_awareness_in_spec(spec)
+        self.assertEqual(
+            {'a': [1, {'b': datetime(2000, 1, 1, 2, 0, 0, 3000)}], 'c': [1, 2]}, patched_spec)
+        self.assertEqual(datetime(2000, 1, 1, 2, 0, 0, 3500), spec['a'][1]['b'])